@@ -0,0 +1,87 @@
+import numpy as np
+
+
+class StreamingAggregator:
+    """
+    Per-pixel running statistics over a stream of daily maps.
+
+    Maps are consumed one at a time (Welford's algorithm), so memory stays
+    constant no matter how many days are processed. NaN pixels are skipped and
+    counted separately, so each pixel keeps its own number of valid samples.
+    Statistics are accumulated in dtype, float64 by default; float32 halves
+    the memory at about 1e-6 relative error on the mean.
+    """
+
+    def __init__(self, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.valid_count = None
+        self.minimum = None
+        self.maximum = None
+        self._mean = None
+        self._m2 = None
+
+    def update(self, array):
+        """Add one daily map to the running statistics."""
+        array = np.asarray(array, dtype=self.dtype)
+
+        if self._mean is None:
+            self.valid_count = np.zeros(array.shape, dtype=np.int64)
+            self.minimum = np.full(array.shape, np.nan, dtype=self.dtype)
+            self.maximum = np.full(array.shape, np.nan, dtype=self.dtype)
+            self._mean = np.zeros(array.shape, dtype=self.dtype)
+            self._m2 = np.zeros(array.shape, dtype=self.dtype)
+        elif array.shape != self._mean.shape:
+            raise ValueError(f"Expected map of shape {self._mean.shape}, got {array.shape}")
+
+        valid = ~np.isnan(array)
+        self.count += 1
+        self.valid_count += valid
+
+        delta = np.where(valid, array - self._mean, 0.0)
+        self._mean += delta / np.maximum(self.valid_count, 1)
+        # Second factor uses the updated mean; zero where the pixel was invalid
+        self._m2 += delta * np.where(valid, array - self._mean, 0.0)
+
+        np.fmin(self.minimum, array, out=self.minimum)
+        np.fmax(self.maximum, array, out=self.maximum)
+        return self
+
+    def update_all(self, arrays):
+        """Consume an iterator of daily maps."""
+        for array in arrays:
+            self.update(array)
+        return self
+
+    def _check_not_empty(self):
+        if self._mean is None:
+            raise ValueError("No maps have been aggregated")
+
+    @property
+    def mean(self):
+        """Per-pixel mean over valid samples, NaN where a pixel was never valid."""
+        self._check_not_empty()
+        return np.where(self.valid_count > 0, self._mean, np.nan)
+
+    def variance(self, ddof=0):
+        """Per-pixel variance over valid samples, NaN where too few samples."""
+        self._check_not_empty()
+        dof = self.valid_count - ddof
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(dof > 0, self._m2 / dof, np.nan)
+
+    def std(self, ddof=0):
+        """Per-pixel standard deviation over valid samples."""
+        return np.sqrt(self.variance(ddof))
+
+    def result(self):
+        """Return all statistics as a dict of arrays."""
+        return {
+            'count': self.count,
+            'valid_count': self.valid_count.copy(),
+            'mean': self.mean,
+            'variance': self.variance(),
+            'min': self.minimum.copy(),
+            'max': self.maximum.copy(),
+        }
+
@@ -0,0 +1,222 @@
+"""
+Anomaly flags of daily emissions, for many sites at once.
+
+Reads the rows appended to an emissions CSV since the last run, flags their new
+days and appends them, with an Anomaly column, to the CSV the dashboard reads.
+The detector state and both CSV positions are kept in state.npz.
+
+Usage:
+    python anomaly.py emissions.csv daily_nox_emissions.csv state.npz [emissions_store]
+"""
+import os
+import sys
+import numpy as np
+import pandas as pd
+from emissions_store import EmissionsStore, read_appended_rows
+
+
+class EwmaAnomalyDetector:
+    """
+    Exponentially weighted z-score detector over a (sites,) vector per day.
+
+    The state is the EWMA mean and variance of every site, so a new day is
+    flagged and absorbed in O(sites) without revisiting past days. A value is
+    an anomaly when it is more than threshold EW standard deviations from the
+    site baseline, once the site has seen warmup days. Anomalous values are
+    clipped to the threshold before updating the baseline, so a spike does not
+    mask the next one. NaN values are neither flagged nor absorbed.
+
+    last_date holds, per site, the last date a value of the site was absorbed,
+    so a site whose data arrives late is continued from its own last day.
+    """
+
+    def __init__(self, sites, alpha=0.05, threshold=3.0, warmup=14):
+        self.sites = list(sites)
+        self.alpha = alpha
+        self.threshold = threshold
+        self.warmup = warmup
+        self.last_date = np.full(len(self.sites), 'NaT', dtype='datetime64[D]')
+        self.mean = np.zeros(len(self.sites))
+        self.var = np.zeros(len(self.sites))
+        self.count = np.zeros(len(self.sites), dtype=np.int64)
+
+    def add_sites(self, sites):
+        """Start tracking new sites, with an empty baseline."""
+        new = [site for site in sites if site not in set(self.sites)]
+        self.sites.extend(new)
+        self.mean = np.concatenate([self.mean, np.zeros(len(new))])
+        self.var = np.concatenate([self.var, np.zeros(len(new))])
+        self.count = np.concatenate([self.count, np.zeros(len(new), dtype=np.int64)])
+        self.last_date = np.concatenate([self.last_date, np.full(len(new), 'NaT', dtype='datetime64[D]')])
+
+    def update(self, values):
+        """
+        Flag one day of all sites and absorb it into the baselines.
+
+        Args:
+        values (np.ndarray): (sites,) values of the day, in the order of self.sites
+
+        Returns:
+        np.ndarray: (sites,) boolean anomaly flags
+        """
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        std = np.sqrt(self.var)
+        deviation = values - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            z = np.where(std > 0, deviation / std, 0.0)
+        flags = valid & (self.count >= self.warmup) & (np.abs(z) > self.threshold)
+
+        # Winsorized update; the first value of a site initializes its mean
+        limit = np.where((self.count >= self.warmup) & (std > 0), self.threshold * std, np.inf)
+        deviation = np.clip(np.where(valid, deviation, 0), -limit, limit)
+        first = valid & (self.count == 0)
+        step = np.where(first, 1.0, np.where(valid, self.alpha, 0.0))
+        self.mean += step * deviation
+        self.var = np.where(valid & ~first, (1 - self.alpha) * (self.var + self.alpha * deviation ** 2), self.var)
+        self.count += valid
+        return flags
+
+    def run(self, values, dates=None):
+        """
+        Flag a (sites, days) array day by day, continuing from the current state.
+
+        With dates, the last date of each site advances to its last non-NaN day.
+
+        Returns:
+        np.ndarray: (sites, days) boolean anomaly flags
+        """
+        values = np.asarray(values, dtype=np.float64)
+        flags = np.empty(values.shape, dtype=bool)
+        for day in range(values.shape[1]):
+            flags[:, day] = self.update(values[:, day])
+        if dates is not None and len(dates):
+            valid = ~np.isnan(values)
+            last_valid = valid.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+            dates = np.asarray(dates).astype('datetime64[D]')
+            self.last_date = np.where(valid.any(axis=1), dates[last_valid], self.last_date)
+        return flags
+
+    def save(self, path, **extra):
+        """Save the state, with extra arrays (e.g. the read positions of anomaly.py) stored alongside."""
+        np.savez(path, sites=np.array(self.sites, dtype=str), mean=self.mean, var=self.var, count=self.count,
+                 params=np.array([self.alpha, self.threshold, self.warmup]), last_date=self.last_date, **extra)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as state:
+            alpha, threshold, warmup = state['params']
+            detector = cls(state['sites'].tolist(), alpha, threshold, int(warmup))
+            detector.mean, detector.var, detector.count = state['mean'], state['var'], state['count']
+            detector.last_date = state['last_date']
+        return detector
+
+
+def _sites(df, site_column='Site'):
+    """Site of every row, 'default' for tables without a site column."""
+    return df[site_column].astype(str) if site_column in df else pd.Series('default', index=df.index)
+
+
+def _new_days(df, sites, detector):
+    """Rows whose date follows the last date of their site in the detector."""
+    last_date = sites.map(pd.Series(pd.to_datetime(detector.last_date), index=detector.sites))
+    return df['Date'].notna() & (last_date.isna() | (df['Date'] > last_date))
+
+
+def flag_anomalies(df, detector=None, value_column='NOx_Emissions_kg_per_day', site_column='Site'):
+    """
+    Set the Anomaly column of a daily emissions table, for all sites at once.
+
+    Only the days of each site after its last date in the detector are
+    flagged, continuing from the detector state; earlier rows keep their
+    Anomaly value. Tables without a site column are treated as a single site.
+
+    Args:
+    df (pd.DataFrame): Daily emissions with Date and value columns
+    detector (EwmaAnomalyDetector): State to continue from, a new one by default
+
+    Returns:
+    tuple: DataFrame with the Anomaly column, updated detector
+    """
+    df = df.copy()
+    df['Date'] = pd.to_datetime(df['Date'])
+    sites = _sites(df, site_column)
+    if detector is None:
+        detector = EwmaAnomalyDetector(sorted(sites.unique()))
+    detector.add_sites(sorted(sites.unique()))
+    if 'Anomaly' not in df:
+        df['Anomaly'] = False
+
+    new = _new_days(df, sites, detector)
+    if not new.any():
+        return df, detector
+
+    # (sites, days) array of the new days, missing site-days as NaN
+    table = pd.DataFrame({'site': sites[new], 'date': df.loc[new, 'Date'], 'value': df.loc[new, value_column]})
+    matrix = table.groupby(['site', 'date'])['value'].sum(min_count=1).unstack('date').reindex(detector.sites)
+    flags = detector.run(matrix.to_numpy(), matrix.columns.to_numpy())
+
+    site_index = pd.Index(detector.sites).get_indexer(table['site'])
+    date_index = matrix.columns.get_indexer(table['date'])
+    df.loc[new, 'Anomaly'] = flags[site_index, date_index]
+    return df, detector
+
+
+def publish_days(store, df, site_column='Site'):
+    """
+    Pass flagged days to an EmissionsStore, one site at a time.
+
+    Tables without a site column are stored as the 'default' site, which the dashboard reads.
+    """
+    for site, days in df.groupby(_sites(df, site_column)):
+        store.add_days(site, days['Date'].to_numpy(), days['NOx_Emissions_kg_per_day'].to_numpy(), days['Anomaly'])
+
+
+def append_rows(csv_path, df, size=None):
+    """
+    Append rows to a CSV, with a header when it is empty, and return its new size.
+
+    With size, the CSV is first cut back to it, the size reached by the previous
+    run, so the rows of a run interrupted before saving its state are not repeated.
+    """
+    with open(csv_path, 'a+b') as f:
+        if size is not None and f.seek(0, os.SEEK_END) > size:
+            f.truncate(size)
+        df.to_csv(f, header=f.seek(0, os.SEEK_END) == 0, index=False, date_format='%Y-%m-%d')
+        return f.tell()
+
+
+def _load_state(state_path):
+    """Detector, input CSV position and output CSV size of the previous run; a first run rewrites the output."""
+    if not os.path.exists(state_path):
+        return None, None, 0
+    with np.load(state_path) as state:
+        position = ({'header': str(state['csv_header']), 'offset': int(state['csv_offset'])}
+                    if 'csv_header' in state else None)
+        output_size = int(state['output_size']) if 'output_size' in state else None
+    return EwmaAnomalyDetector.load(state_path), position, output_size
+
+
+def main(csv_path, output_path, state_path, store_path=None):
+    detector, position, output_size = _load_state(state_path)
+    df, position = read_appended_rows(csv_path, position, parse_dates=['Date'])
+    if df is not None:
+        new = _new_days(df, _sites(df), detector) if detector is not None else df['Date'].notna()
+        df, detector = flag_anomalies(df, detector)
+        df = df[new]
+        output_size = append_rows(output_path, df, output_size)
+        if store_path is not None:
+            # Only the days flagged by this run reach the store, so it never rereads its history
+            publish_days(EmissionsStore(store_path), df)
+        print(f"Flagged {int(df['Anomaly'].sum())} anomalous days of {len(df)} new days")
+    if detector is not None:
+        positions = {'csv_header': position['header'], 'csv_offset': position['offset']}
+        if output_size is not None:
+            positions['output_size'] = output_size
+        detector.save(state_path, **positions)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (4, 5):
+        sys.exit(__doc__)
+    main(*sys.argv[1:])
@@ -0,0 +1,293 @@
+"""
+Local HTTP API serving site emission estimates from an on-disk datacube.
+
+Usage:
+    python api.py datacube_dir --lats latitudes.npy --lons longitudes.npy [--port 8080]
+
+    POST /emissions
+    {"site": {"type": "Point", "coordinates": [lon, lat]}, "start": "2023-01-01", "end": "2023-12-31",
+     "params": {"threshold": 0.5, "match_radius": 5}}
+
+The site is any GeoJSON geometry in longitude/latitude. The response lists the
+sources found around the site over the date range, as the rows of the emissions
+report, and their total emission rate. Add "format": "csv" for the report as CSV.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+import geopandas as gpd
+import numpy as np
+import shapely
+from datacube import Datacube
+from facilities import process_facilities
+from load_rasters import polygon_hash
+
+# Detection parameters a request may override, with their defaults
+DEFAULT_PARAMS = {'threshold': 0.5, 'match_radius': 5, 'half_window': 10, 'min_distance': 10}
+
+MAX_BODY_BYTES = 1 << 20
+
+
+class RequestError(ValueError):
+    """A request the client must fix, answered with 400; any other failure is a 500."""
+
+
+@functools.lru_cache(maxsize=4)
+def _load_grid(lats_path, lons_path):
+    return np.load(lats_path), np.load(lons_path)
+
+
+def estimate_site_emissions(datacube_dir, lats_path, lons_path, site_wkb, start, end, params):
+    """
+    Emission estimates of the sources around one site over a date range.
+
+    Only the divergence window around the site is read from the memory-mapped
+    datacube and averaged over the days in [start, end]; peaks are then fitted
+    and quantified as in the facilities report. Runs in a worker process.
+
+    Returns:
+    dict: Number of days, report rows (Latitude, Longitude, Emission Rate) and total rate
+    """
+    lats, lons = _load_grid(lats_path, lons_path)
+    cube = Datacube(datacube_dir)
+    days = cube.date_slice(start, end)
+    if days.stop <= days.start:
+        raise RequestError(f"No datacube days between {start} and {end}")
+
+    site = gpd.GeoDataFrame({'Facility': ['site']}, geometry=[shapely.from_wkb(site_wkb)], crs='EPSG:4326')
+    report = process_facilities(cube.array('divergence')[days], site.set_index('Facility'), lats, lons, **params)
+    report = report[['Latitude', 'Longitude', 'Emission Rate']]
+    return {'days': days.stop - days.start, 'report': report.to_dict(orient='records'),
+            'total_emission_rate': float(report['Emission Rate'].sum())}
+
+
+class ResultCache:
+    """
+    LRU cache of encoded responses, bounded by their total size in bytes.
+
+    Concurrent requests for a key being computed wait for the same result
+    instead of starting another computation.
+    """
+
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size -= len(self._entries.pop(key))
+        self._entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    async def get_or_compute(self, key, compute):
+        """
+        Cached value of key, else the result of awaiting compute().
+
+        Returns:
+        tuple: value, whether it was served from the cache
+        """
+        value = self.get(key)
+        if value is not None:
+            return value, True
+        if key in self._pending:
+            return await asyncio.shield(self._pending[key]), True
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            value = await compute()
+        except BaseException as error:
+            future.set_exception(error)
+            # Waiters re-raise it; mark it retrieved so it is not reported as unhandled
+            future.exception()
+            raise
+        finally:
+            del self._pending[key]
+        future.set_result(value)
+        self.put(key, value)
+        return value, False
+
+
+class EmissionsService:
+    """Request handling of the API, with CPU-bound estimates run in a process pool."""
+
+    def __init__(self, datacube_dir, lats_path, lons_path, workers=None, cache_bytes=64 << 20):
+        self.datacube_dir = datacube_dir
+        self.lats_path = lats_path
+        self.lons_path = lons_path
+        self.cache = ResultCache(cache_bytes)
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    def data_version(self):
+        """Modification time of the divergence variable, so a recomputed datacube is not served stale."""
+        return os.stat(Datacube(self.datacube_dir).variable_path('divergence')).st_mtime_ns
+
+    def parse_request(self, body):
+        """Validated (site geometry, start, end, params, format) of a POST /emissions body."""
+        try:
+            query = json.loads(body)
+            site = shapely.geometry.shape(query['site'])
+            start, end = str(np.datetime64(query['start'], 'D')), str(np.datetime64(query['end'], 'D'))
+        except (KeyError, TypeError, ValueError, AttributeError, shapely.errors.GEOSException) as error:
+            raise RequestError(f"Invalid request: {error}") from None
+        if site.is_empty or not site.is_valid:
+            raise RequestError("Invalid request: the site geometry is empty or invalid")
+        overrides = query.get('params') or {}
+        if not isinstance(overrides, dict):
+            raise RequestError("Invalid request: params must be an object")
+        unknown = set(overrides) - set(DEFAULT_PARAMS)
+        if unknown:
+            raise RequestError(f"Invalid request: unknown parameters {sorted(unknown)}")
+        try:
+            params = {name: type(default)(overrides.get(name, default)) for name, default in DEFAULT_PARAMS.items()}
+        except (TypeError, ValueError) as error:
+            raise RequestError(f"Invalid request: {error}") from None
+        output_format = query.get('format', 'json')
+        if output_format not in ('json', 'csv'):
+            raise RequestError(f"Invalid request: unknown format {output_format}")
+        return site, start, end, params, output_format
+
+    async def emissions(self, body):
+        """Encoded response to a POST /emissions body, as (content type, bytes, cached)."""
+        site, start, end, params, output_format = self.parse_request(body)
+        key = (polygon_hash(site), start, end, tuple(sorted(params.items())), output_format, self.data_version())
+
+        async def compute():
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.executor, estimate_site_emissions, self.datacube_dir, self.lats_path, self.lons_path,
+                shapely.to_wkb(site), start, end, params)
+            if output_format == 'csv':
+                lines = ['Emission Rate,Latitude,Longitude']
+                lines += [f"{row['Emission Rate']},{row['Latitude']},{row['Longitude']}" for row in result['report']]
+                return ('\n'.join(lines) + '\n').encode()
+            return json.dumps({'site': shapely.geometry.mapping(site), 'start': start, 'end': end,
+                               'params': params, **result}).encode()
+
+        content, cached = await self.cache.get_or_compute(key, compute)
+        return ('text/csv' if output_format == 'csv' else 'application/json'), content, cached
+
+    async def handle(self, method, path, body):
+        """Route one request, returning (status, content type, bytes, extra headers)."""
+        if path == '/health':
+            content = json.dumps({'status': 'ok', 'cached': len(self.cache), 'cache_bytes': self.cache.size})
+            return HTTPStatus.OK, 'application/json', content.encode(), {}
+        if path != '/emissions':
+            return _error(HTTPStatus.NOT_FOUND, f"Unknown path: {path}")
+        if method != 'POST':
+            return _error(HTTPStatus.METHOD_NOT_ALLOWED, "Use POST /emissions")
+        try:
+            content_type, content, cached = await self.emissions(body)
+        except RequestError as error:
+            return _error(HTTPStatus.BAD_REQUEST, str(error))
+        return HTTPStatus.OK, content_type, content, {'X-Cache': 'hit' if cached else 'miss'}
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def _error(status, message):
+    return status, 'application/json', json.dumps({'error': message}).encode(), {}
+
+
+async def _read_request(reader):
+    """(method, path, body, keep-alive) of one HTTP/1.1 request, None at end of stream."""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_BYTES:
+        raise ValueError(f"Request body over {MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), target.split('?', 1)[0], body, headers.get('connection', '').lower() != 'close'
+
+
+def make_handler(service):
+    """asyncio.start_server callback serving keep-alive connections with the service."""
+
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except ValueError as error:
+                    request, keep_alive = None, False
+                    status, content_type, content, headers = _error(HTTPStatus.BAD_REQUEST, str(error))
+                else:
+                    if request is None:
+                        break
+                    method, path, body, keep_alive = request
+                    try:
+                        status, content_type, content, headers = await service.handle(method, path, body)
+                    except Exception as error:
+                        status, content_type, content, headers = _error(HTTPStatus.INTERNAL_SERVER_ERROR,
+                                                                        f"{type(error).__name__}: {error}")
+                head = [f'HTTP/1.1 {status.value} {status.phrase}', f'Content-Type: {content_type}',
+                        f'Content-Length: {len(content)}', f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+                head += [f'{name}: {value}' for name, value in headers.items()]
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return handle_connection
+
+
+async def serve(service, host='127.0.0.1', port=8080):
+    server = await asyncio.start_server(make_handler(service), host, port)
+    print(f"Serving emissions of {service.datacube_dir} on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('datacube', help='Datacube with a divergence variable')
+    parser.add_argument('--lats', required=True, help='Pixel centre latitudes of the grid (.npy)')
+    parser.add_argument('--lons', required=True, help='Pixel centre longitudes of the grid (.npy)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes computing estimates')
+    parser.add_argument('--cache-mb', type=float, default=64, help='Size bound of the result cache')
+    args = parser.parse_args()
+
+    service = EmissionsService(args.datacube, args.lats, args.lons, args.workers, int(args.cache_mb * (1 << 20)))
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        sys.exit(0)
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.ticker import MaxNLocator
+from datacube import Datacube
+from instrumentation import stage
+from manifest import StageManifest, hash_array
+
+# Panels and figure size of each per-date plot, named after its output file prefix
+PLOT_LAYOUTS = {
+    'wind_map': (('wind',), (12, 8)),
+    'no2_map': (('no2',), (12, 8)),
+    'no2_and_wind_map': (('no2', 'wind'), (24, 8)),
+    'nox_emission_analysis': (('no2', 'wind', 'divergence'), (24, 8)),
+}
+
+PANEL_TITLES = {
+    'no2': 'NO2 Concentration',
+    'wind': 'Wind Direction and Speed',
+    'divergence': 'Flux Divergence',
+}
+
+# Manifest kept next to the PNGs when render_dates is given neither a manifest nor input files
+RENDER_MANIFEST = 'render_manifest.json'
+
+# Datacube variables each panel reads
+PANEL_VARIABLES = {
+    'no2': ('no2',),
+    'wind': ('u_wind', 'v_wind'),
+    'divergence': ('divergence',),
+}
+
+
+def quiver_step(shape, arrows_per_axis):
+    """Subsampling step that keeps at most arrows_per_axis arrows along the longest axis."""
+    return max(1, int(np.ceil(max(shape) / arrows_per_axis)))
+
+
+def is_up_to_date(output_file, input_files):
+    """True when output_file exists and is newer than every input file."""
+    if not os.path.exists(output_file):
+        return False
+    output_mtime = os.path.getmtime(output_file)
+    return all(os.path.getmtime(path) <= output_mtime for path in input_files)
+
+
+def value_range(data):
+    """(min, max) of the finite values of a map, or (0, 1) like export.color_scale when it has none."""
+    values = np.asarray(data)
+    values = values[np.isfinite(values)]
+    if not values.size:
+        return 0.0, 1.0
+    vmin, vmax = float(values.min()), float(values.max())
+    return vmin, (vmax if vmax > vmin else vmin + 1.0)
+
+
+class MapLayout:
+    """
+    A per-date figure whose layout, colorbars and quiver are created once.
+
+    Rendering a date only updates the image data, colour limits, quiver vectors
+    and titles and refits the margins before drawing with the Agg canvas, instead
+    of rebuilding the figure.
+    """
+
+    def __init__(self, name, shape, arrows_per_axis=50, dpi=300):
+        panels, figsize = PLOT_LAYOUTS[name]
+        self.name = name
+        self.panels = panels
+        self.dpi = dpi
+        self.step = quiver_step(shape, arrows_per_axis)
+
+        self.figure = Figure(figsize=figsize)
+        FigureCanvasAgg(self.figure)
+        axes = self.figure.subplots(1, len(panels), squeeze=False)[0]
+        self.artists = {}
+        self.titles = {}
+
+        for ax, panel in zip(axes, panels):
+            if panel == 'wind':
+                y, x = np.mgrid[:shape[0]:self.step, :shape[1]:self.step]
+                zeros = np.zeros(x.shape)
+                quiver = ax.quiver(x, y, zeros, zeros, scale=3, scale_units='inches')
+                ax.quiverkey(quiver, X=0.9, Y=1.05, U=10, label='10 m/s', labelpos='E')
+                # The autoscaled limits of a quiver over every pixel, with matplotlib's default 5% margins
+                ax.set_xlim(-0.05 * (shape[1] - 1), 1.05 * (shape[1] - 1))
+                ax.set_ylim(-0.05 * (shape[0] - 1), 1.05 * (shape[0] - 1))
+                self.artists[panel] = quiver
+            else:
+                cmap, label = ('YlOrRd', 'NO2 Concentration') if panel == 'no2' else ('RdBu_r', 'Divergence')
+                image = ax.imshow(np.zeros(shape), cmap=cmap, interpolation='nearest')
+                self.figure.colorbar(image, ax=ax, label=label)
+                self.artists[panel] = image
+
+            ax.set_xlabel('X coordinate')
+            ax.set_ylabel('Y coordinate')
+            ax.invert_yaxis()
+            ax.xaxis.set_major_locator(MaxNLocator(integer=True))
+            ax.yaxis.set_major_locator(MaxNLocator(integer=True))
+            # Placeholder of the final title length, so tight_layout reserves its space
+            self.titles[panel] = ax.set_title(f'{PANEL_TITLES[panel]} - YYYY-MM-DD')
+
+        self.figure.tight_layout()
+
+    def render(self, date, output_dir, no2=None, u_wind=None, v_wind=None, divergence=None):
+        """Update the artists with one date of data and save the PNG."""
+        for panel in self.panels:
+            if panel == 'wind':
+                self.artists[panel].set_UVC(u_wind[::self.step, ::self.step], v_wind[::self.step, ::self.step])
+            else:
+                data = no2 if panel == 'no2' else divergence
+                self.artists[panel].set_data(data)
+                self.artists[panel].set_clim(*value_range(data))
+            self.titles[panel].set_text(f'{PANEL_TITLES[panel]} - {date}')
+
+        output_file = os.path.join(output_dir, f'{self.name}_{date}.png')
+        # Colorbar tick labels change with the data, so the margins are fitted again, as the per-date plots do
+        self.figure.tight_layout()
+        self.figure.savefig(output_file, dpi=self.dpi, bbox_inches='tight')
+        return output_file
+
+
+def _render_chunk(datacube_dir, output_dir, jobs, arrows_per_axis, dpi):
+    """Render a list of (plot name, time index) jobs in one process, reusing one layout per plot."""
+    cube = Datacube(datacube_dir)
+    layouts = {}
+    rendered = []
+    for name, index in jobs:
+        if name not in layouts:
+            layouts[name] = MapLayout(name, cube.shape, arrows_per_axis, dpi)
+        layout = layouts[name]
+        date = str(cube.dates[index])
+        with stage('render', date=date, plot=name):
+            data = {variable: cube.array(variable)[index]
+                    for panel in layout.panels for variable in PANEL_VARIABLES[panel]}
+            rendered.append(layout.render(date, output_dir, **data))
+    return rendered
+
+
+def render_dates(datacube_dir, output_dir, plots, start=None, end=None, workers=1,
+                 arrows_per_axis=50, dpi=300, input_files=None, force=False, manifest=None,
+                 input_fingerprints=None):
+    """
+    Render per-date plots from a datacube, reusing figure layouts.
+
+    Args:
+    datacube_dir (str): Datacube holding the plotted variables
+    output_dir (str): Directory of the PNGs
+    plots (tuple): Names from PLOT_LAYOUTS to render for each date
+    start, end: Optional date range, as in Datacube.read
+    workers (int): Number of rendering processes
+    arrows_per_axis (int): Target quiver density along the longest axis
+    dpi (int): Resolution of the PNGs
+    input_files (dict): Optional mapping of 'YYYY-MM-DD' to the input files of that date.
+        Without a manifest, a PNG is then up to date when it is newer than these files.
+    force (bool): Render even if the PNG is up to date
+    manifest (StageManifest): Optional manifest. A PNG is up to date if its input
+        fingerprint and settings match the 'plot' stage entry. Rendered plots are
+        recorded; the caller saves it. Without a manifest or input files, one is kept
+        in output_dir/render_manifest.json, so a date is only rendered again when its
+        own data changed, not whenever another date of the datacube was written.
+    input_fingerprints (dict): Optional mapping of 'YYYY-MM-DD' to a fingerprint of
+        the date's inputs, e.g. from an upstream stage. Defaults to hashing the
+        plotted datacube arrays.
+
+    Returns:
+    list: Paths of the rendered PNGs
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    cube = Datacube(datacube_dir)
+    selection = cube.date_slice(start, end)
+    own_manifest = manifest is None and input_files is None
+    if own_manifest:
+        manifest = StageManifest(os.path.join(output_dir, RENDER_MANIFEST))
+
+    jobs = []
+    job_fingerprints = []
+    for index in range(selection.start, selection.stop):
+        date = str(cube.dates[index])
+        day_hashes = {}
+        for name in plots:
+            variables = [variable for panel in PLOT_LAYOUTS[name][0] for variable in PANEL_VARIABLES[panel]]
+            output_file = os.path.join(output_dir, f'{name}_{date}.png')
+            if manifest is not None:
+                input_fingerprint = (input_fingerprints or {}).get(date)
+                if not input_fingerprint:
+                    for variable in variables:
+                        if variable not in day_hashes:
+                            day_hashes[variable] = hash_array(cube.array(variable)[index])
+                    input_fingerprint = manifest.fingerprint([day_hashes[variable] for variable in variables])
+                fingerprint = manifest.fingerprint([input_fingerprint],
+                                                   {'dpi': dpi, 'arrows_per_axis': arrows_per_axis})
+                up_to_date = manifest.is_current('plot', f'{name}_{date}', fingerprint)
+            else:
+                fingerprint = None
+                up_to_date = date in input_files and is_up_to_date(output_file, input_files[date])
+            if force or not up_to_date:
+                jobs.append((name, index))
+                job_fingerprints.append(fingerprint)
+
+    if not jobs:
+        return []
+
+    # Contiguous chunks keep one layout per plot and process busy on consecutive dates
+    chunk_size = int(np.ceil(len(jobs) / max(1, workers)))
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    n_chunks = len(chunks)
+    args = ([datacube_dir] * n_chunks, [output_dir] * n_chunks, chunks,
+            [arrows_per_axis] * n_chunks, [dpi] * n_chunks)
+
+    rendered = []
+    if n_chunks > 1:
+        with ProcessPoolExecutor(max_workers=n_chunks) as pool:
+            for files in pool.map(_render_chunk, *args):
+                rendered.extend(files)
+    else:
+        for files in map(_render_chunk, *args):
+            rendered.extend(files)
+
+    if manifest is not None:
+        for (name, index), fingerprint, output_file in zip(jobs, job_fingerprints, rendered):
+            manifest.record('plot', f'{name}_{cube.dates[index]}', fingerprint, [output_file])
+        if own_manifest:
+            manifest.save()
+    return rendered
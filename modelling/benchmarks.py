@@ -0,0 +1,431 @@
+"""
+Benchmarks of the hot paths of the divergence pipeline.
+
+Usage:
+    python benchmarks.py run results.json [--quick] [--large] [--filter NAME] [--verbose]
+    python benchmarks.py compare baseline.json results.json [--threshold 1.2]
+
+Cases whose NO2 and wind stacks exceed MAX_STACK_BYTES, e.g. 3 x 100 x 1000 x 1000
+float64 (2.4 GB) in the full grid, only run with --large.
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+from scipy import optimize
+import model
+import plotting
+import raster_simulated
+
+BENCHMARKS = []
+
+FULL_GRID = {'size': [100, 500, 1000], 'days': [10, 100], 'peaks': [5, 50]}
+QUICK_GRID = {'size': [100], 'days': [5], 'peaks': [5]}
+
+# Largest NO2 + wind stacks of a case run without --large
+MAX_STACK_BYTES = 1 << 30
+
+
+def benchmark(*params):
+    """Register a benchmark parametrized by the named entries of the grid (size, days, peaks)."""
+    def register(func):
+        BENCHMARKS.append((func.__name__, func, params))
+        return func
+    return register
+
+
+def _scenario(size, days, peaks, seed=0):
+    """Synthetic (T, H, W) NO2 and wind stacks with known sources."""
+    dates = np.arange(np.datetime64('2023-01-01'), np.datetime64('2023-01-01') + days)
+    positions, rates = raster_simulated.make_point_sources(peaks, (size, size), seed=seed)
+    days_data = list(raster_simulated.iter_plume_scenario((size, size), dates, positions, rates,
+                                                          seed=seed, dtype=np.float64))
+    no2, u_wind, v_wind = (np.stack([day[i] for day in days_data]) for i in (1, 2, 3))
+    return dates, no2, u_wind, v_wind
+
+
+def _divergence_stack(no2, u_wind, v_wind):
+    return np.stack([model.calculate_divergence(*model.calculate_flux(*day)) for day in zip(no2, u_wind, v_wind)])
+
+
+def _stack_bytes(case):
+    """Bytes of the float64 NO2, U and V stacks a case builds."""
+    return 3 * 8 * case.get('days', 1) * case.get('size', 1) ** 2
+
+
+# Baseline implementations the pipeline replaced, kept as references for the benchmarks of the new paths
+
+def baseline_plot_data(no2, u_wind, v_wind, divergence, date, output_dir):
+    """Create and save a plot of NO2, wind, and divergence data, building the figure for every date."""
+    fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(24, 8))
+
+    # Plot NO2 data
+    im1 = ax1.imshow(no2, cmap='YlOrRd', interpolation='nearest')
+    plt.colorbar(im1, ax=ax1, label='NO2 Concentration')
+    ax1.set_title(f'NO2 Concentration - {date}')
+    ax1.set_xlabel('X coordinate')
+    ax1.set_ylabel('Y coordinate')
+    ax1.invert_yaxis()
+
+    # Plot wind data
+    Y, X = np.mgrid[:u_wind.shape[0], :u_wind.shape[1]]
+    q = ax2.quiver(X, Y, u_wind, v_wind, scale=3, scale_units='inches')
+    ax2.quiverkey(q, X=0.9, Y=1.05, U=10, label='10 m/s', labelpos='E')
+    ax2.set_title(f'Wind Direction and Speed - {date}')
+    ax2.set_xlabel('X coordinate')
+    ax2.set_ylabel('Y coordinate')
+    ax2.invert_yaxis()
+
+    # Plot divergence data
+    im3 = ax3.imshow(divergence, cmap='RdBu_r', interpolation='nearest')
+    plt.colorbar(im3, ax=ax3, label='Divergence')
+    ax3.set_title(f'Flux Divergence - {date}')
+    ax3.set_xlabel('X coordinate')
+    ax3.set_ylabel('Y coordinate')
+    ax3.invert_yaxis()
+
+    # Set integer ticks for all plots
+    for ax in [ax1, ax2, ax3]:
+        ax.xaxis.set_major_locator(plt.MaxNLocator(integer=True))
+        ax.yaxis.set_major_locator(plt.MaxNLocator(integer=True))
+
+    # Adjust layout and save
+    plt.tight_layout()
+    output_file = os.path.join(output_dir, f'nox_emission_analysis_{date}.png')
+    plt.savefig(output_file, dpi=300, bbox_inches='tight')
+    plt.close()
+
+
+def baseline_load_numpy_arrays(directory):
+    """
+    Load all NumPy arrays from .npy files in the specified directory.
+
+    Args:
+    directory (str): Path to the directory containing .npy files
+
+    Returns:
+    tuple: List of numpy arrays, List of dates
+    """
+    npy_files = sorted([f for f in os.listdir(directory) if f.endswith('.npy')])
+    data_list = []
+    date_list = []
+
+    for file in npy_files:
+        file_path = os.path.join(directory, file)
+        array = np.load(file_path)
+
+        # Extract date from filename (assuming format 'data_YYYY-MM-DD.npy')
+        date_str = file.split('_')[-1].split('.')[0]
+        date = datetime.strptime(date_str, '%Y-%m-%d').date()
+
+        data_list.append(array)
+        date_list.append(date)
+
+    return data_list, date_list
+
+
+def baseline_temporal_average(data_list):
+    """Calculate temporal average of a list of arrays."""
+    return np.mean(data_list, axis=0)
+
+
+def baseline_fit_gaussian_2d(data):
+    """Fit a 2D Gaussian to the data."""
+    height, width = data.shape
+    x, y = np.meshgrid(np.arange(width), np.arange(height))
+    xy = np.vstack((x.ravel(), y.ravel()))
+
+    popt, _ = optimize.curve_fit(model.gaussian_2d, xy, data.ravel(), p0=model.initial_gaussian_guess(data))
+    return popt
+
+
+def baseline_detect_and_fit_peaks(divergence_map, threshold=0.5, max_peaks=10):
+    """Detect peaks in the divergence map and fit Gaussians."""
+    peaks = []
+    remaining_map = divergence_map.copy()
+
+    for _ in range(max_peaks):
+        if remaining_map.max() < threshold:
+            break
+
+        peak_pos = np.unravel_index(remaining_map.argmax(), remaining_map.shape)
+        peak_region = remaining_map[max(0, peak_pos[0] - 10):peak_pos[0] + 11,
+                      max(0, peak_pos[1] - 10):peak_pos[1] + 11]
+
+        try:
+            popt = baseline_fit_gaussian_2d(peak_region)
+            peaks.append((peak_pos, popt))
+
+            # Remove fitted peak from the map
+            y, x = np.ogrid[-peak_pos[0]:divergence_map.shape[0] - peak_pos[0],
+                   -peak_pos[1]:divergence_map.shape[1] - peak_pos[1]]
+            remaining_map -= model.gaussian_2d((x, y), *popt)
+            remaining_map = np.maximum(remaining_map, 0)
+        except RuntimeError:
+            print(f"Failed to fit Gaussian at position {peak_pos}")
+
+    return peaks
+
+
+@benchmark('size', 'days')
+def load_numpy_arrays(workdir, size, days):
+    dates, no2, _, _ = _scenario(size, days, 1)
+    directory = os.path.join(workdir, 'npy')
+    os.makedirs(directory, exist_ok=True)
+    for date, array in zip(dates, no2):
+        np.save(os.path.join(directory, f'no2_{date}.npy'), array)
+    return lambda: baseline_load_numpy_arrays(directory)
+
+
+@benchmark('size', 'days')
+def load_no2_data(workdir, size, days):
+    dates = np.arange(np.datetime64('2023-01-01'), np.datetime64('2023-01-01') + days)
+    positions, rates = raster_simulated.make_point_sources(1, (size, size), seed=0)
+    raster_simulated.write_scenario_geotiffs(workdir, (size, size), dates, positions, rates, seed=0)
+    return lambda: plotting.load_no2_data(os.path.join(workdir, 'no2'))
+
+
+@benchmark('size', 'days')
+def load_wind_data(workdir, size, days):
+    dates = np.arange(np.datetime64('2023-01-01'), np.datetime64('2023-01-01') + days)
+    positions, rates = raster_simulated.make_point_sources(1, (size, size), seed=0)
+    raster_simulated.write_scenario_geotiffs(workdir, (size, size), dates, positions, rates, seed=0)
+    return lambda: plotting.load_wind_data(os.path.join(workdir, 'u_wind'), os.path.join(workdir, 'v_wind'))
+
+
+@benchmark('size')
+def interpolate_wind_to_no2_grid(workdir, size):
+    _, _, u_wind, v_wind = _scenario(max(2, size // 4), 1, 1)
+    return lambda: plotting.interpolate_wind_to_no2_grid(u_wind[0], v_wind[0], (size, size))
+
+
+@benchmark('size', 'days')
+def calculate_flux(workdir, size, days):
+    _, no2, u_wind, v_wind = _scenario(size, days, 1)
+    return lambda: [model.calculate_flux(*day) for day in zip(no2, u_wind, v_wind)]
+
+
+@benchmark('size', 'days')
+def calculate_divergence(workdir, size, days):
+    _, no2, u_wind, v_wind = _scenario(size, days, 1)
+    fluxes = [model.calculate_flux(*day) for day in zip(no2, u_wind, v_wind)]
+    return lambda: [model.calculate_divergence(flux_u, flux_v) for flux_u, flux_v in fluxes]
+
+
+@benchmark('size', 'days')
+def calculate_divergence_stack(workdir, size, days):
+    _, no2, u_wind, v_wind = _scenario(size, days, 1)
+    flux_u, flux_v = model.calculate_flux_stack(no2, u_wind, v_wind)
+    out = np.empty_like(flux_u)
+    scratch = np.empty_like(flux_u)
+    return lambda: model.calculate_divergence_stack(flux_u, flux_v, out=out, scratch=scratch)
+
+
+@benchmark('size', 'days')
+def compute_divergence_tiled(workdir, size, days):
+    dates = np.arange(np.datetime64('2023-01-01'), np.datetime64('2023-01-01') + days)
+    positions, rates = raster_simulated.make_point_sources(1, (size, size), seed=0)
+    datacube_dir = os.path.join(workdir, 'datacube')
+    raster_simulated.write_scenario_datacube(datacube_dir, (size, size), dates, positions, rates, seed=0,
+                                             dtype=np.float64)
+    return lambda: model.compute_divergence(datacube_dir, tile_shape=(256, 256))
+
+
+@benchmark('size', 'days')
+def temporal_average(workdir, size, days):
+    _, no2, u_wind, v_wind = _scenario(size, days, 1)
+    divergence_maps = list(_divergence_stack(no2, u_wind, v_wind))
+    return lambda: baseline_temporal_average(divergence_maps)
+
+
+def _gaussian_windows(peaks, seed=0):
+    """Noisy 21 x 21 windows of random Gaussians."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:21, :21]
+    return [model.gaussian_2d((x, y), rng.uniform(1, 3), *rng.uniform(8, 12, 2), *rng.uniform(1.5, 3, 2),
+                              rng.uniform(-1, 1), 0) + rng.normal(0, 0.02, (21, 21)) for _ in range(peaks)]
+
+
+@benchmark('peaks')
+def fit_gaussian_2d(workdir, peaks):
+    windows = _gaussian_windows(peaks)
+    return lambda: [baseline_fit_gaussian_2d(window) for window in windows]
+
+
+@benchmark('peaks')
+def fit_gaussian_2d_batch(workdir, peaks):
+    windows = np.stack(_gaussian_windows(peaks))
+    return lambda: model.fit_gaussian_2d_batch(windows)
+
+
+@benchmark('size', 'peaks')
+def detect_and_fit_peaks_local_maxima(workdir, size, peaks):
+    _, no2, u_wind, v_wind = _scenario(size, 5, peaks)
+    averaged = _divergence_stack(no2, u_wind, v_wind).mean(axis=0)
+    return lambda: model.detect_and_fit_peaks_local_maxima(averaged, max_peaks=peaks)
+
+
+@benchmark('size', 'peaks')
+def detect_and_fit_peaks(workdir, size, peaks):
+    _, no2, u_wind, v_wind = _scenario(size, 5, peaks)
+    averaged = _divergence_stack(no2, u_wind, v_wind).mean(axis=0)
+    return lambda: baseline_detect_and_fit_peaks(averaged, max_peaks=peaks)
+
+
+@benchmark('size')
+def plot_no2(workdir, size):
+    _, no2, _, _ = _scenario(size, 1, 1)
+    return lambda: plotting.plot_no2(no2[0], '2023-01-01', workdir)
+
+
+@benchmark('size')
+def plot_wind_arrows(workdir, size):
+    _, _, u_wind, v_wind = _scenario(size, 1, 1)
+    return lambda: plotting.plot_wind_arrows(u_wind[0], v_wind[0], '2023-01-01', workdir)
+
+
+@benchmark('size')
+def plot_no2_and_wind(workdir, size):
+    _, no2, u_wind, v_wind = _scenario(size, 1, 1)
+    return lambda: plotting.plot_no2_and_wind(no2[0], u_wind[0], v_wind[0], '2023-01-01', workdir)
+
+
+@benchmark('size')
+def plot_data(workdir, size):
+    _, no2, u_wind, v_wind = _scenario(size, 1, 1)
+    divergence = _divergence_stack(no2, u_wind, v_wind)[0]
+    return lambda: baseline_plot_data(no2[0], u_wind[0], v_wind[0], divergence, '2023-01-01', workdir)
+
+
+def measure(func, repeats):
+    """Best wall time over repeats, and peak traced memory of one run."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def run(output_path, grid, name_filter=None, repeats=3, large=False, verbose=False):
+    """
+    Run every registered benchmark over its parameter grid and write the results as JSON.
+
+    Cases with stacks larger than MAX_STACK_BYTES are skipped unless large is set.
+    Only the summary table is printed; with verbose, every case and the output of
+    the benchmarked code are printed as they run.
+    """
+    results, skipped = [], []
+    for name, setup, params in BENCHMARKS:
+        if name_filter and name_filter not in name:
+            continue
+        for values in itertools.product(*(grid[param] for param in params)):
+            case = dict(zip(params, values))
+            if not large and _stack_bytes(case) > MAX_STACK_BYTES:
+                skipped.append((name, case))
+                if verbose:
+                    print(f"{name} {case}: skipped, {_stack_bytes(case) / 2 ** 30:.1f} GiB of stacks needs --large")
+                continue
+            with tempfile.TemporaryDirectory() as workdir, \
+                    (contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())):
+                wall_time, peak_memory = measure(setup(workdir, **case), repeats)
+            results.append({'name': name, 'params': case, 'wall_time': wall_time, 'peak_memory': peak_memory})
+            if verbose:
+                print(f"{name} {case}: {wall_time:.4f} s, {peak_memory / 2 ** 20:.1f} MiB")
+
+    with open(output_path, 'w') as f:
+        json.dump({'created': datetime.now().isoformat(), 'python': platform.python_version(),
+                   'numpy': np.__version__, 'results': results}, f, indent=2)
+    print_summary(results, skipped)
+
+
+def print_summary(results, skipped=()):
+    """Print one row per case: wall time and peak memory, or why it was skipped."""
+    rows = [(result['name'], json.dumps(result['params']), f"{result['wall_time']:.4f}",
+             f"{result['peak_memory'] / 2 ** 20:.1f}") for result in results]
+    rows += [(name, json.dumps(case), 'skipped', 'needs --large') for name, case in skipped]
+    header = ('benchmark', 'params', 'time (s)', 'memory (MiB)')
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        print(f"{row[0]:<{widths[0]}}  {row[1]:<{widths[1]}}  {row[2]:>{widths[2]}}  {row[3]:>{widths[3]}}")
+
+
+def _case_key(result):
+    return result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(baseline_path, results_path, threshold=1.2):
+    """
+    Compare two result files and print the time and memory ratio of every common case.
+
+    Returns:
+    list: (name, params, metric, ratio) of the cases slower or larger than threshold x baseline
+    """
+    with open(baseline_path) as f:
+        baseline = {_case_key(result): result for result in json.load(f)['results']}
+    with open(results_path) as f:
+        current = {_case_key(result): result for result in json.load(f)['results']}
+
+    regressions = []
+    for key in sorted(baseline.keys() & current.keys()):
+        name, params = key
+        ratios = {metric: current[key][metric] / max(baseline[key][metric], 1e-12)
+                  for metric in ('wall_time', 'peak_memory')}
+        flag = ''
+        for metric, ratio in ratios.items():
+            if ratio > threshold:
+                regressions.append((name, params, metric, ratio))
+                flag = '  REGRESSION'
+        print(f"{name} {params}: time x{ratios['wall_time']:.2f}, memory x{ratios['peak_memory']:.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('output', help='JSON results file')
+    run_parser.add_argument('--quick', action='store_true', help='Smallest grid only')
+    run_parser.add_argument('--large', action='store_true',
+                            help='Also run cases whose stacks exceed MAX_STACK_BYTES')
+    run_parser.add_argument('--filter', help='Only benchmarks whose name contains this')
+    run_parser.add_argument('--repeats', type=int, default=3)
+    run_parser.add_argument('--verbose', action='store_true',
+                            help='Print every case and the output of the benchmarked code as it runs')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two results files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--threshold', type=float, default=1.2,
+                                help='Ratio above which a case counts as a regression')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args.output, QUICK_GRID if args.quick else FULL_GRID, args.filter, args.repeats, args.large,
+            args.verbose)
+    elif compare(args.baseline, args.results, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,171 @@
 import os
 import glob
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import rasterio
+from scipy import ndimage
+from instrumentation import enable_trace, stage
 
 
-def fill_top_row_and_save(input_dir, output_dir):
+def fill_nearest(data, gaps):
+    """Fill gaps with the value of the nearest valid pixel, in one distance-transform pass."""
+    indices = ndimage.distance_transform_edt(gaps, return_distances=False, return_indices=True)
+    return data[tuple(indices)]
+
+
+def fill_edges(data, gaps):
+    """
+    Fill gaps with the nearest valid pixel of the same column.
+
+    This extrapolates from the edge of the valid data, e.g. a missing top row is
+    copied from the first valid row below it. Columns without any valid pixel
+    fall back to fill_nearest.
+    """
+    height = data.shape[0]
+    rows = np.arange(height)[:, None]
+    above = np.maximum.accumulate(np.where(gaps, -1, rows), axis=0)
+    below = np.minimum.accumulate(np.where(gaps, height, rows)[::-1], axis=0)[::-1]
+
+    use_above = (above >= 0) & ((below >= height) | (rows - above <= below - rows))
+    source = np.where(use_above, above, below)
+    filled = np.take_along_axis(data, np.clip(source, 0, height - 1), axis=0)
+
+    empty_columns = source >= height
+    if empty_columns.any():
+        filled = np.where(empty_columns, fill_nearest(data, gaps), filled)
+    return filled
+
+
+def fill_gaps(data, method='edge'):
+    """
+    Fill every NaN pixel of a 2D raster.
+
+    Args:
+    data (np.ndarray): Raster with NaN gaps
+    method (str): 'edge' for column-wise edge extrapolation, 'nearest' for the nearest valid pixel
+
+    Returns:
+    np.ndarray: Filled raster, or the input itself if it has no gaps
+    """
+    gaps = np.isnan(data)
+    if not gaps.any():
+        return data
+    if gaps.all():
+        raise ValueError("Cannot fill a raster without any valid pixel")
+    if method == 'edge':
+        return fill_edges(data, gaps)
+    if method == 'nearest':
+        return fill_nearest(data, gaps)
+    raise ValueError(f"Unknown gap filling method: {method}")
+
+
+def fill_gaps_and_save(tif_file, output_dir, method='edge'):
+    """
+    Fill NaN gaps of one wind raster and save it in output_dir.
+
+    Rasters without gaps are hard-linked (or copied) rather than rewritten. Filled
+    rasters are written as tiled, compressed GeoTIFFs to a temporary file that is
+    then renamed, so an interrupted run never leaves a half-written raster.
+    """
+    output_file = os.path.join(output_dir, os.path.basename(tif_file))
+    with stage('fill_gaps', file=tif_file, method=method) as span:
+        filled = _fill_gaps_and_save(tif_file, output_file, method, span)
+    return output_file, filled
+
+
+def _is_copy_of(source, target):
+    """Whether target is a hard link to source, or a copy with the same size and modification time."""
+    if not os.path.exists(target):
+        return False
+    if os.path.samefile(source, target):
+        return True
+    source_stat, target_stat = os.stat(source), os.stat(target)
+    return source_stat.st_size == target_stat.st_size and source_stat.st_mtime_ns == target_stat.st_mtime_ns
+
+
+def _link_or_copy(tif_file, output_file):
+    """Hard-link (or copy) a raster to output_file, unless it is already there."""
+    if _is_copy_of(tif_file, output_file):
+        return
+    # Linked under a name the *.tif globs skip, then renamed over any output of an older input
+    tmp_file = f'{output_file}.tmp'
+    if os.path.lexists(tmp_file):
+        os.remove(tmp_file)
+    try:
+        os.link(tif_file, tmp_file)
+    except OSError:
+        shutil.copy2(tif_file, tmp_file)
+    os.replace(tmp_file, output_file)
+
+
+def _fill_gaps_and_save(tif_file, output_file, method, span):
+    with rasterio.open(tif_file) as src:
+        data = span.array('data', src.read(1))
+        profile = src.profile
+
+    gaps = int(np.isnan(data).sum())
+    span.set(gaps=gaps)
+    if not gaps:
+        _link_or_copy(tif_file, output_file)
+        return False
+
+    data = fill_gaps(data, method)
+    profile.update(driver='GTiff', count=1, dtype=data.dtype, tiled=True, blockxsize=256, blockysize=256,
+                   compress='deflate', predictor=3 if data.dtype.kind == 'f' else 2)
+
+    # Not a .tif, so an interrupted run never leaves a file that looks like a raster of some date
+    fd, tmp_file = tempfile.mkstemp(suffix='.tif.tmp', dir=os.path.dirname(output_file))
+    os.close(fd)
+    try:
+        with rasterio.open(tmp_file, 'w', **profile) as dst:
+            dst.write(data, 1)
+        os.replace(tmp_file, output_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    return True
+
+
+def fill_gaps_or_copy(tif_file, output_dir, method='edge'):
     """
-    Fill the top row of NaN values in wind rasters with values from the second row,
-    and save the modified rasters in a new folder.
+    Like fill_gaps_and_save, but a raster that cannot be filled is copied as is.
+
+    Returns:
+    tuple: output file, whether gaps were filled, the error of an unfillable raster or None
     """
-    # Create output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Get all .tif files in the input directory
-    tif_files = glob.glob(os.path.join(input_dir, '*.tif'))
-
-    for tif_file in tif_files:
-        with rasterio.open(tif_file) as src:
-            # Read the raster data
-            data = src.read(1)
-
-            # Check if the top row contains NaN values
-            if np.isnan(data[0]).any():
-                # Fill the top row with values from the second row
-                data[0] = data[1]
-
-            # Prepare the output file path
-            output_file = os.path.join(output_dir, os.path.basename(tif_file))
-
-            # Create a new raster file with the modified data
-            with rasterio.open(
-                    output_file,
-                    'w',
-                    driver='GTiff',
-                    height=src.height,
-                    width=src.width,
-                    count=1,
-                    dtype=data.dtype,
-                    crs=src.crs,
-                    transform=src.transform,
-            ) as dst:
-                dst.write(data, 1)
-
-        print(f"Processed and saved: {output_file}")
+    try:
+        return fill_gaps_and_save(tif_file, output_dir, method) + (None,)
+    except ValueError as error:
+        # Kept so the wind dates still match the NO2 dates; its NaN pixels are handled downstream
+        output_file = os.path.join(output_dir, os.path.basename(tif_file))
+        _link_or_copy(tif_file, output_file)
+        return output_file, False, error
+
+
+def fill_gaps_in_directories(directory_pairs, method='edge', workers=4):
+    """
+    Fill the gaps of every .tif in several (input_dir, output_dir) pairs concurrently.
+
+    All files of all directories share one thread pool, so the u_wind and v_wind
+    directories are processed at the same time. A raster without any valid pixel
+    is reported and copied as is rather than stopping the other files.
+    """
+    if method not in ('edge', 'nearest'):
+        raise ValueError(f"Unknown gap filling method: {method}")
+    tasks = []
+    for input_dir, output_dir in directory_pairs:
+        os.makedirs(output_dir, exist_ok=True)
+        tasks.extend((tif_file, output_dir) for tif_file in sorted(glob.glob(os.path.join(input_dir, '*.tif'))))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lambda task: fill_gaps_or_copy(*task, method=method), tasks)
+        for output_file, filled, error in results:
+            if error is not None:
+                print(f"Could not fill, copied as is ({error}): {output_file}")
+            else:
+                print(f"{'Filled and saved' if filled else 'No gaps, linked'}: {output_file}")
 
 
 def main():
@@ -52,16 +175,14 @@ def main():
     u_wind_output_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/wind_poland/u_wind_filled"
     v_wind_output_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/wind_poland/v_wind_filled"
 
-    # Process u_wind rasters
-    print("Processing u_wind rasters...")
-    fill_top_row_and_save(u_wind_input_dir, u_wind_output_dir)
+    enable_trace("/home/cedric/repos/cassini_nitrogen_estimation/data/trace.jsonl")
 
-    # Process v_wind rasters
-    print("Processing v_wind rasters...")
-    fill_top_row_and_save(v_wind_input_dir, v_wind_output_dir)
+    print("Processing u_wind and v_wind rasters...")
+    fill_gaps_in_directories([(u_wind_input_dir, u_wind_output_dir), (v_wind_input_dir, v_wind_output_dir)],
+                             workers=os.cpu_count())
 
     print("All rasters have been processed and saved.")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
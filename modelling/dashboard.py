@@ -1,18 +1,16 @@
-import pandas as pd
 import matplotlib.pyplot as plt
 from modelling.conf import DASHBOARD_DIR
+from modelling.emissions_store import CSRD_YEARLY_MAX, EmissionsStore
 
-# Load the CSV file
-df = pd.read_csv(DASHBOARD_DIR/'daily_nox_emissions.csv')
-df['Date'] = pd.to_datetime(df['Date'])
+# Daily emissions live in an append-only store fed by anomaly.py; only rows added to the CSV since the last refresh are read
+store = EmissionsStore(DASHBOARD_DIR/'emissions_store', yearly_limit=CSRD_YEARLY_MAX)
+csv_path = DASHBOARD_DIR/'daily_nox_emissions.csv'
+if csv_path.exists():
+    store.import_csv(csv_path, site='default')
 
-# Calculate yearly emissions
-df['Year'] = df['Date'].dt.year
-yearly_emissions = df.groupby('Year')['NOx_Emissions_kg_per_day'].sum().reset_index()
-yearly_emissions = yearly_emissions.rename(columns={'NOx_Emissions_kg_per_day': 'Yearly_NOx_Emissions_kg'})
-
-# Assume CSRD regulation defines a yearly maximum (you'll need to replace this with the actual value)
-CSRD_YEARLY_MAX = 1500000
+# Yearly emissions come from the incrementally maintained rollup, not from the daily rows
+yearly_rollup = store.yearly()
+yearly_emissions = yearly_rollup.groupby('Year')[['Yearly_NOx_Emissions_kg', 'Anomalies']].sum().reset_index()
 
 # Set up the plot style
 plt.style.use('ggplot')
@@ -26,7 +24,7 @@ plt.savefig(DASHBOARD_DIR/'nox_emissions_dashboard.png')
 plt.close()
 
 # Calculate and save yearly summary data
-yearly_summary = yearly_emissions.copy()
+yearly_summary = yearly_emissions[['Year', 'Yearly_NOx_Emissions_kg']].copy()
 yearly_summary['Compliance'] = yearly_summary['Yearly_NOx_Emissions_kg'] <= CSRD_YEARLY_MAX
 yearly_summary['Exceedance_kg'] = (yearly_summary['Yearly_NOx_Emissions_kg'] - CSRD_YEARLY_MAX).clip(lower=0)
 
@@ -42,7 +40,7 @@ total_exceedances = yearly_summary['Exceedance_kg'].sum()
 compliant_years = yearly_summary['Compliance'].sum()
 total_years = len(yearly_summary)
 compliance_rate = (compliant_years / total_years) * 100
-num_anomalies = df['Anomaly'].sum()
+num_anomalies = yearly_emissions['Anomalies'].sum()
 
 # Print more debug information
 print(f"\nCompliant years: {compliant_years}")
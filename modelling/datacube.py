@@ -0,0 +1,300 @@
+import io
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+from numpy.lib import format as npy_format
+from numpy.lib.format import open_memmap
+
+DATES_FILE = 'dates.npy'
+META_FILE = 'meta.json'
+
+
+def _to_day(value):
+    """Convert a date, datetime or ISO string to numpy datetime64[D]."""
+    return np.datetime64(value, 'D')
+
+
+def _replace_file(path, write):
+    """Write a file through write(f) to a temporary name, then move it over path in one rename."""
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        write(f)
+    os.replace(tmp_file, path)
+
+
+def _grow_npy(file, length):
+    """
+    Grow the first axis of a C-ordered .npy file in place to length.
+
+    The file is extended with zeros and its header rewritten with the new
+    shape. numpy pads headers so the shape can grow without moving the data;
+    returns False, leaving the file as is, when the new header would not fit.
+    """
+    with open(file, 'r+b') as f:
+        version = npy_format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = npy_format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = npy_format.read_array_header_2_0(f)
+        offset = f.tell()
+        if fortran_order:
+            return False
+        header = io.BytesIO()
+        write_header = npy_format.write_array_header_1_0 if version == (1, 0) else npy_format.write_array_header_2_0
+        write_header(header, {'descr': npy_format.dtype_to_descr(dtype), 'fortran_order': False,
+                              'shape': (length,) + tuple(shape[1:])})
+        if header.tell() != offset:
+            return False
+        frame_bytes = int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize
+        f.truncate(offset + length * frame_bytes)
+        f.seek(0)
+        f.write(header.getvalue())
+    return True
+
+
+def _recover_rebuild(path):
+    """
+    Finish or roll back a rebuild of the datacube at path that was interrupted while swapping directories.
+
+    A rebuild moves path to path.old, then the complete path.tmp to path, then
+    deletes path.old. If path is missing, path.tmp is the rebuilt datacube when
+    it exists and path.old the untouched one otherwise.
+    """
+    path = os.path.normpath(path)
+    old_path, tmp_path = path + '.old', path + '.tmp'
+    if not os.path.exists(old_path):
+        return
+    if not os.path.exists(path):
+        os.replace(tmp_path if os.path.exists(tmp_path) else old_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+class Datacube:
+    """
+    Date-indexed store of memory-mapped (T, H, W) arrays.
+
+    A datacube is a directory holding one ``<variable>.npy`` array per variable,
+    a sorted ``dates.npy`` index (datetime64[D]) and a small ``meta.json``.
+    Arrays are opened as memory maps, so slicing a date range only touches the
+    pages of that range. ``dates.npy`` is authoritative for the number of days:
+    variable files may hold more, e.g. after an interrupted append. Each
+    datacube gets a random id when created, kept when it is rebuilt.
+    """
+
+    def __init__(self, path, mode='r'):
+        if mode not in ('r', 'r+'):
+            raise ValueError(f"Unsupported mode: {mode}")
+        self.path = path
+        self.mode = mode
+
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        self.shape = tuple(meta['shape'])
+        self.variables = dict(meta['variables'])
+        self.id = meta.get('id')
+        self.dates = np.load(os.path.join(path, DATES_FILE))
+        self._arrays = {}
+
+    @classmethod
+    def create(cls, path, dates, shape, variables=None, cube_id=None):
+        """
+        Create an empty datacube on disk.
+
+        Args:
+        path (str): Directory of the datacube
+        dates (list): Strictly increasing dates (date objects or 'YYYY-MM-DD')
+        shape (tuple): (H, W) shape of a single day
+        variables (dict): Optional mapping of variable name to dtype
+        cube_id (str): Id of the datacube, a new random one by default
+
+        Returns:
+        Datacube: The new datacube, opened for writing
+        """
+        dates = np.array([_to_day(d) for d in dates], dtype='datetime64[D]')
+        if np.any(dates[1:] <= dates[:-1]):
+            raise ValueError("Datacube dates must be strictly increasing")
+
+        os.makedirs(path, exist_ok=True)
+        _replace_file(os.path.join(path, DATES_FILE), lambda f: np.save(f, dates))
+        _replace_file(os.path.join(path, META_FILE),
+                      lambda f: f.write(json.dumps({'shape': list(shape), 'variables': {},
+                                                    'id': cube_id or uuid.uuid4().hex}).encode()))
+
+        cube = cls(path, mode='r+')
+        for name, dtype in (variables or {}).items():
+            cube.add_variable(name, dtype)
+        return cube
+
+    @classmethod
+    def open_or_create(cls, path, dates, shape, variables=None, copy_batch=64):
+        """
+        Open a datacube for writing, creating or rebuilding it when dates, shape or dtypes changed.
+
+        New dates after the last stored one are appended in place: every
+        variable file grows along T and dates.npy is replaced last, so an
+        interrupted append leaves the datacube at its previous dates. Any other
+        change of dates, shape or dtype rebuilds the datacube in a sibling
+        directory, copying over the days both have in common, and swaps it in
+        with renames.
+        """
+        dates = np.array([_to_day(d) for d in dates], dtype='datetime64[D]')
+        _recover_rebuild(path)
+        if not os.path.exists(os.path.join(path, META_FILE)):
+            return cls.create(path, dates, shape, variables)
+
+        existing = cls(path, mode='r+')
+        same_dtypes = all(existing.variables.get(name, np.dtype(dtype).str) == np.dtype(dtype).str
+                          for name, dtype in (variables or {}).items())
+        same_layout = existing.shape == tuple(shape) and same_dtypes
+        if same_layout and len(dates) >= len(existing) and np.array_equal(existing.dates, dates[:len(existing)]):
+            if len(dates) == len(existing) or existing._append_dates(dates):
+                for name, dtype in (variables or {}).items():
+                    existing.add_variable(name, dtype)
+                return existing
+
+        tmp_path = os.path.normpath(path) + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        variables = {name: np.dtype(dtype).str for name, dtype in (variables or {}).items()}
+        cube = cls.create(tmp_path, dates, shape, dict(existing.variables, **variables),
+                          cube_id=existing.id)
+        if existing.shape == tuple(shape):
+            _, new_index, old_index = np.intersect1d(dates, existing.dates, return_indices=True)
+            # Copy in batches of days to keep memory flat
+            for name in existing.variables:
+                for start in range(0, len(new_index), copy_batch):
+                    days = slice(start, start + copy_batch)
+                    cube.array(name)[new_index[days]] = existing.array(name)[old_index[days]]
+        cube.flush()
+        del cube, existing
+
+        # The old datacube is only deleted once the new one is in place, see _recover_rebuild
+        old_path = os.path.normpath(path) + '.old'
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path)
+        return cls(path, mode='r+')
+
+    def _append_dates(self, dates):
+        """Grow every variable in place to the given dates, which extend the current ones."""
+        self._arrays.clear()
+        for name in self.variables:
+            if not _grow_npy(self.variable_path(name), len(dates)):
+                return False
+        _replace_file(os.path.join(self.path, DATES_FILE), lambda f: np.save(f, dates))
+        self.dates = dates
+        return True
+
+    def __len__(self):
+        return len(self.dates)
+
+    def variable_path(self, name):
+        return os.path.join(self.path, f'{name}.npy')
+
+    def _write_meta(self):
+        meta = {'shape': list(self.shape), 'variables': self.variables, 'id': self.id}
+        _replace_file(os.path.join(self.path, META_FILE), lambda f: f.write(json.dumps(meta).encode()))
+
+    def add_variable(self, name, dtype=np.float64, overwrite=False):
+        """
+        Allocate a (T, H, W) array for a new variable, if it does not exist yet.
+
+        With overwrite=True an existing variable of another dtype is reallocated
+        and its data dropped, which suits derived variables that are recomputed.
+        """
+        if self.mode != 'r+':
+            raise ValueError("Datacube is opened read-only")
+        if name in self.variables and not (overwrite and self.variables[name] != np.dtype(dtype).str):
+            return self.array(name)
+        self._arrays.pop(name, None)
+
+        array = open_memmap(self.variable_path(name), mode='w+', dtype=np.dtype(dtype),
+                            shape=(len(self.dates),) + self.shape)
+        self._arrays[name] = array
+        self.variables[name] = np.dtype(dtype).str
+        self._write_meta()
+        return array
+
+    def drop_variable(self, name):
+        """Remove a variable and its array file, if it exists."""
+        if self.mode != 'r+':
+            raise ValueError("Datacube is opened read-only")
+        if name not in self.variables:
+            return
+        self._arrays.pop(name, None)
+        del self.variables[name]
+        self._write_meta()
+        os.remove(self.variable_path(name))
+
+    def array(self, name):
+        """Return the full memory-mapped (T, H, W) array of a variable."""
+        if name not in self.variables:
+            raise KeyError(f"Unknown datacube variable: {name}")
+        if name not in self._arrays:
+            array = np.load(self.variable_path(name), mmap_mode=self.mode)
+            self._arrays[name] = array[:len(self.dates)] if len(array) > len(self.dates) else array
+        return self._arrays[name]
+
+    def date_slice(self, start=None, end=None):
+        """
+        Return the slice of time indices between start and end, both inclusive.
+
+        Coarser ISO strings select whole periods, e.g. ``date_slice('2023-03', '2023-03')``
+        covers all of March 2023.
+        """
+        lo = 0 if start is None else np.searchsorted(self.dates, _to_day(start), 'left')
+        if end is None:
+            hi = len(self.dates)
+        else:
+            # First day after the end period, so '2023-03' includes March 31st
+            after_end = (np.datetime64(end) + 1).astype('datetime64[D]')
+            hi = np.searchsorted(self.dates, after_end, 'left')
+        return slice(int(lo), int(hi))
+
+    def index_of(self, date):
+        """Return the time index of a single date."""
+        day = _to_day(date)
+        index = int(np.searchsorted(self.dates, day))
+        if index == len(self.dates) or self.dates[index] != day:
+            raise KeyError(f"Date {day} is not in the datacube")
+        return index
+
+    def day_signature(self, date, variables):
+        """
+        Where the data of one date and some variables is stored, for stage fingerprints.
+
+        The signature holds the datacube id, the time index of the date and the
+        grid shape and dtypes of the variables. It changes when the datacube is
+        recreated, when dates are inserted before the date or when a variable is
+        reallocated, but not when dates are appended after it.
+        """
+        return {'datacube': self.id, 'index': self.index_of(date), 'shape': list(self.shape),
+                'variables': {name: self.variables.get(name) for name in variables}}
+
+    def read(self, name, start=None, end=None):
+        """
+        Lazily read a variable over a date range.
+
+        Returns:
+        tuple: memory-mapped (T, H, W) view, datetime64[D] dates of the view
+        """
+        selection = self.date_slice(start, end)
+        return self.array(name)[selection], self.dates[selection]
+
+    def iter_days(self, name, start=None, end=None):
+        """Yield (array, date) pairs for a variable, one day at a time."""
+        data, dates = self.read(name, start, end)
+        for array, date in zip(data, dates.astype(object)):
+            yield array, date
+
+    def write(self, name, date, array):
+        """Write the map of one date for a variable."""
+        self.array(name)[self.index_of(date)] = array
+
+    def flush(self):
+        """Flush all open memory maps to disk."""
+        for array in self._arrays.values():
+            if isinstance(array, np.memmap):
+                array.flush()
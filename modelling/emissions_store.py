@@ -0,0 +1,282 @@
+import io
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Assumed CSRD yearly maximum per site, in kg (replace with the actual regulatory value)
+CSRD_YEARLY_MAX = 1500000
+
+STATE_FILE = 'state.json'
+
+
+def _as_flags(anomalies):
+    """Boolean anomaly flags, with missing values (NaN, None) as False rather than True."""
+    return pd.Series(np.asarray(anomalies, dtype=object)).fillna(False).astype(bool).to_numpy()
+
+
+def read_appended_rows(csv_path, position=None, **read_csv_options):
+    """
+    Read the rows appended to a CSV since a previous read.
+
+    Only the bytes after position, the {'header', 'offset'} returned by the
+    previous call, are read. A CSV whose header changed or that shrank is read
+    again from its first row. A trailing partial line is left for the next read.
+
+    Returns:
+    tuple: DataFrame of the appended rows (None if there are none), position after them
+    """
+    previous = position or {'header': None, 'offset': 0}
+    with open(csv_path, 'rb') as f:
+        header = f.readline()
+        size = f.seek(0, os.SEEK_END)
+        same_file = previous['header'] == header.decode() and previous['offset'] <= size
+        offset = previous['offset'] if same_file else len(header)
+        f.seek(offset)
+        tail = f.read()
+    # Only complete lines; a row still being written is read next time
+    tail = tail[:tail.rfind(b'\n') + 1]
+    position = {'header': header.decode(), 'offset': offset + len(tail)}
+    if not tail.strip():
+        return None, position
+    return pd.read_csv(io.BytesIO(header + tail), **read_csv_options), position
+
+
+class EmissionsStore:
+    """
+    Append-only columnar store of daily emissions, partitioned by site and year.
+
+    Each append writes one chunk per touched (site, year) partition, as an .npz
+    file with one array per column (date, emissions, anomaly). Yearly and
+    monthly rollups (totals, day counts, anomaly counts) are updated from the
+    appended rows only and kept in state.json with the chunk counts, which is
+    replaced atomically as the commit point of an append: chunks not listed
+    there are ignored and overwritten by the next append. Anomaly flags of
+    stored days can be updated, which rewrites their partition. A dashboard
+    refresh only reads the rollups.
+    """
+
+    def __init__(self, path, yearly_limit=CSRD_YEARLY_MAX):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        state_path = os.path.join(path, STATE_FILE)
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+        else:
+            self.state = {'yearly_limit': yearly_limit, 'last_date': {}, 'chunks': {}, 'yearly': {}, 'monthly': {}}
+
+    def _save_state(self):
+        state_path = os.path.join(self.path, STATE_FILE)
+        with open(f'{state_path}.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.replace(f'{state_path}.tmp', state_path)
+
+    @property
+    def yearly_limit(self):
+        return self.state['yearly_limit']
+
+    def sites(self):
+        return sorted(self.state['last_date'])
+
+    def _partition_dir(self, site, year):
+        return os.path.join(self.path, f'site={site}', f'year={year}')
+
+    def append(self, site, dates, emissions, anomalies=None):
+        """
+        Append days of one site.
+
+        Args:
+        site (str): Site identifier
+        dates (list): Increasing dates, all after the last appended date of the site
+        emissions (list): Daily emissions in kg
+        anomalies (list): Optional daily anomaly flags, False by default and where missing (NaN)
+        """
+        site = str(site)
+        if '/' in site:
+            raise ValueError(f"Site identifiers cannot contain '/': {site}")
+        dates = np.array(dates, dtype='datetime64[D]')
+        emissions = np.asarray(emissions, dtype=np.float64)
+        anomalies = np.zeros(len(dates), dtype=bool) if anomalies is None else _as_flags(anomalies)
+        if not len(dates):
+            return
+        if not (len(dates) == len(emissions) == len(anomalies)):
+            raise ValueError("dates, emissions and anomalies must have the same length")
+        last_date = self.state['last_date'].get(site)
+        if np.any(dates[1:] <= dates[:-1]) or (last_date is not None and dates[0] <= np.datetime64(last_date)):
+            raise ValueError(f"Dates of site {site} must increase and follow its last date {last_date}")
+
+        years = dates.astype('datetime64[Y]').astype(int) + 1970
+        months = dates.astype('datetime64[M]').astype(int) % 12 + 1
+        for year in np.unique(years):
+            rows = years == year
+            partition = f'{site}/{year}'
+            chunks = self.state['chunks'].setdefault(partition, [])
+            chunk = chunks[-1] + 1 if chunks else 0
+            directory = self._partition_dir(site, year)
+            os.makedirs(directory, exist_ok=True)
+            np.savez(os.path.join(directory, f'part-{chunk:05d}.npz'),
+                     date=dates[rows], emissions=emissions[rows], anomaly=anomalies[rows])
+            chunks.append(chunk)
+
+            self._add_rollup('yearly', f'{site}/{year}', emissions[rows], anomalies[rows])
+            for month in np.unique(months[rows]):
+                in_month = rows & (months == month)
+                self._add_rollup('monthly', f'{site}/{year}/{month}', emissions[in_month], anomalies[in_month])
+
+        self.state['last_date'][site] = str(dates[-1])
+        self._save_state()
+
+    def _add_rollup(self, table, key, emissions, anomalies):
+        total, days, anomaly_count = self.state[table].get(key, (0.0, 0, 0))
+        self.state[table][key] = (total + float(emissions.sum()), days + len(emissions),
+                                  anomaly_count + int(anomalies.sum()))
+
+    def read(self, site, years=None, columns=('date', 'emissions', 'anomaly')):
+        """Daily rows of one site, optionally for some years only, as a DataFrame."""
+        site = str(site)
+        parts = {column: [] for column in columns}
+        for partition, chunks in sorted(self.state['chunks'].items()):
+            partition_site, year = partition.rsplit('/', 1)
+            if partition_site != site or (years is not None and int(year) not in years):
+                continue
+            for chunk in chunks:
+                with np.load(os.path.join(self._partition_dir(site, year), f'part-{chunk:05d}.npz')) as data:
+                    for column in columns:
+                        parts[column].append(data[column])
+        return pd.DataFrame({column: np.concatenate(arrays) if arrays else np.empty(0)
+                             for column, arrays in parts.items()})
+
+    def compact(self, site, year):
+        """
+        Merge the chunks of one (site, year) partition into a single new chunk.
+
+        The old chunks are only removed once the state lists the merged one.
+        """
+        site = str(site)
+        if len(self.state['chunks'].get(f'{site}/{year}', [])) <= 1:
+            return
+        stale = self._rewrite_partition(site, year, self.read(site, years=[int(year)]))
+        self._save_state()
+        for chunk_file in stale:
+            os.remove(chunk_file)
+
+    def _rewrite_partition(self, site, year, data):
+        """
+        Replace the chunks of one (site, year) partition by a single chunk of data.
+
+        Returns:
+        list: Files of the replaced chunks, to remove once the state is saved
+        """
+        partition = f'{site}/{year}'
+        chunks = self.state['chunks'][partition]
+        directory = self._partition_dir(site, year)
+        merged = chunks[-1] + 1
+        np.savez(os.path.join(directory, f'part-{merged:05d}.npz'),
+                 date=data['date'].to_numpy().astype('datetime64[D]'),
+                 emissions=data['emissions'].to_numpy(), anomaly=data['anomaly'].to_numpy())
+        self.state['chunks'][partition] = [merged]
+        return [os.path.join(directory, f'part-{chunk:05d}.npz') for chunk in chunks]
+
+    def update_anomalies(self, site, dates, anomalies):
+        """
+        Set the anomaly flags of days already stored for one site.
+
+        Dates that are not stored are ignored. Each partition with a changed
+        flag is rewritten as a single chunk, as by compact, and its yearly and
+        monthly anomaly counts are adjusted.
+
+        Returns:
+        int: Number of days whose flag changed
+        """
+        site = str(site)
+        updates = pd.Series(_as_flags(anomalies), index=np.array(dates, dtype='datetime64[D]'))
+        updates = updates[~updates.index.duplicated(keep='last')]
+        years = updates.index.year
+        changed, stale = 0, []
+        for year in np.unique(years):
+            if f'{site}/{year}' not in self.state['chunks']:
+                continue
+            data = self.read(site, years=[int(year)])
+            dates_in_year = data['date'].to_numpy().astype('datetime64[D]')
+            new = updates[years == year].reindex(dates_in_year)
+            flags = np.where(new.isna(), data['anomaly'].to_numpy(), new.to_numpy(dtype=object)).astype(bool)
+            delta = flags.astype(int) - data['anomaly'].to_numpy().astype(int)
+            if not delta.any():
+                continue
+            changed += int(np.count_nonzero(delta))
+            stale += self._rewrite_partition(site, year, data.assign(anomaly=flags))
+            self._add_anomalies('yearly', f'{site}/{year}', int(delta.sum()))
+            months = dates_in_year.astype('datetime64[M]').astype(int) % 12 + 1
+            for month in np.unique(months[delta != 0]):
+                self._add_anomalies('monthly', f'{site}/{year}/{month}', int(delta[months == month].sum()))
+        if changed:
+            self._save_state()
+        for chunk_file in stale:
+            os.remove(chunk_file)
+        return changed
+
+    def _add_anomalies(self, table, key, count):
+        total, days, anomaly_count = self.state[table][key]
+        self.state[table][key] = (total, days, anomaly_count + count)
+
+    def yearly(self):
+        """Yearly rollup: totals, days, anomalies, compliance and exceedance per (site, year)."""
+        rows = [(*key.split('/'), *values) for key, values in self.state['yearly'].items()]
+        yearly = pd.DataFrame(rows, columns=['Site', 'Year', 'Yearly_NOx_Emissions_kg', 'Days', 'Anomalies'])
+        yearly['Year'] = yearly['Year'].astype(int)
+        yearly['Compliance'] = yearly['Yearly_NOx_Emissions_kg'] <= self.yearly_limit
+        yearly['Exceedance_kg'] = (yearly['Yearly_NOx_Emissions_kg'] - self.yearly_limit).clip(lower=0)
+        return yearly.sort_values(['Site', 'Year'], ignore_index=True)
+
+    def monthly(self):
+        """Monthly rollup: totals, days and anomalies per (site, year, month)."""
+        rows = [(*key.split('/'), *values) for key, values in self.state['monthly'].items()]
+        monthly = pd.DataFrame(rows, columns=['Site', 'Year', 'Month', 'NOx_Emissions_kg', 'Days', 'Anomalies'])
+        monthly[['Year', 'Month']] = monthly[['Year', 'Month']].astype(int)
+        return monthly.sort_values(['Site', 'Year', 'Month'], ignore_index=True)
+
+    def add_days(self, site, dates, emissions, anomalies=None):
+        """
+        Store days of one site that may already be partly stored, e.g. the days
+        anomaly.py just flagged: days up to the last date of the site only update
+        their anomaly flags, later days are appended. Of repeated dates the last
+        row is kept.
+        """
+        site = str(site)
+        flags = np.zeros(len(dates), dtype=bool) if anomalies is None else _as_flags(anomalies)
+        days = pd.DataFrame({'date': np.array(dates, dtype='datetime64[D]'),
+                             'emissions': np.asarray(emissions, dtype=np.float64), 'anomaly': flags})
+        days = days.drop_duplicates('date', keep='last').sort_values('date')
+        last_date = self.state['last_date'].get(site)
+        stored = days['date'] <= np.datetime64(last_date) if last_date is not None else np.zeros(len(days), dtype=bool)
+        if anomalies is not None and stored.any():
+            self.update_anomalies(site, days.loc[stored, 'date'].to_numpy(), days.loc[stored, 'anomaly'])
+        days = days[~stored]
+        self.append(site, days['date'].to_numpy(), days['emissions'].to_numpy(), days['anomaly'].to_numpy())
+
+    def import_csv(self, csv_path, site='default'):
+        """
+        Append the days of a daily_nox_emissions.csv that follow the last date of their site.
+
+        Only the bytes added to the CSV since the last import are read: the offset
+        reached is kept in the state, so the CSV is expected to grow at its end, as
+        anomaly.py appends to it. A CSV whose header changed or that shrank is read
+        again from its first row. Rows are stored under their Site column, or under
+        site when the CSV has none. Anomaly flags of stored days are not re-read:
+        anomaly.py passes the flags it sets to add_days.
+        """
+        imports = self.state.setdefault('imports', {})
+        df, imports[str(csv_path)] = read_appended_rows(
+            csv_path, imports.get(str(csv_path)), parse_dates=['Date'],
+            usecols=lambda column: column in ('Site', 'Date', 'NOx_Emissions_kg_per_day', 'Anomaly'))
+        if df is not None:
+            sites = df['Site'].astype(str) if 'Site' in df else pd.Series(str(site), index=df.index)
+            for site_id, days in df.groupby(sites):
+                last_date = self.state['last_date'].get(site_id)
+                if last_date is not None:
+                    days = days[days['Date'] > pd.Timestamp(last_date)]
+                if not days.empty:
+                    self.add_days(site_id, days['Date'].to_numpy(), days['NOx_Emissions_kg_per_day'].to_numpy(),
+                                  days['Anomaly'] if 'Anomaly' in days else None)
+        self._save_state()
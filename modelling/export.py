@@ -0,0 +1,304 @@
+"""
+Export of divergence and NO2 maps as Cloud-Optimized GeoTIFFs and XYZ tile pyramids.
+
+Usage:
+    python export.py datacube_dir output_dir [--tiles] [--max-zoom 10]
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+from matplotlib import colormaps
+from matplotlib.image import imsave
+from rasterio.transform import array_bounds, from_origin
+from rasterio.warp import Resampling, reproject
+from aggregation import StreamingAggregator
+from datacube import Datacube
+from instrumentation import stage
+from manifest import StageManifest, hash_array
+
+TILE_SIZE = 256
+
+# Half the circumference of the Web Mercator sphere, in m
+MERCATOR_EXTENT = 20037508.342789244
+
+# Colour map and whether the colour scale is centred on zero, per exported variable
+STYLES = {'no2': ('YlOrRd', False), 'divergence': ('RdBu_r', True)}
+
+# Manifest stage whose output fingerprint identifies the content of each variable's days
+PRODUCING_STAGES = {'no2': 'interpolate', 'divergence': 'divergence'}
+
+
+def grid_transform(lats, lons):
+    """
+    North-up geotransform of a grid given its pixel centre coordinates.
+
+    Returns:
+    tuple: Affine transform, whether the rows must be flipped (latitudes increasing) to be north-up
+    """
+    lats, lons = np.asarray(lats), np.asarray(lons)
+    lat_step = abs(lats[-1] - lats[0]) / (len(lats) - 1)
+    lon_step = (lons[-1] - lons[0]) / (len(lons) - 1)
+    transform = from_origin(lons[0] - lon_step / 2, lats.max() + lat_step / 2, lon_step, lat_step)
+    return transform, bool(lats[-1] > lats[0])
+
+
+def write_cog(array, path, lats, lons, resampling='average', blocksize=512):
+    """
+    Write a 2D array as a Cloud-Optimized GeoTIFF in EPSG:4326.
+
+    The file is tiled, deflate-compressed and carries internal overviews down
+    to a single block, so clients can fetch any area at any zoom with a few
+    range requests. NaN is the nodata value. The file is written to a temporary
+    path and moved into place, so readers never see a partial file.
+    """
+    transform, flip = grid_transform(lats, lons)
+    array = np.asarray(array)
+    if flip:
+        array = array[::-1]
+    dtype = np.result_type(array.dtype, np.float32)
+    profile = dict(driver='COG', width=array.shape[1], height=array.shape[0], count=1, dtype=dtype,
+                   crs='EPSG:4326', transform=transform, nodata=np.nan, compress='deflate', predictor=3,
+                   blocksize=blocksize, overview_resampling=resampling)
+
+    # Not a .tif, so globs over the exports never pick up a partial file
+    fd, tmp_file = tempfile.mkstemp(suffix='.tif.tmp', dir=os.path.dirname(path) or '.')
+    os.close(fd)
+    try:
+        with rasterio.open(tmp_file, 'w', **profile) as dst:
+            dst.write(array.astype(dtype, copy=False), 1)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    return path
+
+
+def export_datacube_cogs(datacube_dir, output_dir, lats, lons, variables=('no2', 'divergence'), manifest=None):
+    """
+    Write one COG per variable and date of a datacube, as <variable>/<variable>_<date>.tif.
+
+    With a manifest, only the days whose content changed since their last
+    export are written again. A day's content is identified by the output
+    fingerprint the manifest recorded for the stage that produced it, so
+    unchanged days are skipped without reading them; days without one are
+    hashed.
+
+    Returns:
+    list: Paths of the written files
+    """
+    cube = Datacube(datacube_dir)
+    written = []
+    for name in variables:
+        os.makedirs(os.path.join(output_dir, name), exist_ok=True)
+        data = cube.array(name)
+        for index, date in enumerate(cube.dates.astype(str)):
+            path = os.path.join(output_dir, name, f'{name}_{date}.tif')
+            fingerprint = None
+            if manifest is not None:
+                content = manifest.output_fingerprint(PRODUCING_STAGES.get(name), date) or hash_array(data[index])
+                fingerprint = manifest.fingerprint([content], {'variable': name})
+                if manifest.is_current(f'export_{name}', date, fingerprint):
+                    continue
+            with stage('export_cog', variable=name, date=date):
+                write_cog(data[index], path, lats, lons)
+            if manifest is not None:
+                manifest.record(f'export_{name}', date, fingerprint, [path])
+            written.append(path)
+    return written
+
+
+def color_scale(array, centred=False, percentile=98):
+    """Robust (vmin, vmax) of an array, symmetric around zero when centred."""
+    values = np.asarray(array)
+    values = values[np.isfinite(values)]
+    if not values.size:
+        return 0.0, 1.0
+    if centred:
+        limit = float(np.percentile(np.abs(values), percentile)) or 1.0
+        return -limit, limit
+    vmin, vmax = np.percentile(values, [100 - percentile, percentile])
+    return float(vmin), (float(vmax) if vmax > vmin else float(vmin) + 1.0)
+
+
+def tile_bounds(x, y, z):
+    """Web Mercator (left, bottom, right, top) of an XYZ tile, in m."""
+    size = 2 * MERCATOR_EXTENT / 2 ** z
+    left, top = -MERCATOR_EXTENT + x * size, MERCATOR_EXTENT - y * size
+    return left, top - size, left + size, top
+
+
+def tiles_covering(bounds, z):
+    """XYZ (x, y) indices of the tiles at zoom z covering lon/lat bounds (west, south, east, north)."""
+    west, south, east, north = bounds
+    n = 2 ** z
+
+    def tile_x(lon):
+        return min(n - 1, max(0, int(np.floor((lon + 180) / 360 * n))))
+
+    def tile_y(lat):
+        lat = np.radians(np.clip(lat, -85.0511, 85.0511))
+        return min(n - 1, max(0, int(np.floor((1 - np.arcsinh(np.tan(lat)) / np.pi) / 2 * n))))
+
+    return [(x, y) for x in range(tile_x(west), tile_x(east) + 1) for y in range(tile_y(north), tile_y(south) + 1)]
+
+
+def native_zoom(lats, lons):
+    """Lowest zoom whose tiles are at least as fine as the grid, at the grid's central latitude."""
+    lat_step = abs(lats[-1] - lats[0]) / (len(lats) - 1)
+    lon_step = abs(lons[-1] - lons[0]) / (len(lons) - 1)
+    # Mercator stretches latitudes by 1 / cos(lat), so a grid degree of latitude spans more tile pixels
+    step = min(lon_step, lat_step / np.cos(np.radians(np.mean(lats))))
+    return max(0, int(np.ceil(np.log2(360 / (TILE_SIZE * step)))))
+
+
+def render_tile(array, transform, x, y, z, cmap, vmin, vmax, resampling):
+    """RGBA (TILE_SIZE, TILE_SIZE, 4) uint8 image of one XYZ tile, or None when it holds no data."""
+    left, bottom, right, top = tile_bounds(x, y, z)
+    tile = np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32)
+    reproject(array, tile, src_transform=transform, src_crs='EPSG:4326', src_nodata=np.nan,
+              dst_transform=rasterio.transform.from_bounds(left, bottom, right, top, TILE_SIZE, TILE_SIZE),
+              dst_crs='EPSG:3857', dst_nodata=np.nan, resampling=resampling)
+    valid = np.isfinite(tile)
+    if not valid.any():
+        return None
+    rgba = cmap(np.clip((tile - vmin) / (vmax - vmin), 0, 1), bytes=True)
+    rgba[..., 3] = np.where(valid, 255, 0)
+    return rgba
+
+
+def export_tiles(array, output_dir, lats, lons, cmap='RdBu_r', vmin=None, vmax=None, centred=True, min_zoom=0,
+                 max_zoom=None, workers=8):
+    """
+    Pre-render an XYZ tile pyramid of a 2D map, as <output_dir>/<z>/<x>/<y>.png in Web Mercator.
+
+    Only the tiles intersecting the grid are rendered; NaN pixels and tiles
+    without data are transparent or skipped. Zoomed-out levels average the
+    source pixels. A tiles.json next to the pyramid records the bounds, zoom
+    range and colour scale for the dashboard legend. The pyramid is written to
+    a sibling directory and swapped in, so no tile of a previous, larger
+    pyramid is left behind.
+
+    Args:
+    array (np.ndarray): (H, W) map on the lats x lons grid
+    cmap (str): Matplotlib colour map name
+    vmin, vmax (float): Colour scale, a robust range of the data by default
+    centred (bool): Whether the default colour scale is symmetric around zero
+    max_zoom (int): Deepest zoom level, the grid's native resolution by default
+    workers (int): Threads rendering tiles concurrently
+
+    Returns:
+    int: Number of tiles written
+    """
+    lats, lons = np.asarray(lats), np.asarray(lons)
+    transform, flip = grid_transform(lats, lons)
+    array = np.asarray(array, dtype=np.float32)
+    array = np.ascontiguousarray(array[::-1] if flip else array)
+    if vmin is None or vmax is None:
+        default_vmin, default_vmax = color_scale(array, centred)
+        vmin = default_vmin if vmin is None else vmin
+        vmax = default_vmax if vmax is None else vmax
+    max_zoom = native_zoom(lats, lons) if max_zoom is None else max_zoom
+    colormap = colormaps[cmap]
+    bounds = array_bounds(array.shape[0], array.shape[1], transform)
+
+    output_dir = os.path.normpath(output_dir)
+    os.makedirs(os.path.dirname(output_dir) or '.', exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(suffix='.tmp', dir=os.path.dirname(output_dir) or '.')
+    # mkdtemp creates a private directory, tiles are meant to be served
+    os.chmod(tmp_dir, 0o755)
+
+    def render(job):
+        x, y, z = job
+        resampling = Resampling.bilinear if z >= max_zoom else Resampling.average
+        rgba = render_tile(array, transform, x, y, z, colormap, vmin, vmax, resampling)
+        if rgba is None:
+            return False
+        os.makedirs(os.path.join(tmp_dir, str(z), str(x)), exist_ok=True)
+        imsave(os.path.join(tmp_dir, str(z), str(x), f'{y}.png'), rgba)
+        return True
+
+    jobs = [(x, y, z) for z in range(min_zoom, max_zoom + 1) for x, y in tiles_covering(bounds, z)]
+    try:
+        with stage('export_tiles', tiles=len(jobs), max_zoom=max_zoom) as span:
+            # GDAL releases the GIL while warping, so threads render tiles in parallel
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                written = sum(pool.map(render, jobs))
+            span.set(written=written)
+        with open(os.path.join(tmp_dir, 'tiles.json'), 'w') as f:
+            json.dump({'bounds': bounds, 'minzoom': min_zoom, 'maxzoom': max_zoom, 'tile_size': TILE_SIZE,
+                       'cmap': cmap, 'vmin': vmin, 'vmax': vmax, 'tiles': '{z}/{x}/{y}.png'}, f, indent=2)
+    except BaseException:
+        shutil.rmtree(tmp_dir)
+        raise
+
+    # The previous pyramid is only deleted once the new one is in place
+    old_dir = f'{output_dir}.old'
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(output_dir):
+        os.replace(output_dir, old_dir)
+    os.replace(tmp_dir, output_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return written
+
+
+def export_maps(datacube_dir, output_dir, lats, lons, averaged_divergence=None, tiles=False, max_zoom=None,
+                manifest=None, average_fingerprint=None):
+    """
+    Export stage of the pipeline: per-date NO2 and divergence COGs, the averaged
+    divergence COG and optionally its tile pyramid, under output_dir.
+
+    With a manifest, the average COG and tiles are only written again when the
+    average changed, as identified by average_fingerprint (e.g. the output
+    fingerprint of the 'average' stage) or else by its hash.
+    """
+    export_datacube_cogs(datacube_dir, os.path.join(output_dir, 'cog'), lats, lons, manifest=manifest)
+    if averaged_divergence is None:
+        return
+    if manifest is not None and average_fingerprint is None:
+        average_fingerprint = hash_array(averaged_divergence)
+
+    cog_path = os.path.join(output_dir, 'cog', 'divergence_average.tif')
+    fingerprint = manifest.fingerprint([average_fingerprint]) if manifest is not None else None
+    if manifest is None or not manifest.is_current('export_average', 'divergence', fingerprint):
+        write_cog(averaged_divergence, cog_path, lats, lons)
+        if manifest is not None:
+            manifest.record('export_average', 'divergence', fingerprint, [cog_path])
+
+    if tiles:
+        cmap, centred = STYLES['divergence']
+        tiles_dir = os.path.join(output_dir, 'tiles', 'divergence_average')
+        fingerprint = (manifest.fingerprint([average_fingerprint], {'cmap': cmap, 'max_zoom': max_zoom})
+                       if manifest is not None else None)
+        if manifest is None or not manifest.is_current('export_tiles', 'divergence', fingerprint):
+            export_tiles(averaged_divergence, tiles_dir, lats, lons, cmap, centred=centred, max_zoom=max_zoom)
+            if manifest is not None:
+                manifest.record('export_tiles', 'divergence', fingerprint, [os.path.join(tiles_dir, 'tiles.json')])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('datacube', help='Datacube with no2 and divergence variables')
+    parser.add_argument('output_dir')
+    parser.add_argument('--lats', default='latitudes.npy', help='Pixel centre latitudes of the grid')
+    parser.add_argument('--lons', default='longitudes.npy', help='Pixel centre longitudes of the grid')
+    parser.add_argument('--tiles', action='store_true', help='Also render the averaged divergence as XYZ tiles')
+    parser.add_argument('--max-zoom', type=int, help='Deepest tile zoom level, native resolution by default')
+    parser.add_argument('--manifest', help='Stage manifest, to only export the days that changed')
+    args = parser.parse_args()
+
+    lats, lons = np.load(args.lats), np.load(args.lons)
+    manifest = StageManifest(args.manifest) if args.manifest else None
+    cube = Datacube(args.datacube)
+    averaged_divergence = StreamingAggregator(cube.variables['divergence']).update_all(cube.array('divergence')).mean
+    export_maps(args.datacube, args.output_dir, lats, lons, averaged_divergence, args.tiles, args.max_zoom, manifest)
+    if manifest is not None:
+        manifest.save()
+
+
+if __name__ == "__main__":
+    main()
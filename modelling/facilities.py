@@ -0,0 +1,172 @@
+import os
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from aggregation import StreamingAggregator
+from datacube import Datacube
+from model import detect_and_fit_peaks_local_maxima, grid_pixel_area, quantify_emissions
+
+
+def read_facilities(path, id_column='Facility'):
+    """
+    Read a facility table as a GeoDataFrame in longitude/latitude.
+
+    CSV files need Latitude and Longitude columns; any other vector file
+    (GeoPackage, GeoJSON, Shapefile) may hold points or polygons.
+    """
+    if str(path).endswith('.csv'):
+        df = pd.read_csv(path)
+        facilities = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df['Longitude'], df['Latitude']),
+                                      crs='EPSG:4326')
+    else:
+        facilities = gpd.read_file(path).to_crs('EPSG:4326')
+    if id_column not in facilities:
+        facilities[id_column] = np.arange(len(facilities))
+    return facilities.set_index(id_column)
+
+
+def _coordinate_to_index(coords):
+    """Function mapping a coordinate to a fractional pixel index along a monotonic axis."""
+    index = np.arange(len(coords), dtype=np.float64)
+    if coords[-1] < coords[0]:
+        coords, index = coords[::-1], index[::-1]
+    # Linear extrapolation beyond the axis, so windows of facilities off the grid are clipped correctly
+    step = (coords[-1] - coords[0]) / (len(coords) - 1)
+    return lambda values: np.where((values < coords[0]) | (values > coords[-1]),
+                                   index[0] + (values - coords[0]) / step * np.sign(index[-1] - index[0]),
+                                   np.interp(values, coords, index))
+
+
+def to_pixel_geometries(geometries, lats, lons):
+    """Geometries in longitude/latitude converted to (col, row) pixel coordinates of the grid."""
+    col_of, row_of = _coordinate_to_index(np.asarray(lons)), _coordinate_to_index(np.asarray(lats))
+    return shapely.transform(np.asarray(geometries), lambda xy: np.column_stack([col_of(xy[:, 0]),
+                                                                                row_of(xy[:, 1])]))
+
+
+def group_windows(footprints, shape, margin):
+    """
+    Merge the windows of overlapping footprints into groups read and processed once.
+
+    Each footprint's window is its pixel bounding box grown by margin pixels.
+    Overlapping windows are found with an STRtree and merged transitively, and
+    each group is covered by the bounding window of its members.
+
+    Returns:
+    list: (row_start, row_stop, col_start, col_stop, member indices) per group, clipped to shape
+    """
+    bounds = shapely.bounds(footprints)
+    windows = shapely.box(bounds[:, 0] - margin, bounds[:, 1] - margin, bounds[:, 2] + margin, bounds[:, 3] + margin)
+    tree = shapely.STRtree(windows)
+    left, right = tree.query(windows, predicate='intersects')
+
+    # Union-find over the overlapping pairs
+    parent = np.arange(len(windows))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(left.tolist(), right.tolist()):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    roots = np.array([find(i) for i in range(len(windows))])
+    groups = []
+    for root in np.unique(roots):
+        members = np.flatnonzero(roots == root)
+        col_min, row_min = bounds[members, 0].min() - margin, bounds[members, 1].min() - margin
+        col_max, row_max = bounds[members, 2].max() + margin, bounds[members, 3].max() + margin
+        row_start, row_stop = max(0, int(np.floor(row_min))), min(shape[0], int(np.ceil(row_max)) + 1)
+        col_start, col_stop = max(0, int(np.floor(col_min))), min(shape[1], int(np.ceil(col_max)) + 1)
+        if row_start < row_stop and col_start < col_stop:
+            groups.append((row_start, row_stop, col_start, col_stop, members))
+    return groups
+
+
+def process_facilities(divergence, facilities, lats, lons, threshold=0.5, match_radius=5, half_window=10,
+                       min_distance=10):
+    """
+    Detect, fit and quantify the emission sources of many facilities on one shared grid.
+
+    Facility windows (footprint plus match_radius and the fit half_window) are
+    indexed and merged where they overlap, so every part of the raster is read
+    and fitted at most once. divergence may be an averaged (H, W) map or a
+    (T, H, W) stack such as a memory-mapped datacube variable, in which case
+    only the group windows are read and averaged. Each fitted peak is assigned
+    to the nearest facility within match_radius pixels of its footprint.
+
+    Args:
+    divergence: (H, W) or (T, H, W) array on the lats x lons grid
+    facilities (GeoDataFrame): Points or polygons in longitude/latitude, indexed by facility id
+    lats, lons (np.ndarray): Pixel centre coordinates of the rows and columns
+
+    Returns:
+    pd.DataFrame: One row per fitted peak with Facility, Latitude, Longitude and Emission Rate
+    """
+    shape = np.shape(divergence)[-2:]
+    pixel_area = grid_pixel_area(lats, lons)
+    footprints = to_pixel_geometries(facilities.geometry, lats, lons)
+    catchments = shapely.buffer(footprints, match_radius)
+    catchment_tree = shapely.STRtree(catchments)
+    ids = facilities.index.to_numpy()
+
+    rows = []
+    for row_start, row_stop, col_start, col_stop, _ in group_windows(footprints, shape, match_radius + half_window):
+        window = divergence[..., row_start:row_stop, col_start:col_stop]
+        if np.ndim(window) == 3:
+            window = StreamingAggregator().update_all(window).mean
+        # Pixels never valid carry no divergence signal, as in model.py
+        window = np.nan_to_num(window)
+
+        peaks = detect_and_fit_peaks_local_maxima(window, threshold, min_distance=min_distance,
+                                                  half_window=half_window)
+        for (row, col), emission_rate in quantify_emissions(peaks, pixel_area):
+            row, col = row + row_start, col + col_start
+            # Pixel centres are at integer (col, row) coordinates
+            peak = shapely.Point(col, row)
+            candidates = catchment_tree.query(peak, predicate='intersects')
+            if not len(candidates):
+                continue
+            nearest = candidates[np.argmin(shapely.distance(footprints[candidates], peak))]
+            rows.append((ids[nearest], lats[row], lons[col], emission_rate))
+
+    return pd.DataFrame(rows, columns=['Facility', 'Latitude', 'Longitude', 'Emission Rate'])
+
+
+def save_facility_reports(peaks_report, facilities, output_dir):
+    """
+    Save the per-peak report and a per-facility summary of total emission rate and peak count.
+
+    Facilities without any detected source are listed with a zero rate.
+    """
+    peaks_report.to_csv(os.path.join(output_dir, 'facility_peaks_report.csv'), index=False)
+    summary = peaks_report.groupby('Facility')['Emission Rate'].agg(['sum', 'size'])
+    summary = summary.reindex(facilities.index, fill_value=0)
+    summary.columns = ['Emission Rate', 'Peaks']
+    location = facilities.geometry.representative_point()
+    summary.insert(0, 'Latitude', location.y.to_numpy())
+    summary.insert(1, 'Longitude', location.x.to_numpy())
+    summary.index.name = 'Facility'
+    summary.to_csv(os.path.join(output_dir, 'facility_emissions_report.csv'))
+    return summary
+
+
+if __name__ == "__main__":
+    datacube_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/datacube"
+    facilities_path = "/home/cedric/repos/cassini_nitrogen_estimation/data/facilities.gpkg"
+    output_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/divergence_np"
+
+    lats = np.load("/home/cedric/repos/cassini_nitrogen_estimation/data/latitudes.npy")
+    lons = np.load("/home/cedric/repos/cassini_nitrogen_estimation/data/longitudes.npy")
+    facilities = read_facilities(facilities_path)
+
+    # Only the facility windows of the memory-mapped divergence stack are read
+    cube = Datacube(datacube_dir)
+    peaks_report = process_facilities(cube.array('divergence'), facilities, lats, lons)
+    summary = save_facility_reports(peaks_report, facilities, output_dir)
+    print(f"Reported {len(peaks_report)} sources for {len(summary)} facilities")
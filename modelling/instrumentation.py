@@ -0,0 +1,209 @@
+"""
+Per-stage timing and memory trace of the pipeline, written as JSON lines.
+
+Tracing is enabled by enable_trace(path), or by setting the MODELLING_TRACE
+environment variable, which worker processes inherit. Each traced stage appends
+one line with its wall and CPU time, bytes read and written by the process,
+sizes of the arrays it reported, the peak RSS of the process since it started
+(process_peak_rss) and how much the stage raised that peak (peak_rss_increase).
+A stage that stays below an earlier peak has no increase, whatever it allocates.
+Reads through memory maps are page faults rather than read calls, so they
+show up in the array sizes but not in bytes_read. CPU time and I/O counters
+are per process, so stages running concurrently in threads share them.
+
+Usage:
+    python instrumentation.py trace.jsonl
+"""
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+TRACE_ENV = 'MODELLING_TRACE'
+RUN_ENV = 'MODELLING_TRACE_RUN'
+
+_local = threading.local()
+
+
+def enable_trace(path, run_id=None):
+    """Append the trace of this process and its future workers to path."""
+    os.environ[TRACE_ENV] = str(path)
+    os.environ[RUN_ENV] = run_id or datetime.now().strftime('%Y%m%dT%H%M%S')
+
+
+def disable_trace():
+    os.environ.pop(TRACE_ENV, None)
+    os.environ.pop(RUN_ENV, None)
+
+
+def trace_path():
+    """Path of the trace, or None when tracing is disabled."""
+    return os.environ.get(TRACE_ENV) or None
+
+
+def _io_counters():
+    """Bytes read and written by this process so far, from /proc where available."""
+    try:
+        with open('/proc/self/io', 'rb') as f:
+            counters = dict(line.split(b':') for line in f.read().splitlines())
+        return int(counters[b'rchar']), int(counters[b'wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _peak_rss():
+    """
+    High-water mark of the resident set size of this process since it started, in bytes.
+
+    ru_maxrss is in kB on Linux and in bytes on macOS.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _write_event(path, event):
+    # One O_APPEND write per line, so lines of concurrent worker processes do not interleave
+    line = (json.dumps(event, default=str) + '\n').encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+class Span:
+    """Fields of one traced stage; arrays and extra fields can be added while it runs."""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.arrays = {}
+
+    def array(self, name, array):
+        """Record the shape, dtype and size of an array produced or consumed by the stage."""
+        array = np.asanyarray(array)
+        self.arrays[name] = {'shape': list(array.shape), 'dtype': array.dtype.str, 'nbytes': int(array.nbytes)}
+        return array
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+
+class _NullSpan:
+    """Span of a disabled trace; recording is a no-op."""
+
+    def array(self, name, array):
+        return array
+
+    def set(self, **fields):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    Trace the enclosed block as one stage.
+
+    Args:
+    name (str): Stage name, e.g. 'load', 'interpolate', 'divergence'
+    **fields: JSON-serializable context such as date or file
+
+    Yields:
+    Span: Call span.array(name, array) to record array sizes, span.set(...) for extra fields
+    """
+    path = trace_path()
+    if path is None:
+        yield _NULL_SPAN
+        return
+
+    stack = _local.__dict__.setdefault('stack', [])
+    span = Span(name, dict(fields))
+    parent = stack[-1].name if stack else None
+    stack.append(span)
+
+    read_start, written_start = _io_counters()
+    peak_rss_start = _peak_rss()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    error = None
+    try:
+        yield span
+    except BaseException as exc:
+        error = type(exc).__name__
+        raise
+    finally:
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        read_end, written_end = _io_counters()
+        peak_rss = _peak_rss()
+        stack.pop()
+
+        event = {
+            'run': os.environ.get(RUN_ENV),
+            'stage': name,
+            'parent': parent,
+            'pid': os.getpid(),
+            'start': time.time() - wall_time,
+            'wall_time': wall_time,
+            'cpu_time': cpu_time,
+            'bytes_read': None if read_start is None else read_end - read_start,
+            'bytes_written': None if written_start is None else written_end - written_start,
+            'array_bytes': sum(info['nbytes'] for info in span.arrays.values()),
+            'process_peak_rss': peak_rss,
+            'peak_rss_increase': peak_rss - peak_rss_start,
+            **span.fields,
+        }
+        if span.arrays:
+            event['arrays'] = span.arrays
+        if error is not None:
+            event['error'] = error
+        _write_event(path, event)
+
+
+def load_trace(path):
+    """Read a JSON-lines trace into a DataFrame, one row per stage event."""
+    with open(path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+
+def summarize_trace(path, run=None):
+    """
+    Totals per stage: call count, wall and CPU time, bytes read and written,
+    largest process peak RSS and largest peak RSS increase of one call.
+
+    Args:
+    path (str): Trace file
+    run (str): Run id to summarize, defaults to the last run in the trace
+    """
+    events = load_trace(path)
+    if events.empty:
+        return events
+    runs = events['run'].fillna('')
+    events = events[runs == (run or runs.iloc[-1])]
+    summary = events.groupby('stage').agg(
+        calls=('wall_time', 'size'),
+        wall_time=('wall_time', 'sum'),
+        cpu_time=('cpu_time', 'sum'),
+        bytes_read=('bytes_read', 'sum'),
+        bytes_written=('bytes_written', 'sum'),
+        array_bytes=('array_bytes', 'sum'),
+        process_peak_rss=('process_peak_rss', 'max'),
+        peak_rss_increase=('peak_rss_increase', 'max'),
+    )
+    return summary.sort_values('wall_time', ascending=False)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(summarize_trace(sys.argv[1]))
@@ -1,13 +1,248 @@
-import ee
+import hashlib
+import os
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Optional
+
 import geopandas as gpd
 import pandas as pd
-from shapely.ops import unary_union
-from pathlib import Path
-from utils import get_spatial_mean
 from pandas import DataFrame
+from shapely.geometry.base import BaseGeometry
+from shapely.ops import unary_union
 
 MODEL_NASA = "CNRM-ESM2-1"
 
+TIME_SERIES_COLUMNS = ["timestamp", "mean_daily"]
+
+
+class TimeSeriesBackend(ABC):
+    """Source of daily polygon means of one band of an image collection."""
+
+    @abstractmethod
+    def fetch(
+        self,
+        image_collection_id: str,
+        band: str,
+        polygon: BaseGeometry,
+        start_date: str,
+        end_date: str,
+    ) -> DataFrame:
+        """Daily means over [start_date, end_date), indexed by timestamp."""
+
+
+class EarthEngineBackend(TimeSeriesBackend):
+    """Google Earth Engine, initialized once and shared by all requests."""
+
+    def __init__(self):
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    def _initialize(self):
+        with self._lock:
+            if not self._initialized:
+                import ee
+
+                ee.Initialize()
+                self._initialized = True
+
+    def fetch(self, image_collection_id, band, polygon, start_date, end_date):
+        import ee
+        from utils import get_spatial_mean
+
+        self._initialize()
+        ee_water_basin_polygon = ee.Geometry.Polygon(list(polygon.exterior.coords))
+
+        image_collection = ee.ImageCollection(image_collection_id)
+
+        if image_collection_id == "NASA/GDDP-CMIP6":
+            filtered_collection = (
+                image_collection.filterBounds(ee_water_basin_polygon).filterDate(
+                    start_date, end_date
+                )
+            ).filter(ee.Filter.eq("model", MODEL_NASA))
+        else:
+            filtered_collection = image_collection.filterBounds(
+                ee_water_basin_polygon
+            ).filterDate(start_date, end_date)
+
+        daily_mean = filtered_collection.map(
+            lambda image: get_spatial_mean(image, ee_water_basin_polygon, band)
+        )
+
+        # Reduce the collections to lists
+        time_series = (
+            daily_mean.reduceColumns(
+                ee.Reducer.toList(2), ["system:time_start", "daily_mean_temp"]
+            )
+            .values()
+            .get(0)
+        )
+
+        # Get the results as a Python list.
+        values = time_series.getInfo()
+
+        df_time_series = pd.DataFrame(values, columns=TIME_SERIES_COLUMNS)
+        df_time_series["timestamp"] = pd.to_datetime(
+            df_time_series["timestamp"], unit="ms"
+        )
+        return df_time_series.set_index("timestamp")
+
+
+class LocalFileBackend(TimeSeriesBackend):
+    """
+    Stand-in for Earth Engine reading precomputed series from CSV files.
+
+    Each (collection, band) is read from <root>/<collection>/<band>.csv with
+    timestamp and mean_daily columns, where "/" in the collection id is
+    replaced by "_". The polygon is ignored.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def fetch(self, image_collection_id, band, polygon, start_date, end_date):
+        path = self.root / image_collection_id.replace("/", "_") / f"{band}.csv"
+        df_time_series = pd.read_csv(path, parse_dates=["timestamp"], index_col="timestamp")
+        in_range = (df_time_series.index >= pd.Timestamp(start_date)) & (
+            df_time_series.index < pd.Timestamp(end_date)
+        )
+        return df_time_series.loc[in_range, ["mean_daily"]]
+
+
+def load_polygon(polygon_location: Path) -> BaseGeometry:
+    """Union of the polygons of the first feature of a vector file."""
+    polygon_location = gpd.read_file(polygon_location)
+    polygon_location = polygon_location.geometry.to_list()[0]
+    return unary_union(polygon_location)
+
+
+def polygon_hash(polygon: BaseGeometry) -> str:
+    """Content hash of a polygon, independent of its vertex order and starting point."""
+    return hashlib.blake2b(polygon.normalize().wkb, digest_size=16).hexdigest()
+
+
+def date_chunks(start_date: str, end_date: str, freq: str = "YS") -> list:
+    """
+    Split [start_date, end_date) into chunks aligned on calendar periods.
+
+    Chunk boundaries do not depend on the requested range, so extending the
+    range reuses every cached chunk except the partial ones at its ends.
+    """
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    boundaries = [start, *pd.date_range(start, end, freq=freq, inclusive="neither"), end]
+    boundaries = sorted(set(boundaries))
+    return [
+        (lower.strftime("%Y-%m-%d"), upper.strftime("%Y-%m-%d"))
+        for lower, upper in zip(boundaries[:-1], boundaries[1:])
+    ]
+
+
+class TimeSeriesCache:
+    """
+    On-disk cache of fetched chunks, keyed by (collection, band, polygon hash, date chunk).
+
+    Chunks are stored as CSV under <root>/<collection>/<band>/<polygon hash>/,
+    written to a temporary file and renamed, so concurrent or interrupted runs
+    never leave a partial chunk behind.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def path(self, image_collection_id, band, polygon_key, chunk) -> Path:
+        return (
+            self.root
+            / image_collection_id.replace("/", "_")
+            / band
+            / polygon_key
+            / f"{chunk[0]}_{chunk[1]}.csv"
+        )
+
+    def get(self, image_collection_id, band, polygon_key, chunk) -> Optional[DataFrame]:
+        path = self.path(image_collection_id, band, polygon_key, chunk)
+        if not path.exists():
+            return None
+        return pd.read_csv(path, parse_dates=["timestamp"], index_col="timestamp")
+
+    def put(self, image_collection_id, band, polygon_key, chunk, df_time_series):
+        path = self.path(image_collection_id, band, polygon_key, chunk)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".csv", dir=path.parent)
+        os.close(fd)
+        try:
+            df_time_series.to_csv(tmp_path, index_label="timestamp")
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+def generate_time_series_batch(
+    requests: Iterable[tuple],
+    polygon_location: Path,
+    start_date: str,
+    end_date: str,
+    backend: Optional[TimeSeriesBackend] = None,
+    cache_dir: Optional[Path] = None,
+    chunk_freq: str = "YS",
+    max_workers: int = 8,
+) -> dict:
+    """
+    Fetch the daily polygon means of several (collection, band) pairs concurrently.
+
+    The date range is split into calendar-aligned chunks, and every missing
+    (band, chunk) is fetched in a bounded thread pool. With a cache directory,
+    chunks fetched before are read from disk, so re-running a basin or
+    extending its date range only fetches the missing chunks.
+
+    Args:
+    requests: (image_collection_id, band) pairs
+    polygon_location (Path): Vector file of the basin
+    start_date, end_date (str): Date range, end excluded
+    backend (TimeSeriesBackend): Defaults to Earth Engine
+    cache_dir (Path): Optional cache directory
+    chunk_freq (str): pandas frequency of the chunk boundaries, e.g. "YS" or "MS"
+    max_workers (int): Maximum number of concurrent requests
+
+    Returns:
+    dict: (image_collection_id, band) to DataFrame of mean_daily indexed by timestamp
+    """
+    backend = backend or EarthEngineBackend()
+    cache = TimeSeriesCache(cache_dir) if cache_dir is not None else None
+    polygon = load_polygon(polygon_location)
+    polygon_key = polygon_hash(polygon)
+    requests = list(requests)
+    chunks = date_chunks(start_date, end_date, chunk_freq)
+
+    pieces = {}
+    missing = []
+    for request in requests:
+        for chunk in chunks:
+            cached = cache.get(*request, polygon_key, chunk) if cache else None
+            if cached is None:
+                missing.append((request, chunk))
+            else:
+                pieces[request, chunk] = cached
+
+    def fetch(task):
+        (image_collection_id, band), chunk = task
+        df_time_series = backend.fetch(image_collection_id, band, polygon, *chunk)
+        if cache:
+            cache.put(image_collection_id, band, polygon_key, chunk, df_time_series)
+        return df_time_series
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for task, df_time_series in zip(missing, pool.map(fetch, missing)):
+            pieces[task] = df_time_series
+
+    return {
+        request: pd.concat([pieces[request, chunk] for chunk in chunks]).sort_index()
+        for request in requests
+    }
+
 
 def generate_time_series(
     image_collection_id: str,
@@ -15,86 +250,39 @@ def generate_time_series(
     polygon_location: Path,
     start_date: str,
     end_date: str,
+    backend: Optional[TimeSeriesBackend] = None,
+    cache_dir: Optional[Path] = None,
 ) -> DataFrame:
-    # Initialize the Earth Engine API.
-    ee.Initialize()
+    """Daily polygon means of one band, see generate_time_series_batch."""
+    request = (image_collection_id, band)
+    return generate_time_series_batch(
+        [request], polygon_location, start_date, end_date, backend, cache_dir
+    )[request]
 
-    polygon_location = gpd.read_file(polygon_location)
-    polygon_location = polygon_location.geometry.to_list()[0]
-    merged_polygon = unary_union(polygon_location)
-    coords_water_basin = list(merged_polygon.exterior.coords)
 
-    ee_water_basin_polygon = ee.Geometry.Polygon(coords_water_basin)
+if __name__ == "__main__":
+    path_water_basin = Path("/home/cedric/repos/cassini_data/villeret_water_basin.gpkg")
+    cache_dir = Path("/home/cedric/repos/cassini_data/time_series_cache")
 
-    image_collection = ee.ImageCollection(image_collection_id)
-
-    if image_collection_id == "NASA/GDDP-CMIP6":
-        filtered_collection = (
-            image_collection.filterBounds(ee_water_basin_polygon).filterDate(
-                start_date, end_date
-            )
-        ).filter(ee.Filter.eq("model", MODEL_NASA))
-    else:
-        filtered_collection = image_collection.filterBounds(
-            ee_water_basin_polygon
-        ).filterDate(start_date, end_date)
-
-    daily_mean = filtered_collection.map(
-        lambda image: get_spatial_mean(image, ee_water_basin_polygon, band)
+    # All bands and yearly chunks are requested concurrently with one Earth Engine session
+    time_series = generate_time_series_batch(
+        [
+            ("NASA/GDDP-CMIP6", "pr"),
+            ("NASA/GDDP-CMIP6", "tas"),
+            ("ECMWF/ERA5_LAND/DAILY_AGGR", "potential_evaporation_sum"),
+        ],
+        path_water_basin,
+        "2000-01-01",
+        "2001-01-01",
+        cache_dir=cache_dir,
     )
 
-    # Reduce the collections to lists
-    time_series = (
-        daily_mean.reduceColumns(
-            ee.Reducer.toList(2), ["system:time_start", "daily_mean_temp"]
-        )
-        .values()
-        .get(0)
+    time_series["NASA/GDDP-CMIP6", "pr"].to_csv(
+        "/home/cedric/repos/cassini_data/precipitation_time_series.csv"
+    )
+    time_series["NASA/GDDP-CMIP6", "tas"].to_csv(
+        "/home/cedric/repos/cassini_data/temperature_time_series.csv"
+    )
+    time_series["ECMWF/ERA5_LAND/DAILY_AGGR", "potential_evaporation_sum"].to_csv(
+        "/home/cedric/repos/cassini_data/evapotranspiration_time_series.csv"
     )
-
-    # Get the results as a Python list.
-    values = time_series.getInfo()
-
-    df_time_series = pd.DataFrame(values, columns=["timestamp", "mean_daily"])
-    df_time_series["timestamp"] = pd.to_datetime(df_time_series["timestamp"], unit="ms")
-    df_time_series.set_index("timestamp", inplace=True)
-
-    return df_time_series
-
-
-path_water_basin = Path("/home/cedric/repos/cassini_data/villeret_water_basin.gpkg")
-
-precipitation_time_series = generate_time_series(
-    "NASA/GDDP-CMIP6",
-    "pr",
-    path_water_basin,
-    "2000-01-01",
-    "2001-01-01",
-)
-
-temperature_time_series = generate_time_series(
-    "NASA/GDDP-CMIP6",
-    "tas",
-    path_water_basin,
-    "2000-01-01",
-    "2001-01-01",
-)
-
-
-evapotranspiration_time_series = generate_time_series(
-    "ECMWF/ERA5_LAND/DAILY_AGGR",
-    "potential_evaporation_sum",
-    path_water_basin,
-    "2000-01-01",
-    "2001-01-01",
-)
-
-precipitation_time_series.to_csv(
-    "/home/cedric/repos/cassini_data/precipitation_time_series.csv"
-)
-temperature_time_series.to_csv(
-    "/home/cedric/repos/cassini_data/temperature_time_series.csv"
-)
-evapotranspiration_time_series.to_csv(
-    "/home/cedric/repos/cassini_data/evapotranspiration_time_series.csv"
-)
\ No newline at end of file
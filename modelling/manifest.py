@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+
+def _hasher():
+    return hashlib.blake2b(digest_size=16)
+
+
+def hash_array(array):
+    """Content hash of an array, including its dtype and shape."""
+    array = np.ascontiguousarray(array)
+    hasher = _hasher()
+    hasher.update(f'{array.dtype.str}{array.shape}'.encode())
+    hasher.update(array.view(np.uint8).reshape(-1) if array.size else b'')
+    return hasher.hexdigest()
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """Content hash of a file, read in chunks."""
+    hasher = _hasher()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class StageManifest:
+    """
+    Record of which (stage, key) outputs were produced from which inputs and parameters.
+
+    Each entry stores a fingerprint of the inputs and parameters, the output
+    paths and optionally a fingerprint of the outputs, so downstream stages can
+    chain on it without re-reading the data. A stage only needs to rerun for
+    keys whose fingerprint changed or whose outputs disappeared.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.files = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                content = json.load(f)
+            self.entries = content.get('entries', {})
+            self.files = content.get('files', {})
+
+    def file_fingerprint(self, path):
+        """Content hash of a file, only recomputed when its size or mtime changed."""
+        stat = os.stat(path)
+        cached = self.files.get(path)
+        if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['hash']
+        digest = hash_file(path)
+        self.files[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest}
+        return digest
+
+    @staticmethod
+    def fingerprint(inputs=(), params=None):
+        """Combine input hashes and JSON-serializable parameters into one fingerprint."""
+        hasher = _hasher()
+        hasher.update(json.dumps([list(inputs), params], sort_keys=True, default=str).encode())
+        return hasher.hexdigest()
+
+    def is_current(self, stage, key, fingerprint):
+        """True when (stage, key) was produced with this fingerprint and its outputs still exist."""
+        entry = self.entries.get(stage, {}).get(str(key))
+        return (entry is not None and entry['fingerprint'] == fingerprint
+                and all(os.path.exists(path) for path in entry['outputs']))
+
+    def record(self, stage, key, fingerprint, outputs=(), output_fingerprint=None):
+        """Record that (stage, key) was produced, and with what."""
+        self.entries.setdefault(stage, {})[str(key)] = {
+            'fingerprint': fingerprint,
+            'outputs': [str(path) for path in outputs],
+            'output_fingerprint': output_fingerprint,
+        }
+
+    def output_fingerprint(self, stage, key):
+        """Fingerprint of the outputs of (stage, key), or None if unknown."""
+        entry = self.entries.get(stage, {}).get(str(key))
+        return entry and entry['output_fingerprint']
+
+    def outputs(self, stage, key):
+        """Output paths recorded for (stage, key)."""
+        return self.entries[stage][str(key)]['outputs']
+
+    def save(self):
+        """Write the manifest atomically, so an interrupted run keeps the previous one."""
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'entries': self.entries, 'files': self.files}, f)
+        os.replace(tmp_path, self.path)
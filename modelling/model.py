@@ -1,91 +1,282 @@
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
-from scipy import ndimage
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from scipy import ndimage, optimize
+from aggregation import StreamingAggregator
+from datacube import Datacube
+from export import export_maps
+from instrumentation import enable_trace, stage
+from manifest import StageManifest, hash_array
 
-def load_numpy_arrays(directory):
+
+def gaussian_2d(xy, amplitude, x0, y0, sigma_x, sigma_y, theta, offset):
+    """2D Gaussian function."""
+    x, y = xy
+    a = (np.cos(theta) ** 2) / (2 * sigma_x ** 2) + (np.sin(theta) ** 2) / (2 * sigma_y ** 2)
+    b = -(np.sin(2 * theta)) / (4 * sigma_x ** 2) + (np.sin(2 * theta)) / (4 * sigma_y ** 2)
+    c = (np.sin(theta) ** 2) / (2 * sigma_x ** 2) + (np.cos(theta) ** 2) / (2 * sigma_y ** 2)
+    return amplitude * np.exp(-(a * (x - x0) ** 2 + 2 * b * (x - x0) * (y - y0) + c * (y - y0) ** 2)) + offset
+
+
+def gaussian_2d_jacobian(xy, amplitude, x0, y0, sigma_x, sigma_y, theta, offset, axis=-1):
+    """Analytic Jacobian of gaussian_2d, with the 7 parameter derivatives stacked along axis."""
+    x, y = xy
+    cos_t, sin_t = np.cos(theta), np.sin(theta)
+    sin_2t, cos_2t = np.sin(2 * theta), np.cos(2 * theta)
+    a = cos_t ** 2 / (2 * sigma_x ** 2) + sin_t ** 2 / (2 * sigma_y ** 2)
+    b = -sin_2t / (4 * sigma_x ** 2) + sin_2t / (4 * sigma_y ** 2)
+    c = sin_t ** 2 / (2 * sigma_x ** 2) + cos_t ** 2 / (2 * sigma_y ** 2)
+
+    dx, dy = x - x0, y - y0
+    dx2, dxdy, dy2 = dx * dx, dx * dy, dy * dy
+    g = np.exp(-(a * dx2 + 2 * b * dxdy + c * dy2))
+    ag = amplitude * g
+
+    # Partial derivatives of the quadratic form coefficients
+    sx3, sy3 = sigma_x ** 3, sigma_y ** 3
+    d_sigma_x = -cos_t ** 2 / sx3 * dx2 + sin_2t / sx3 * dxdy - sin_t ** 2 / sx3 * dy2
+    d_sigma_y = -sin_t ** 2 / sy3 * dx2 - sin_2t / sy3 * dxdy - cos_t ** 2 / sy3 * dy2
+    inv_diff = 1 / (2 * sigma_y ** 2) - 1 / (2 * sigma_x ** 2)
+    d_theta = sin_2t * inv_diff * dx2 + 2 * cos_2t * inv_diff * dxdy - sin_2t * inv_diff * dy2
+
+    return np.stack([
+        g,
+        ag * (2 * a * dx + 2 * b * dy),
+        ag * (2 * b * dx + 2 * c * dy),
+        -ag * d_sigma_x,
+        -ag * d_sigma_y,
+        -ag * d_theta,
+        np.ones_like(g),
+    ], axis=axis)
+
+
+def initial_gaussian_guess(data):
+    """Starting parameters for a Gaussian fit, with x0 as column and y0 as row; NaN pixels are ignored."""
+    amplitude = np.nanmax(data)
+    y0, x0 = np.unravel_index(np.nanargmax(data), data.shape)
+    ratio = np.nansum(data) / amplitude if amplitude > 0 else 0
+    sigma = np.sqrt(ratio) / 2 if np.isfinite(ratio) and ratio > 0 else 1.0
+    return np.array([amplitude, x0, y0, sigma, sigma, 0, 0], dtype=np.float64)
+
+
+def fit_gaussian_2d_analytic(data, max_nfev=100, ftol=1e-8, xtol=1e-8):
     """
-    Load all NumPy arrays from .npy files in the specified directory.
+    Fit a 2D Gaussian using the analytic Jacobian and bounded parameters.
+
+    Sigmas are fitted in log space so they stay positive, and theta is wrapped
+    into [-pi/2, pi/2) since the Gaussian is periodic in theta with period pi.
+    This keeps the problem unconstrained, so the Levenberg-Marquardt solver can
+    be used. Per fit this is about as fast as curve_fit, since the time goes to
+    Python overhead rather than Jacobian evaluations; fit_gaussian_2d_batch is
+    the fast path for many windows.
 
-    Args:
-    directory (str): Path to the directory containing .npy files
+    NaN pixels are left out of the fit. A window with fewer valid pixels than
+    parameters, or a fit whose centre leaves the window or whose sigmas exceed
+    the window size, is reported as not converged, with NaN parameters when no
+    fit was attempted. The fit does not raise on bad windows or an exhausted budget.
 
     Returns:
-    tuple: List of numpy arrays, List of dates
+    tuple: fitted parameters, dict with 'converged', 'status', 'nfev', 'cost' and 'elapsed' (s)
     """
-    npy_files = sorted([f for f in os.listdir(directory) if f.endswith('.npy')])
-    data_list = []
-    date_list = []
+    start = time.perf_counter()
+    height, width = data.shape
+    valid = np.isfinite(data).ravel()
+    if valid.sum() < 7:
+        info = {'converged': False, 'status': 0, 'nfev': 0, 'cost': np.nan, 'elapsed': time.perf_counter() - start}
+        return np.full(7, np.nan), info
+    x, y = np.meshgrid(np.arange(width), np.arange(height))
+    xy = (x.ravel()[valid].astype(np.float64), y.ravel()[valid].astype(np.float64))
+    values = data.ravel()[valid].astype(np.float64)
+
+    def to_params(q):
+        return np.concatenate([q[:3], np.exp(q[3:5]), q[5:]])
+
+    def residuals(q):
+        return gaussian_2d(xy, *to_params(q)) - values
+
+    def jacobian(q):
+        params = to_params(q)
+        jac = gaussian_2d_jacobian(xy, *params)
+        # Chain rule for sigma = exp(log_sigma)
+        jac[:, 3:5] *= params[3:5]
+        return jac
+
+    q0 = initial_gaussian_guess(data)
+    q0[3:5] = np.log(q0[3:5])
+    result = optimize.least_squares(residuals, q0, jac=jacobian, method='lm',
+                                    max_nfev=max_nfev, ftol=ftol, xtol=xtol)
+
+    popt = to_params(result.x)
+    popt[5] = (popt[5] + np.pi / 2) % np.pi - np.pi / 2
+    in_bounds = (-0.5 <= popt[1] <= width - 0.5 and -0.5 <= popt[2] <= height - 0.5
+                 and max(popt[3], popt[4]) <= max(height, width))
+
+    info = {
+        'converged': bool(result.success and result.status > 0 and in_bounds and np.isfinite(popt).all()),
+        'status': int(result.status),
+        'nfev': int(result.nfev),
+        'cost': float(result.cost),
+        'elapsed': time.perf_counter() - start,
+    }
+    return popt, info
+
+
+def fit_gaussian_2d_batch(windows, max_iter=50, ftol=1e-8, xtol=1e-8, gtol=1e-12):
+    """
+    Fit a 2D Gaussian to each window of an (N, h, w) stack at once.
 
-    for file in npy_files:
-        file_path = os.path.join(directory, file)
-        array = np.load(file_path)
+    Runs Levenberg-Marquardt steps for all windows together in NumPy, with the
+    same log-sigma parametrization as fit_gaussian_2d_analytic. NaN pixels are
+    ignored, so windows padded at the map border can be fitted as well.
 
-        # Extract date from filename (assuming format 'data_YYYY-MM-DD.npy')
-        date_str = file.split('_')[-1].split('.')[0]
-        date = datetime.strptime(date_str, '%Y-%m-%d').date()
+    Returns:
+    tuple: (N, 7) fitted parameters, (N,) boolean convergence flags
+    """
+    windows = np.asarray(windows, dtype=np.float64)
+    n_windows, height, width = windows.shape
+    valid = np.isfinite(windows)
+    weights = valid.reshape(n_windows, -1).astype(np.float64)
+    values = np.where(valid, windows, 0).reshape(n_windows, -1)
+    y, x = np.mgrid[:height, :width]
+    xy = (x.ravel()[None, :].astype(np.float64), y.ravel()[None, :].astype(np.float64))
+
+    # Vectorized version of initial_gaussian_guess
+    flat = np.where(valid, windows, -np.inf).reshape(n_windows, -1)
+    argmax = flat.argmax(axis=1)
+    amplitude = flat[np.arange(n_windows), argmax]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma = np.sqrt(values.sum(axis=1) / amplitude) / 2
+    sigma = np.where(np.isfinite(sigma) & (sigma > 0) & (amplitude > 0), sigma, 1.0)
+    q = np.column_stack([np.where(np.isfinite(amplitude), amplitude, 0), argmax % width, argmax // width,
+                         np.log(sigma), np.log(sigma), np.zeros(n_windows), np.zeros(n_windows)])
+
+    def to_params(q):
+        return np.concatenate([q[:, :3], np.exp(q[:, 3:5]), q[:, 5:]], axis=1)
+
+    def residuals(q, rows):
+        params = to_params(q).T[:, :, None]
+        return (gaussian_2d(xy, *params) - values[rows]) * weights[rows]
+
+    resid = residuals(q, slice(None))
+    cost = 0.5 * np.sum(resid ** 2, axis=1)
+    damping = np.full(n_windows, 1e-3)
+    converged = np.zeros(n_windows, dtype=bool)
+    active = np.isfinite(amplitude)
+    diagonal = np.arange(7)
+
+    for _ in range(max_iter):
+        rows = np.flatnonzero(active)
+        if rows.size == 0:
+            break
 
-        data_list.append(array)
-        date_list.append(date)
+        q_active = q[rows]
+        params = to_params(q_active)
+        # Jacobian transposed to (n, 7, M), so J^T J is a single batched matmul
+        jac_t = gaussian_2d_jacobian(xy, *params.T[:, :, None], axis=1)
+        jac_t[:, 3:5] *= params[:, 3:5, None]
+        jac_t *= weights[rows, None, :]
+
+        jtj = jac_t @ jac_t.swapaxes(1, 2)
+        gradient = (jac_t @ resid[rows, :, None])[..., 0]
+        system = jtj.copy()
+        system[:, diagonal, diagonal] += damping[rows, None] * jtj[:, diagonal, diagonal] + 1e-12
+        try:
+            step = -np.linalg.solve(system, gradient[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = -np.einsum('nij,nj->ni', np.linalg.pinv(system), gradient)
+
+        q_new = q_active + step
+        resid_new = residuals(q_new, rows)
+        cost_new = 0.5 * np.sum(resid_new ** 2, axis=1)
+        improved = np.isfinite(cost_new) & (cost_new < cost[rows])
+
+        small_cost = improved & (cost[rows] - cost_new <= ftol * cost[rows])
+        small_step = improved & (np.linalg.norm(step, axis=1)
+                                 <= xtol * (np.linalg.norm(q_active, axis=1) + xtol))
+        small_gradient = np.abs(gradient).max(axis=1) <= gtol
+
+        q[rows[improved]] = q_new[improved]
+        resid[rows[improved]] = resid_new[improved]
+        cost[rows[improved]] = cost_new[improved]
+        damping[rows] = np.clip(np.where(improved, damping[rows] / 10, damping[rows] * 10), 1e-12, 1e12)
+
+        done = small_cost | small_step | small_gradient
+        converged[rows[done]] = True
+        # Windows whose damping saturated are stuck and stop without converging
+        active[rows[done | (damping[rows] >= 1e12)]] = False
+
+    popt = to_params(q)
+    popt[:, 5] = (popt[:, 5] + np.pi / 2) % np.pi - np.pi / 2
+    in_bounds = ((popt[:, 1] >= -0.5) & (popt[:, 1] <= width - 0.5)
+                 & (popt[:, 2] >= -0.5) & (popt[:, 2] <= height - 0.5)
+                 & (popt[:, 3:5].max(axis=1) <= max(height, width)))
+    converged &= in_bounds & np.isfinite(popt).all(axis=1)
+    return popt, converged
+
+
+def fit_peak_windows(divergence_map, peak_positions, half_window=10, **kwargs):
+    """
+    Batch-fit Gaussians around many peak positions of a map.
 
-    return data_list, date_list
+    Windows are centred on each (row, col) position and padded with NaN at the
+    map border. Fitted parameters are relative to the window origin
+    (row - half_window, col - half_window).
 
+    Returns:
+    tuple: list of (peak_pos, popt) for converged fits, as used by quantify_emissions,
+           (N,) boolean convergence flags
+    """
+    positions = np.asarray(peak_positions, dtype=np.int64).reshape(-1, 2)
+    padded = np.pad(divergence_map.astype(np.float64), half_window, constant_values=np.nan)
+    offsets = np.arange(2 * half_window + 1)
+    rows = positions[:, 0, None] + offsets
+    cols = positions[:, 1, None] + offsets
+    windows = padded[rows[:, :, None], cols[:, None, :]]
 
-def gaussian_2d(xy, amplitude, x0, y0, sigma_x, sigma_y, theta, offset):
-    """2D Gaussian function."""
-    x, y = xy
-    a = (np.cos(theta) ** 2) / (2 * sigma_x ** 2) + (np.sin(theta) ** 2) / (2 * sigma_y ** 2)
-    b = -(np.sin(2 * theta)) / (4 * sigma_x ** 2) + (np.sin(2 * theta)) / (4 * sigma_y ** 2)
-    c = (np.sin(theta) ** 2) / (2 * sigma_x ** 2) + (np.cos(theta) ** 2) / (2 * sigma_y ** 2)
-    return amplitude * np.exp(-(a * (x - x0) ** 2 + 2 * b * (x - x0) * (y - y0) + c * (y - y0) ** 2)) + offset
+    popt, converged = fit_gaussian_2d_batch(windows, **kwargs)
+    peaks = [(tuple(pos), params) for pos, params, ok in zip(positions.tolist(), popt, converged) if ok]
+    return peaks, converged
 
 
-def fit_gaussian_2d(data):
-    """Fit a 2D Gaussian to the data."""
-    height, width = data.shape
-    x, y = np.meshgrid(np.arange(width), np.arange(height))
-    xy = np.vstack((x.ravel(), y.ravel()))
+def grid_pixel_area(lats, lons):
+    """Area of one pixel of a regular lats x lons grid, in m^2, whatever the axis orientation."""
+    return abs((lats[1] - lats[0]) * (lons[1] - lons[0])) * 111000 * 111000
 
-    # Initial guess for parameters
-    amplitude = data.max()
-    x0, y0 = np.unravel_index(data.argmax(), data.shape)
-    sigma_x = sigma_y = np.sqrt(data.sum() / amplitude) / 2
 
-    popt, _ = optimize.curve_fit(gaussian_2d, xy, data.ravel(),
-                                 p0=[amplitude, x0, y0, sigma_x, sigma_y, 0, 0])
-    return popt
+def gaussian_emission_rate(popt, pixel_area):
+    """Emission rate of fitted Gaussian parameters, for one (7,) or many (..., 7) fits."""
+    popt = np.asarray(popt)
+    # Emission rate proportional to amplitude and area of the Gaussian
+    return popt[..., 0] * 2 * np.pi * popt[..., 3] * popt[..., 4] * pixel_area
 
 
 def quantify_emissions(peaks, pixel_area):
     """Convert fitted peaks to emission rates."""
-    emissions = []
-    for peak_pos, popt in peaks:
-        amplitude, _, _, sigma_x, sigma_y, _, _ = popt
-        # Emission rate proportional to amplitude and area of the Gaussian
-        emission_rate = amplitude * 2 * np.pi * sigma_x * sigma_y * pixel_area
-        emissions.append((peak_pos, emission_rate))
-    return emissions
+    return [(peak_pos, gaussian_emission_rate(popt, pixel_area)) for peak_pos, popt in peaks]
 
 
 def visualize_results(divergence_map, emissions, lats, lons, output_dir):
-    """Create a map of divergence with identified point sources."""
-    plt.figure(figsize=(12, 8))
-    m = Basemap(projection='mill', llcrnrlat=lats.min(), urcrnrlat=lats.max(),
-                llcrnrlon=lons.min(), urcrnrlon=lons.max(), resolution='l')
+    """
+    Create a quick-look map of divergence with identified point sources.
 
-    x, y = m(*np.meshgrid(lons, lats))
-    m.pcolormesh(x, y, divergence_map, cmap='RdYlBu_r', shading='auto')
+    Georeferenced COGs and web tiles of the same map are written by export.export_maps.
+    """
+    plt.figure(figsize=(12, 8))
+    extent = (lons.min(), lons.max(), lats.min(), lats.max())
+    origin = 'lower' if lats[-1] > lats[0] else 'upper'
+    plt.imshow(divergence_map, cmap='RdYlBu_r', extent=extent, origin=origin, interpolation='nearest')
 
     for (y, x), emission_rate in emissions:
-        m.plot(lons[x], lats[y], 'ko', markersize=5)
+        plt.plot(lons[x], lats[y], 'ko', markersize=5)
         plt.text(lons[x], lats[y], f'{emission_rate:.2f}', fontsize=8)
 
-    m.drawcoastlines()
-    m.drawcountries()
     plt.colorbar(label='Divergence')
+    plt.xlabel('Longitude')
+    plt.ylabel('Latitude')
     plt.title('NOx Emissions from Point Sources')
 
     plt.savefig(os.path.join(output_dir, 'nox_emissions_map.png'))
@@ -101,30 +292,113 @@ def save_emissions_report(emissions, lats, lons, output_dir):
     df.to_csv(os.path.join(output_dir, 'nox_emissions_report.csv'), index=False)
 
 
-def detect_and_fit_peaks(divergence_map, threshold=0.5, max_peaks=10):
-    """Detect peaks in the divergence map and fit Gaussians."""
-    peaks = []
-    remaining_map = divergence_map.copy()
+def find_local_maxima(divergence_map, threshold=0.5, min_distance=10):
+    """
+    Find all candidate peaks in one pass with a maximum filter.
 
-    for _ in range(max_peaks):
-        if remaining_map.max() < threshold:
-            break
+    Returns (row, col) positions of local maxima above threshold that are the
+    largest value within min_distance pixels, sorted by decreasing value.
+    """
+    filtered = ndimage.maximum_filter(divergence_map, size=2 * min_distance + 1, mode='nearest')
+    rows, cols = np.nonzero((divergence_map == filtered) & (divergence_map >= threshold))
+    order = np.argsort(-divergence_map[rows, cols], kind='stable')
+    return list(zip(rows[order].tolist(), cols[order].tolist()))
+
+
+def schedule_fit_rounds(peak_positions, half_window=10):
+    """Greedily group peaks into rounds whose fit windows do not overlap."""
+    rounds = []
+    for pos in peak_positions:
+        for round_positions in rounds:
+            if all(max(abs(pos[0] - other[0]), abs(pos[1] - other[1])) > 2 * half_window
+                   for other in round_positions):
+                round_positions.append(pos)
+                break
+        else:
+            rounds.append([pos])
+    return rounds
+
+
+def subtract_gaussian_window(remaining_map, popt, row0, col0, n_sigma=3):
+    """
+    Subtract a fitted Gaussian from the map, in place, inside its support window only.
 
-        peak_pos = np.unravel_index(remaining_map.argmax(), remaining_map.shape)
-        peak_region = remaining_map[max(0, peak_pos[0] - 10):peak_pos[0] + 11,
-                      max(0, peak_pos[1] - 10):peak_pos[1] + 11]
+    popt is expressed in the coordinates of the fit window starting at (row0, col0).
+    Only the Gaussian is removed, not the fitted background offset.
+    """
+    amplitude, x0, y0, sigma_x, sigma_y, theta, _ = popt
+    center_row, center_col = row0 + y0, col0 + x0
+    radius = n_sigma * max(abs(sigma_x), abs(sigma_y))
+    if not np.isfinite([center_row, center_col, radius]).all():
+        return
 
-        try:
-            popt = fit_gaussian_2d(peak_region)
-            peaks.append((peak_pos, popt))
+    height, width = remaining_map.shape
+    r_start = max(0, int(np.floor(center_row - radius)))
+    r_stop = min(height, int(np.ceil(center_row + radius)) + 1)
+    c_start = max(0, int(np.floor(center_col - radius)))
+    c_stop = min(width, int(np.ceil(center_col + radius)) + 1)
+    if r_start >= r_stop or c_start >= c_stop:
+        return
+
+    y, x = np.ogrid[r_start - row0:r_stop - row0, c_start - col0:c_stop - col0]
+    window = remaining_map[r_start:r_stop, c_start:c_stop]
+    window -= gaussian_2d((x, y), amplitude, x0, y0, sigma_x, sigma_y, theta, 0)
+    np.maximum(window, 0, out=window)
+
+
+def _fit_peak_window(window):
+    """Fit a Gaussian to one peak window, returning None parameters when the fit did not converge."""
+    popt, info = fit_gaussian_2d_analytic(window)
+    if not info['converged']:
+        return None, info
+    return popt, info
+
+
+# Fewest windows of a fitting round worth spreading over a process pool; a fit takes a few ms,
+# starting the pool and pickling windows costs about as much as fitting tens of them
+POOL_MIN_WINDOWS = 64
+
+
+def detect_and_fit_peaks_local_maxima(divergence_map, threshold=0.5, max_peaks=None, min_distance=10,
+                                      half_window=10, n_sigma=3, workers=1, fit_info=None):
+    """
+    Detect all peaks at once with a maximum filter and fit Gaussians.
 
-            # Remove fitted peak from the map
-            y, x = np.ogrid[-peak_pos[0]:divergence_map.shape[0] - peak_pos[0],
-                   -peak_pos[1]:divergence_map.shape[1] - peak_pos[1]]
-            remaining_map -= gaussian_2d((x, y), *popt)
-            remaining_map = np.maximum(remaining_map, 0)
-        except RuntimeError:
-            print(f"Failed to fit Gaussian at position {peak_pos}")
+    Candidates are fitted in rounds of non-overlapping windows. With workers > 1,
+    rounds of at least POOL_MIN_WINDOWS windows are spread over a process pool,
+    started on the first such round. After a round, every fitted Gaussian
+    is subtracted inside its n_sigma support window only. If fit_info is a list,
+    the timing and convergence info of every fit is appended to it.
+    """
+    peaks = []
+    remaining_map = divergence_map.astype(np.float64)
+    candidates = find_local_maxima(divergence_map, threshold, min_distance)[:max_peaks]
+
+    pool = None
+    try:
+        for round_positions in schedule_fit_rounds(candidates, half_window):
+            # Earlier rounds may have explained a candidate away
+            round_positions = [pos for pos in round_positions if remaining_map[pos] >= threshold]
+            origins = [(max(0, row - half_window), max(0, col - half_window)) for row, col in round_positions]
+            windows = [remaining_map[row0:row + half_window + 1, col0:col + half_window + 1].copy()
+                       for (row, col), (row0, col0) in zip(round_positions, origins)]
+
+            if workers > 1 and len(windows) >= POOL_MIN_WINDOWS:
+                pool = pool or ProcessPoolExecutor(max_workers=workers)
+                fits = pool.map(_fit_peak_window, windows)
+            else:
+                fits = map(_fit_peak_window, windows)
+            for peak_pos, (row0, col0), (popt, info) in zip(round_positions, origins, fits):
+                if fit_info is not None:
+                    fit_info.append(dict(info, position=peak_pos))
+                if popt is None:
+                    print(f"Failed to fit Gaussian at position {peak_pos}")
+                    continue
+                peaks.append((peak_pos, popt))
+                subtract_gaussian_window(remaining_map, popt, row0, col0, n_sigma)
+    finally:
+        if pool:
+            pool.shutdown()
 
     return peaks
 
@@ -141,9 +415,60 @@ def calculate_divergence(flux_u, flux_v):
     dv_dy = ndimage.sobel(flux_v, axis=0)
     return du_dx + dv_dy
 
-def temporal_average(data_list):
-    """Calculate temporal average of a list of arrays."""
-    return np.mean(data_list, axis=0)
+def calculate_flux_stack(no2, u_wind, v_wind, flux_u=None, flux_v=None, missing=None):
+    """
+    Calculate NOx flux for a whole (T, H, W) stack at once.
+
+    Results are written into flux_u and flux_v when given, so buffers can be
+    reused across batches. Pass float32 buffers to run in single precision.
+    With a boolean missing mask, the flux of missing pixels is set to zero in
+    place, so it stays finite for the Sobel passes.
+    """
+    flux_u = np.multiply(no2, u_wind, out=flux_u)
+    flux_v = np.multiply(no2, v_wind, out=flux_v)
+    if missing is not None:
+        np.copyto(flux_u, 0, where=missing)
+        np.copyto(flux_v, 0, where=missing)
+    return flux_u, flux_v
+
+
+# Pixels a tile needs from each neighbour for the 3x3 Sobel stencil of calculate_divergence_stack
+DIVERGENCE_HALO = 1
+
+
+def divergence_missing_mask(missing):
+    """Pixels whose 3x3 Sobel stencil touches a missing pixel, on the spatial axes only."""
+    structure = np.ones((1,) * (missing.ndim - 2) + (3, 3), dtype=bool)
+    return ndimage.binary_dilation(missing, structure=structure)
+
+
+def calculate_divergence_stack(flux_u, flux_v, out=None, scratch=None, missing=None):
+    """
+    Calculate divergence of a (T, H, W) flux stack, matching calculate_divergence per day.
+
+    The Sobel filters are applied as separable 1D passes on the two spatial axes
+    only, so days are never mixed. The result goes into out and the dv/dy term
+    into scratch; scratch may be flux_u itself, which is fully consumed first.
+    With a boolean missing mask, pixels whose stencil touches missing data are
+    set to NaN, so averages skip them instead of counting them as zero flux.
+    """
+    if out is None:
+        out = np.empty_like(flux_u)
+    if scratch is None:
+        scratch = np.empty_like(out)
+
+    # du/dx: derivative along x, smoothing along y (as ndimage.sobel(axis=1))
+    ndimage.correlate1d(flux_u, [-1, 0, 1], axis=-1, output=out)
+    ndimage.correlate1d(out, [1, 2, 1], axis=-2, output=out)
+
+    # dv/dy: derivative along y, smoothing along x (as ndimage.sobel(axis=0))
+    ndimage.correlate1d(flux_v, [-1, 0, 1], axis=-2, output=scratch)
+    ndimage.correlate1d(scratch, [1, 2, 1], axis=-1, output=scratch)
+
+    out += scratch
+    if missing is not None:
+        np.copyto(out, np.nan, where=divergence_missing_mask(missing))
+    return out
 
 def save_numpy_array(array, output_dir, date):
     """Save numpy array with date in filename."""
@@ -152,41 +477,254 @@ def save_numpy_array(array, output_dir, date):
     filename = f"divergence_{date.strftime('%Y-%m-%d')}.npy"
     file_path = os.path.join(output_dir, filename)
     np.save(file_path, array)
+    return file_path
 
-if __name__ == "__main__":
-    u_wind_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/u_wind_np"
-    v_wind_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/v_wind_np"
-    no2_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/no2_np"
-    output_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/divergence_np"
 
-    u_wind_data, dates = load_numpy_arrays(u_wind_dir)
-    v_wind_data, _ = load_numpy_arrays(v_wind_dir)
-    no2_data, _ = load_numpy_arrays(no2_dir)
+def save_peaks(peaks, file_path):
+    """Save fitted peaks as positions and Gaussian parameters."""
+    positions = np.array([pos for pos, _ in peaks], dtype=np.int64).reshape(-1, 2)
+    params = np.array([popt for _, popt in peaks], dtype=np.float64).reshape(-1, 7)
+    np.savez(file_path, positions=positions, params=params)
+
 
-    divergence_maps = []
+def load_peaks(file_path):
+    """Load peaks saved by save_peaks, as (peak_pos, popt) pairs."""
+    with np.load(file_path) as data:
+        return [(tuple(pos), popt) for pos, popt in zip(data['positions'].tolist(), data['params'])]
 
-    for no2, u_wind, v_wind, date in zip(no2_data, u_wind_data, v_wind_data, dates):
-        flux_u, flux_v = calculate_flux(no2, u_wind, v_wind)
-        divergence = calculate_divergence(flux_u, flux_v)
-        divergence_maps.append(divergence)
-        save_numpy_array(divergence, output_dir, date)
+def process_divergence_batch(datacube_dir, start, stop, flux_buffers=None):
+    """
+    Compute divergence for days [start, stop) of a datacube and write it back.
 
-    averaged_divergence = temporal_average(divergence_maps)
-    save_numpy_array(averaged_divergence, output_dir, datetime.now().date())
+    The batch opens the datacube itself, so it can run in a worker process
+    without pickling arrays from the parent. flux_buffers is an optional pair of
+    (N, H, W) arrays with N >= stop - start, reused for the fluxes of every batch.
+
+    Returns:
+    tuple: start, stop, content hash of each computed divergence map
+    """
+    cube = Datacube(datacube_dir, mode='r+')
+    days = slice(start, stop)
+    dates = {'start_date': cube.dates[start], 'end_date': cube.dates[stop - 1]}
+    # Datacubes written in a precision mode track missing pixels in a boolean variable
+    missing = cube.array('missing')[days] if 'missing' in cube.variables else None
+    flux_u = flux_v = None
+    if flux_buffers is not None:
+        flux_u, flux_v = (buffer[:stop - start] for buffer in flux_buffers)
+    with stage('flux', **dates) as span:
+        flux_u, flux_v = calculate_flux_stack(cube.array('no2')[days], cube.array('u_wind')[days],
+                                              cube.array('v_wind')[days], flux_u, flux_v, missing=missing)
+        span.array('flux_u', flux_u)
+        span.array('flux_v', flux_v)
+    with stage('divergence', **dates) as span:
+        divergence = calculate_divergence_stack(flux_u, flux_v, out=cube.array('divergence')[days], scratch=flux_u,
+                                                missing=missing)
+        cube.flush()
+        span.array('divergence', divergence)
+    return start, stop, [hash_array(day) for day in divergence]
+
+
+def tile_windows(shape, tile_shape):
+    """(row slice, col slice) of the tiles covering an (H, W) grid, row-major."""
+    return [(slice(row, min(row + tile_shape[0], shape[0])), slice(col, min(col + tile_shape[1], shape[1])))
+            for row in range(0, shape[0], tile_shape[0]) for col in range(0, shape[1], tile_shape[1])]
+
+
+def halo_window(rows, cols, shape, halo=DIVERGENCE_HALO):
+    """
+    Read window of a tile grown by halo pixels, clipped to the grid.
+
+    Returns:
+    tuple: (row slice, col slice) to read, (row slice, col slice) of the tile within it
+    """
+    read_rows = slice(max(0, rows.start - halo), min(shape[0], rows.stop + halo))
+    read_cols = slice(max(0, cols.start - halo), min(shape[1], cols.stop + halo))
+    core = (slice(rows.start - read_rows.start, rows.stop - read_rows.start),
+            slice(cols.start - read_cols.start, cols.stop - read_cols.start))
+    return (read_rows, read_cols), core
+
+
+def process_divergence_tile(datacube_dir, start, stop, rows, cols):
+    """
+    Compute divergence for days [start, stop) of one spatial tile of a datacube and write it back.
+
+    Only the tile and its halo are read from the memory-mapped inputs. The Sobel
+    passes and the missing-mask dilation are local to the halo, and grid edges
+    are handled by the same boundary mode as the whole-map path, so the stitched
+    tiles are bit-identical to process_divergence_batch.
+
+    Returns:
+    tuple: start, stop
+    """
+    cube = Datacube(datacube_dir, mode='r+')
+    (read_rows, read_cols), core = halo_window(rows, cols, cube.shape)
+    window = slice(start, stop), read_rows, read_cols
+    missing = cube.array('missing')[window] if 'missing' in cube.variables else None
+    with stage('divergence_tile', start_date=cube.dates[start], end_date=cube.dates[stop - 1],
+               rows=[rows.start, rows.stop], cols=[cols.start, cols.stop]) as span:
+        flux_u, flux_v = calculate_flux_stack(cube.array('no2')[window], cube.array('u_wind')[window],
+                                              cube.array('v_wind')[window], missing=missing)
+        divergence = calculate_divergence_stack(flux_u, flux_v, scratch=flux_u, missing=missing)
+        cube.array('divergence')[start:stop, rows, cols] = divergence[(slice(None),) + core]
+        cube.flush()
+        span.array('divergence', divergence)
+    return start, stop
+
+
+def _divergence_input_fingerprint(cube, manifest, index):
+    """
+    Fingerprint of one day's divergence inputs, chained on the 'interpolate' stage when known,
+    and of where its divergence is stored.
+    """
+    date = str(cube.dates[index])
+    upstream = manifest.output_fingerprint('interpolate', date)
+    if upstream is None:
+        inputs = [name for name in ('no2', 'u_wind', 'v_wind', 'missing') if name in cube.variables]
+        upstream = manifest.fingerprint([hash_array(cube.array(name)[index]) for name in inputs])
+    return manifest.fingerprint([upstream], {'stencil': 'sobel', 'datacube': cube.day_signature(date, ('divergence',))})
+
+
+def compute_divergence(datacube_dir, batch_size=32, workers=1, manifest=None, tile_shape=None):
+    """
+    Compute the divergence variable of a datacube in batches of days.
+
+    With workers > 1 the batches are spread over a process pool. Every batch
+    writes a disjoint range of days, so the result is identical to a serial run,
+    which reuses one pair of flux buffers for all its batches.
+    With a tile_shape (rows, cols), each batch is further split into spatial
+    tiles read with a one-pixel halo, so memory is bounded by batch_size tiles
+    rather than batch_size full maps; the tiles of all batches share the pool
+    and the result is identical to the untiled run.
+    With a manifest, only days whose inputs changed are recomputed and each
+    computed day is recorded under the 'divergence' stage.
+    """
+    cube = Datacube(datacube_dir, mode='r+')
+    # Divergence is stored in the precision of its inputs, e.g. float32 in float32 mode
+    cube.add_variable('divergence', np.result_type(*(cube.variables[name] for name in ('no2', 'u_wind', 'v_wind'))),
+                      overwrite=True)
+    cube.flush()
+
+    if manifest is None:
+        stale = list(range(len(cube)))
+        fingerprints = {}
+    else:
+        fingerprints = {i: _divergence_input_fingerprint(cube, manifest, i) for i in range(len(cube))}
+        stale = [i for i in range(len(cube))
+                 if not manifest.is_current('divergence', str(cube.dates[i]), fingerprints[i])]
+
+    # Batches of consecutive stale days, at most batch_size long
+    starts, stops = [], []
+    for i in stale:
+        if starts and stops[-1] == i and i - starts[-1] < batch_size:
+            stops[-1] = i + 1
+        else:
+            starts.append(i)
+            stops.append(i + 1)
+    if not starts:
+        return
+
+    def report(start, stop, hashes):
+        if manifest is not None:
+            for i, day_hash in zip(range(start, stop), hashes):
+                manifest.record('divergence', str(cube.dates[i]), fingerprints[i], [datacube_dir], day_hash)
+        print(f"Processed divergence for {cube.dates[start]} to {cube.dates[stop - 1]}")
+
+    if tile_shape is None:
+        flux_buffers = [None] * len(starts)
+        if workers <= 1:
+            # One pair of flux buffers for all batches of a serial run; worker processes allocate their own
+            buffer_shape = (max(stop - start for start, stop in zip(starts, stops)),) + cube.shape
+            buffers = tuple(np.empty(buffer_shape, cube.variables['divergence']) for _ in range(2))
+            flux_buffers = [buffers] * len(starts)
+        task, jobs = process_divergence_batch, ([datacube_dir] * len(starts), starts, stops, flux_buffers)
+    else:
+        windows = tile_windows(cube.shape, tile_shape)
+        tiles = [(datacube_dir, start, stop, rows, cols) for start, stop in zip(starts, stops) for rows, cols in windows]
+        task, jobs = process_divergence_tile, tuple(zip(*tiles))
+        remaining = dict.fromkeys(starts, len(windows))
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for result in (pool.map if pool else map)(task, *jobs):
+            if tile_shape is None:
+                report(*result)
+                continue
+            # A batch is complete once all its tiles are written
+            start, stop = result
+            remaining[start] -= 1
+            if not remaining[start]:
+                report(start, stop, [hash_array(day) for day in cube.array('divergence')[start:stop]])
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+if __name__ == "__main__":
+    datacube_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/datacube"
+    manifest_path = "/home/cedric/repos/cassini_nitrogen_estimation/data/manifest.json"
+    output_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/divergence_np"
+    export_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/export"
+    enable_trace("/home/cedric/repos/cassini_nitrogen_estimation/data/trace.jsonl")
+
+    workers = os.cpu_count()
+    peak_params = {'threshold': 0.5, 'max_peaks': 10, 'min_distance': 10, 'half_window': 10}
+
+    # Only days, averages and peaks whose inputs or settings changed are recomputed
+    manifest = StageManifest(manifest_path)
+    # Tiles bound memory to batch_size x tile pixels on continental grids, with results identical to whole maps
+    compute_divergence(datacube_dir, workers=workers, manifest=manifest, tile_shape=(1024, 1024))
+    manifest.save()
+
+    cube = Datacube(datacube_dir)
+    average_fingerprint = manifest.fingerprint(
+        [manifest.output_fingerprint('divergence', date) for date in cube.dates.astype(str)])
+    if manifest.is_current('average', 'divergence', average_fingerprint):
+        averaged_divergence = np.load(manifest.outputs('average', 'divergence')[0])
+    else:
+        # Aggregate in date order in the parent so the average matches a serial run exactly
+        with stage('average', days=len(cube)) as span:
+            divergence_stats = StreamingAggregator(cube.variables['divergence']).update_all(cube.array('divergence'))
+            averaged_divergence = span.array('average', divergence_stats.mean)
+        with stage('save_average'):
+            average_path = save_numpy_array(averaged_divergence, output_dir, datetime.now().date())
+        manifest.record('average', 'divergence', average_fingerprint, [average_path],
+                        hash_array(averaged_divergence))
+        manifest.save()
 
     print("Divergence maps saved. Shape of averaged divergence map:", averaged_divergence.shape)
 
     lats = np.load("/home/cedric/repos/cassini_nitrogen_estimation/data/latitudes.npy")
     lons = np.load("/home/cedric/repos/cassini_nitrogen_estimation/data/longitudes.npy")
 
-    pixel_area = (lats[1] - lats[0]) * (lons[1] - lons[0]) * 111000 * 111000  # in m^2
-
-    peaks = detect_and_fit_peaks(averaged_divergence)
+    pixel_area = grid_pixel_area(lats, lons)
+
+    peaks_path = os.path.join(output_dir, 'peaks.npz')
+    peaks_fingerprint = manifest.fingerprint([manifest.output_fingerprint('average', 'divergence')],
+                                             dict(peak_params, method='local_maxima'))
+    if manifest.is_current('peaks', 'average', peaks_fingerprint):
+        peaks = load_peaks(peaks_path)
+    else:
+        with stage('fit_peaks', **peak_params) as span:
+            # Pixels never valid on any day carry no divergence signal
+            peaks = detect_and_fit_peaks_local_maxima(np.nan_to_num(averaged_divergence), workers=workers,
+                                                      **peak_params)
+            span.set(fitted=len(peaks))
+        save_peaks(peaks, peaks_path)
+        manifest.record('peaks', 'average', peaks_fingerprint, [peaks_path])
+        manifest.save()
 
     emissions = quantify_emissions(peaks, pixel_area)
 
-    visualize_results(averaged_divergence, emissions, lats, lons, output_dir)
+    with stage('visualize'):
+        visualize_results(averaged_divergence, emissions, lats, lons, output_dir)
+
+    with stage('report'):
+        save_emissions_report(emissions, lats, lons, output_dir)
 
-    save_emissions_report(emissions, lats, lons, output_dir)
+    # Georeferenced COGs of every day and the average, and web tiles of the average, for the dashboard
+    with stage('export'):
+        export_maps(datacube_dir, export_dir, lats, lons, averaged_divergence, tiles=True, manifest=manifest,
+                    average_fingerprint=manifest.output_fingerprint('average', 'divergence'))
+    manifest.save()
 
     print("Analysis complete. Results saved in the output directory.")
\ No newline at end of file
@@ -1,50 +1,142 @@
 import os
 import glob
+import math
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
 import rasterio
-from scipy.interpolate import RegularGridInterpolator
-
-
-def load_wind_data(u_wind_dir, v_wind_dir):
-    """Load U and V wind component rasters and their dates."""
-    u_files = sorted(glob.glob(os.path.join(u_wind_dir, '*.tif')))
-    v_files = sorted(glob.glob(os.path.join(v_wind_dir, '*.tif')))
+from rasterio.enums import Resampling
+from rasterio.features import geometry_window
+from rasterio.windows import Window, from_bounds, round_window_to_full_blocks
+from datacube import Datacube
+from regridding import regrid_wind_stack
+from batch_rendering import render_dates
+from instrumentation import enable_trace, stage
+from manifest import StageManifest, hash_array
+from precision import PRECISIONS, resolve_dtype
+
+
+def list_raster_files(directory):
+    """List the GeoTIFFs of a directory in date order, with their dates."""
+    files = sorted(glob.glob(os.path.join(directory, '*.tif')))
+    dates = [os.path.basename(file).split('_')[-1].split('.')[0] for file in files]
+    return files, dates
+
+
+def aoi_window(src, bounds=None, geometry=None, align_to_blocks=False):
+    """
+    Window of an open raster covering an area of interest.
+
+    Args:
+    src: Open rasterio dataset
+    bounds (tuple): Optional (left, bottom, right, top) in the raster CRS
+    geometry: Optional GeoJSON-like or shapely geometry in the raster CRS
+    align_to_blocks (bool): Expand the window outward to whole internal blocks
+
+    Returns:
+    Window: Pixel window clipped to the raster, the full raster if no AOI is given
+    """
+    full = Window(0, 0, src.width, src.height)
+    if geometry is not None:
+        window = geometry_window(src, [geometry])
+    elif bounds is not None:
+        window = from_bounds(*bounds, transform=src.transform)
+    else:
+        return full
+
+    # Edges rounded outward, so partly covered pixels on every side are read
+    row_start, col_start = math.floor(window.row_off), math.floor(window.col_off)
+    window = Window(col_start, row_start, math.ceil(window.col_off + window.width) - col_start,
+                    math.ceil(window.row_off + window.height) - row_start).intersection(full)
+    if align_to_blocks:
+        # Blocks at the right and bottom edges may extend past the raster
+        window = round_window_to_full_blocks(window, src.block_shapes).intersection(full)
+    return window
+
+
+def read_raster_band(path, bounds=None, geometry=None, decimation=1, align_to_blocks=False, dtype=None,
+                     masked=False):
+    """
+    Read band 1 of a GeoTIFF, optionally cropped to an area of interest and decimated.
+
+    Only the pixels of the AOI window are read. With decimation > 1 the read is
+    done at a reduced resolution, which lets GDAL use the internal overviews for
+    quick-look plots. With dtype the band is read directly into that type,
+    without an intermediate copy. With masked=True a boolean mask of missing
+    pixels (nodata or NaN) is returned as well.
+    """
+    with rasterio.open(path) as src:
+        window = aoi_window(src, bounds, geometry, align_to_blocks)
+        out_shape = None
+        if decimation > 1:
+            out_shape = (max(1, int(np.ceil(window.height / decimation))),
+                         max(1, int(np.ceil(window.width / decimation))))
+        data = src.read(1, window=window, out_shape=out_shape, resampling=Resampling.nearest,
+                        out_dtype=dtype, masked=masked)
+    if not masked:
+        return data
+    missing = np.ma.getmaskarray(data)
+    data = data.data
+    if data.dtype.kind == 'f':
+        missing |= np.isnan(data)
+    return data, missing
+
+
+def read_wind_rasters(u_file, v_file, dtype=None, mask_missing=False, **read_options):
+    """
+    Read one date of U and V wind components.
+
+    By default missing values are replaced with 0. With mask_missing=True they
+    are left in place and a boolean mask of pixels missing in either component
+    is returned as a third value.
+    """
+    if mask_missing:
+        u_wind, u_missing = read_raster_band(u_file, dtype=dtype, masked=True, **read_options)
+        v_wind, v_missing = read_raster_band(v_file, dtype=dtype, masked=True, **read_options)
+        return u_wind, v_wind, u_missing | v_missing
+
+    u_wind = read_raster_band(u_file, dtype=dtype, **read_options)
+    v_wind = read_raster_band(v_file, dtype=dtype, **read_options)
+
+    # Replace NaN values with 0
+    u_wind = np.nan_to_num(u_wind, nan=0.0, copy=False)
+    v_wind = np.nan_to_num(v_wind, nan=0.0, copy=False)
+    return u_wind, v_wind
+
+
+def read_no2_raster(no2_file, dtype=None, mask_missing=False, **read_options):
+    """Read one date of NO2 concentration, see read_wind_rasters for mask_missing."""
+    if mask_missing:
+        return read_raster_band(no2_file, dtype=dtype, masked=True, **read_options)
+
+    no2 = read_raster_band(no2_file, dtype=dtype, **read_options)
+
+    # Replace NaN values with 0
+    return np.nan_to_num(no2, nan=0.0, copy=False)
+
+
+def load_wind_data(u_wind_dir, v_wind_dir, **read_options):
+    """
+    Load U and V wind component rasters and their dates.
+
+    read_options (bounds, geometry, decimation, align_to_blocks) are passed to
+    read_raster_band to read only an area of interest.
+    """
+    u_files, dates = list_raster_files(u_wind_dir)
+    v_files, _ = list_raster_files(v_wind_dir)
 
     if len(u_files) != len(v_files):
         raise ValueError("Mismatch in number of U and V wind files")
 
-    dates = [os.path.basename(file).split('_')[-1].split('.')[0] for file in u_files]
-
-    wind_data = []
-    for u_file, v_file in zip(u_files, v_files):
-        with rasterio.open(u_file) as u_src, rasterio.open(v_file) as v_src:
-            u_wind = u_src.read(1)
-            v_wind = v_src.read(1)
-
-        # Replace NaN values with 0
-        u_wind = np.nan_to_num(u_wind, nan=0.0)
-        v_wind = np.nan_to_num(v_wind, nan=0.0)
-
-        wind_data.append((u_wind, v_wind))
-
+    wind_data = [read_wind_rasters(u_file, v_file, **read_options) for u_file, v_file in zip(u_files, v_files)]
     return wind_data, dates
 
 
-def load_no2_data(no2_dir):
-    """Load NO2 rasters and their dates."""
-    no2_files = sorted(glob.glob(os.path.join(no2_dir, '*.tif')))
-    dates = [os.path.basename(file).split('_')[-1].split('.')[0] for file in no2_files]
-
-    no2_data = []
-    for no2_file in no2_files:
-        with rasterio.open(no2_file) as src:
-            no2 = src.read(1)
-
-        # Replace NaN values with 0
-        no2 = np.nan_to_num(no2, nan=0.0)
-        no2_data.append(no2)
-
+def load_no2_data(no2_dir, **read_options):
+    """Load NO2 rasters and their dates, see load_wind_data for read_options."""
+    no2_files, dates = list_raster_files(no2_dir)
+    no2_data = [read_no2_raster(no2_file, **read_options) for no2_file in no2_files]
     return no2_data, dates
 
 
@@ -82,28 +174,17 @@ def plot_no2_and_wind(no2_data, u_wind, v_wind, date, output_dir):
 
 
 
-def interpolate_wind_to_no2_grid(u_wind, v_wind, no2_shape):
-    """Interpolate wind data to match NO2 data shape using RegularGridInterpolator."""
-    old_shape = u_wind.shape
-    old_y = np.arange(old_shape[0])
-    old_x = np.arange(old_shape[1])
-
-    new_y = np.linspace(0, old_shape[0] - 1, no2_shape[0])
-    new_x = np.linspace(0, old_shape[1] - 1, no2_shape[1])
-
-    # Create meshgrid for new coordinates
-    new_xx, new_yy = np.meshgrid(new_x, new_y)
-    new_points = np.column_stack([new_yy.ravel(), new_xx.ravel()])
-
-    # Create interpolation functions for u and v components
-    interp_u = RegularGridInterpolator((old_y, old_x), u_wind)
-    interp_v = RegularGridInterpolator((old_y, old_x), v_wind)
-
-    # Apply interpolation
-    u_wind_interp = interp_u(new_points).reshape(no2_shape)
-    v_wind_interp = interp_v(new_points).reshape(no2_shape)
+def interpolate_wind_to_no2_grid(u_wind, v_wind, no2_shape, method='bilinear', missing=None):
+    """
+    Interpolate wind data to match NO2 data shape.
 
-    return u_wind_interp, v_wind_interp
+    Uses the cached separable operator from regridding, so the weights are built
+    once per grid pair rather than once per date. 'bilinear' matches the former
+    RegularGridInterpolator result; 'conservative' averages by cell overlap.
+    float32 input stays float32. With a missing mask of the wind grid, missing
+    pixels are excluded and the missing mask on the NO2 grid is returned too.
+    """
+    return regrid_wind_stack(u_wind, v_wind, no2_shape, method=method, missing=missing)
 
 
 def plot_wind_arrows(u_wind, v_wind, date, output_dir):
@@ -159,40 +240,155 @@ def plot_no2(no2_data, date, output_dir):
     plt.close()
 
 
-def main():
-    u_wind_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/wind_poland/u_wind"
-    v_wind_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/wind_poland/v_wind"
-    output_dir = "/home/cedric/repos/cassini_nitrogen_estimation/outputs/maps"
-    no2_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/no2_poland"
-
-    u_wind_output_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/u_wind_np"
-    v_wind_output_dir= "/home/cedric/repos/cassini_nitrogen_estimation/data/v_wind_np"
-    no2_output_dir= "/home/cedric/repos/cassini_nitrogen_estimation/data/no2_np"
+def process_date(u_file, v_file, no2_file, date, datacube_dir, output_dir, read_options=None, plot=True,
+                 precision=None):
+    """
+    Interpolate, store and plot a single date.
+
+    Inputs are read from disk here rather than passed in, so the function can run
+    in a worker process without pickling arrays from the parent. With a precision
+    ('float32' or 'float64'), rasters are read in that dtype, missing pixels are
+    tracked in the datacube's boolean 'missing' variable instead of being
+    zero-filled, and the wind regridding skips them.
+
+    Returns:
+    tuple: date, fingerprint of the stored no2/u_wind/v_wind (and missing) arrays
+    """
+    read_options = read_options or {}
+    masked = precision is not None
+    dtype = resolve_dtype(precision) if masked else None
+    with stage('load', date=date) as span:
+        if masked:
+            u_wind, v_wind, wind_missing = read_wind_rasters(u_file, v_file, dtype, True, **read_options)
+            no2, no2_missing = read_no2_raster(no2_file, dtype, True, **read_options)
+        else:
+            u_wind, v_wind = read_wind_rasters(u_file, v_file, **read_options)
+            no2 = read_no2_raster(no2_file, **read_options)
+        span.array('u_wind', u_wind)
+        span.array('v_wind', v_wind)
+        span.array('no2', no2)
+
+    # Interpolate wind data to match NO2 grid
+    with stage('interpolate', date=date) as span:
+        if masked:
+            u_wind_interp, v_wind_interp, missing = interpolate_wind_to_no2_grid(u_wind, v_wind, no2.shape,
+                                                                                 missing=wind_missing)
+            missing |= no2_missing
+        else:
+            u_wind_interp, v_wind_interp = interpolate_wind_to_no2_grid(u_wind, v_wind, no2.shape)
+        span.array('u_wind', u_wind_interp)
+        span.array('v_wind', v_wind_interp)
+
+    # Every date writes its own slice of the datacube, so workers never overlap
+    with stage('store', date=date):
+        cube = Datacube(datacube_dir, mode='r+')
+        cube.write('u_wind', date, u_wind_interp)
+        cube.write('v_wind', date, v_wind_interp)
+        cube.write('no2', date, no2)
+        if masked:
+            cube.write('missing', date, missing)
+        cube.flush()
+
+    if plot:
+        with stage('plot', date=date):
+            plot_wind_arrows(u_wind_interp, v_wind_interp, date, output_dir)
+            plot_no2(no2, date, output_dir)
+            plot_no2_and_wind(no2, u_wind_interp, v_wind_interp, date, output_dir)
+    outputs = [no2, u_wind_interp, v_wind_interp] + ([missing] if masked else [])
+    return date, StageManifest.fingerprint([hash_array(array) for array in outputs])
+
+
+def process_directories(u_wind_dir, v_wind_dir, no2_dir, datacube_dir, output_dir, manifest_path, workers=1,
+                        bounds=None, geometry=None, batch_render=True, precision=None, plot=True):
+    """
+    Interpolate, store and plot every date of the wind and NO2 directories.
+
+    Dates whose GeoTIFFs, settings and datacube slot are unchanged since the
+    last run are skipped; plot=False only fills the datacube. Without a precision, a missing-pixel mask left by an
+    earlier precision run is dropped from the datacube.
+    """
     os.makedirs(output_dir, exist_ok=True)
-    os.makedirs(u_wind_output_dir, exist_ok=True)
-    os.makedirs(v_wind_output_dir, exist_ok=True)
-    os.makedirs(no2_output_dir, exist_ok=True)
 
-    wind_data, wind_dates = load_wind_data(u_wind_dir, v_wind_dir)
-    no2_data, no2_dates = load_no2_data(no2_dir)
+    u_files, wind_dates = list_raster_files(u_wind_dir)
+    v_files, _ = list_raster_files(v_wind_dir)
+    no2_files, no2_dates = list_raster_files(no2_dir)
+
+    if len(u_files) != len(v_files):
+        raise ValueError("Mismatch in number of U and V wind files")
 
     # Ensure wind and NO2 data have matching dates
     if wind_dates != no2_dates:
         raise ValueError("Mismatch in dates between wind and NO2 data")
 
-    for (u_wind, v_wind), no2, date in zip(wind_data, no2_data, wind_dates):
-        # Interpolate wind data to match NO2 grid
-        u_wind_interp, v_wind_interp = interpolate_wind_to_no2_grid(u_wind, v_wind, no2.shape)
-
-        np.save(os.path.join(u_wind_output_dir, f'u_wind_interp_{date}.npy'), u_wind_interp)
-        np.save(os.path.join(v_wind_output_dir, f'v_wind_interp_{date}.npy'), v_wind_interp)
-        np.save(os.path.join(no2_output_dir, f'no2_{date}.npy'), no2)
+    # Only the area of interest is read when bounds or geometry are given
+    read_options = {'bounds': bounds, 'geometry': geometry}
+    first_no2 = read_no2_raster(no2_files[0], **read_options)
+
+    if precision is None:
+        variables = {'no2': first_no2.dtype, 'u_wind': np.float64, 'v_wind': np.float64}
+    else:
+        # One dtype end to end, with missing pixels tracked in a boolean mask
+        dtype = resolve_dtype(precision)
+        variables = {'no2': dtype, 'u_wind': dtype, 'v_wind': dtype, 'missing': bool}
+    cube = Datacube.open_or_create(datacube_dir, no2_dates, first_no2.shape, variables=variables)
+    if precision is None:
+        # Zero-filled rasters have no missing pixels; a stale mask would hide valid ones downstream
+        cube.drop_variable('missing')
+    cube.flush()
+
+    # Only dates whose GeoTIFFs or settings changed since the last run, or whose datacube slot is new, are reprocessed
+    manifest = StageManifest(manifest_path)
+    params = {'read_options': read_options, 'regridding': 'bilinear'}
+    if precision is not None:
+        params['precision'] = precision
+    fingerprints = {date: manifest.fingerprint([manifest.file_fingerprint(path) for path in files],
+                                               dict(params, datacube=cube.day_signature(date, variables)))
+                    for date, files in zip(wind_dates, zip(u_files, v_files, no2_files))}
+    stale = [i for i, date in enumerate(wind_dates)
+             if not manifest.is_current('interpolate', date, fingerprints[date])]
+
+    tasks = ([u_files[i] for i in stale], [v_files[i] for i in stale], [no2_files[i] for i in stale],
+             [wind_dates[i] for i in stale], [datacube_dir] * len(stale), [output_dir] * len(stale),
+             [read_options] * len(stale), [plot and not batch_render] * len(stale), [precision] * len(stale))
+
+    # pool.map yields in submission order, so progress and outputs match a serial run
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(process_date, *tasks)
+            for date, output_fingerprint in results:
+                manifest.record('interpolate', date, fingerprints[date], [datacube_dir], output_fingerprint)
+                print(f"Processed wind and NO2 maps for {date}")
+    else:
+        for date, output_fingerprint in map(process_date, *tasks):
+            manifest.record('interpolate', date, fingerprints[date], [datacube_dir], output_fingerprint)
+            print(f"Processed wind and NO2 maps for {date}")
+    manifest.save()
+    print(f"Skipped {len(wind_dates) - len(stale)} unchanged dates")
+
+    if plot and batch_render:
+        # Render with reused figure layouts, skipping plots whose inputs and settings are unchanged
+        input_fingerprints = {date: manifest.output_fingerprint('interpolate', date) for date in wind_dates}
+        rendered = render_dates(datacube_dir, output_dir, ('wind_map', 'no2_map', 'no2_and_wind_map'),
+                                workers=workers, manifest=manifest, input_fingerprints=input_fingerprints)
+        manifest.save()
+        print(f"Rendered {len(rendered)} maps")
+
+
+def main(workers=1, bounds=None, geometry=None, batch_render=True, precision=None):
+    u_wind_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/wind_poland/u_wind"
+    v_wind_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/wind_poland/v_wind"
+    output_dir = "/home/cedric/repos/cassini_nitrogen_estimation/outputs/maps"
+    no2_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/no2_poland"
 
-        plot_wind_arrows(u_wind_interp, v_wind_interp, date, output_dir)
-        plot_no2(no2, date, output_dir)
-        plot_no2_and_wind(no2, u_wind_interp, v_wind_interp, date, output_dir)
-        print(f"Processed wind and NO2 maps for {date}")
+    datacube_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/datacube"
+    manifest_path = "/home/cedric/repos/cassini_nitrogen_estimation/data/manifest.json"
+    enable_trace("/home/cedric/repos/cassini_nitrogen_estimation/data/trace.jsonl")
+    process_directories(u_wind_dir, v_wind_dir, no2_dir, datacube_dir, output_dir, manifest_path, workers=workers,
+                        bounds=bounds, geometry=geometry, batch_render=batch_render, precision=precision)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--precision', choices=sorted(PRECISIONS),
+                        help='Store rasters in this dtype with a missing-pixel mask (default: float64, zero-filled)')
+    main(workers=os.cpu_count(), precision=parser.parse_args().precision)
@@ -0,0 +1,126 @@
+"""
+Precision modes of the divergence pipeline, and a harness validating float32 against float64.
+
+Usage:
+    python precision.py [datacube_dir] [--tolerance 1e-5]
+"""
+import argparse
+import sys
+import numpy as np
+import model
+import raster_simulated
+from aggregation import StreamingAggregator
+from datacube import Datacube
+
+PRECISIONS = {'float32': np.float32, 'float64': np.float64}
+
+# Largest accepted error of each float32 stage, relative to the largest float64 magnitude of that stage
+DEFAULT_TOLERANCES = {'flux': 1e-6, 'divergence': 1e-5, 'average': 1e-5, 'emissions': 1e-3}
+
+
+def resolve_dtype(precision):
+    """numpy dtype of a precision mode name."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision}, expected one of {sorted(PRECISIONS)}")
+    return np.dtype(PRECISIONS[precision])
+
+
+def run_precision(no2, u_wind, v_wind, missing, precision):
+    """
+    Flux, divergence, temporal average and emissions of a (T, H, W) stack in one precision.
+
+    Mirrors the datacube path: inputs are cast once, missing pixels are masked
+    rather than zero-filled, and the average is accumulated in the same dtype.
+    """
+    dtype = resolve_dtype(precision)
+    no2, u_wind, v_wind = (np.asarray(array, dtype=dtype) for array in (no2, u_wind, v_wind))
+    flux_u, flux_v = model.calculate_flux_stack(no2, u_wind, v_wind, missing=missing)
+    flux = np.hypot(flux_u, flux_v)
+    divergence = model.calculate_divergence_stack(flux_u, flux_v, missing=missing)
+    average = StreamingAggregator(dtype).update_all(divergence).mean
+    return {'flux': flux, 'divergence': divergence, 'average': average}
+
+
+def validate_precision(no2, u_wind, v_wind, missing=None, tolerances=None, peak_positions=None):
+    """
+    Compare the float32 path with the float64 path on the same inputs.
+
+    Errors are the largest absolute difference of each stage, relative to the
+    largest float64 magnitude of that stage, so they are comparable across
+    units. NaN must appear at the same pixels in both paths. When peak
+    positions are given, the emissions of the Gaussians fitted at those
+    positions on both averages are compared as well.
+
+    Returns:
+    dict: stage -> {'error': relative error, 'tolerance': bound, 'passed': bool}
+    """
+    tolerances = dict(DEFAULT_TOLERANCES, **(tolerances or {}))
+    reference = run_precision(no2, u_wind, v_wind, missing, 'float64')
+    single = run_precision(no2, u_wind, v_wind, missing, 'float32')
+
+    report = {}
+    for stage, expected in reference.items():
+        actual = single[stage].astype(np.float64)
+        same_nan = np.array_equal(np.isnan(expected), np.isnan(actual))
+        finite = np.isfinite(expected)
+        error = 0.0
+        if finite.any():
+            scale = max(np.abs(expected[finite]).max(), np.finfo(np.float64).tiny)
+            error = np.abs(actual[finite] - expected[finite]).max() / scale
+        report[stage] = {'error': float(error), 'tolerance': tolerances[stage],
+                         'passed': bool(same_nan and error <= tolerances[stage])}
+
+    if peak_positions is not None and len(peak_positions):
+        emissions = []
+        for result in (reference, single):
+            peaks, converged = model.fit_peak_windows(np.nan_to_num(result['average']).astype(np.float64),
+                                                      peak_positions)
+            emissions.append((np.array([rate for _, rate in model.quantify_emissions(peaks, 1.0)]), converged))
+        (rates_64, converged_64), (rates_32, converged_32) = emissions
+        if np.array_equal(converged_64, converged_32) and len(rates_64):
+            error = float(np.max(np.abs(rates_32 - rates_64) / np.maximum(np.abs(rates_64), 1e-300)))
+            passed = error <= tolerances['emissions']
+        else:
+            error, passed = float('inf'), not len(rates_64) and np.array_equal(converged_64, converged_32)
+        report['emissions'] = {'error': error, 'tolerance': tolerances['emissions'], 'passed': bool(passed)}
+    return report
+
+
+def _scenario_inputs(shape=(200, 200), n_days=20, n_sources=10, missing_fraction=0.02, seed=0):
+    """Synthetic inputs with known sources and random missing pixels."""
+    dates = np.arange(np.datetime64('2023-01-01'), np.datetime64('2023-01-01') + n_days)
+    positions, rates = raster_simulated.make_point_sources(n_sources, shape, margin=15, seed=seed)
+    days = list(raster_simulated.iter_plume_scenario(shape, dates, positions, rates, seed=seed, dtype=np.float64))
+    no2, u_wind, v_wind = (np.stack([day[i] for day in days]) for i in (1, 2, 3))
+    missing = np.random.default_rng(seed).random(no2.shape) < missing_fraction
+    no2[missing] = np.nan
+    return no2, u_wind, v_wind, missing, positions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('datacube', nargs='?', help='Datacube to validate on, a synthetic scenario by default')
+    parser.add_argument('--days', type=int, default=32, help='Number of datacube days to use')
+    parser.add_argument('--tolerance', type=float, help='Relative tolerance of every array stage')
+    args = parser.parse_args()
+
+    if args.datacube:
+        cube = Datacube(args.datacube)
+        days = slice(0, args.days)
+        no2, u_wind, v_wind = (cube.array(name)[days] for name in ('no2', 'u_wind', 'v_wind'))
+        missing = cube.array('missing')[days] if 'missing' in cube.variables else None
+        peak_positions = None
+    else:
+        no2, u_wind, v_wind, missing, peak_positions = _scenario_inputs()
+
+    tolerances = {stage: args.tolerance for stage in ('flux', 'divergence', 'average')} if args.tolerance else None
+    report = validate_precision(no2, u_wind, v_wind, missing, tolerances, peak_positions)
+    for stage, result in report.items():
+        status = 'ok' if result['passed'] else 'FAILED'
+        print(f"{stage}: relative error {result['error']:.2e} (tolerance {result['tolerance']:.0e}) {status}")
+    if not all(result['passed'] for result in report.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
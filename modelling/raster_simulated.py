@@ -1,9 +1,22 @@
+"""
+Synthetic NO2 and wind rasters with known point sources, to validate the pipeline against.
+
+Usage:
+    python raster_simulated.py [--datacube dir] [--size 1000] [--days 365] [--sources 100]
+
+Without --datacube the concentrated decay raster of the plant is written, with
+it only the synthetic scenario datacube; a 1000 x 1000 x 365 float32 datacube
+takes about 4.4 GB.
+"""
+import argparse
+import os
 import rasterio
 import numpy as np
+import pandas as pd
 import geopandas as gpd
 from rasterio.transform import from_origin
-from scipy.spatial.distance import cdist
 from conf import DATA_DIR
+from datacube import Datacube
 
 
 def create_concentrated_decay_raster(input_raster_path, point_gpkg_path, output_raster_path, decay_factor=0.1,
@@ -49,9 +62,164 @@ def create_concentrated_decay_raster(input_raster_path, point_gpkg_path, output_
     print(f"Concentrated decay raster saved to {output_raster_path}")
 
 
-# Usage
-input_raster_path = DATA_DIR/'NO2_plant_larger.tif'
-point_gpkg_path = '/home/cedric/plant_point_2.gpkg'
-output_raster_path = DATA_DIR/'NO2_simulated.tif'
+def make_point_sources(n_sources, shape, emission_range=(0.5, 5.0), margin=5, seed=None):
+    """
+    Draw random point sources with known emission rates.
+
+    Returns:
+    tuple: (N, 2) integer (row, col) positions, (N,) emission rates
+    """
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    rows = rng.integers(margin, max(margin + 1, height - margin), n_sources)
+    cols = rng.integers(margin, max(margin + 1, width - margin), n_sources)
+    rates = rng.uniform(*emission_range, n_sources)
+    return np.column_stack([rows, cols]), rates
+
+
+def plume_kernel(u_wind, v_wind, sigma=1.5, spread=0.1, lifetime=4.0, truncate=1e-3):
+    """
+    Unit-emission plume of a point source at the kernel centre, for a uniform wind.
+
+    The plume is a Gaussian of width sigma upwind, widening by spread per pixel
+    downwind and decaying over wind speed x lifetime pixels (the NOx lifetime in
+    pixel-crossing units). It is only evaluated within the radius where it drops
+    below truncate, instead of over the full raster.
+
+    Returns:
+    np.ndarray: (2r + 1, 2r + 1) kernel, centred on the source
+    """
+    speed = max(np.hypot(u_wind, v_wind), 1e-3)
+    decay_length = speed * lifetime
+    radius = int(np.ceil(decay_length * np.log(1 / truncate) + 3 * sigma))
+    direction_u, direction_v = u_wind / speed, v_wind / speed
+
+    # Rows follow v and columns follow u, as in calculate_divergence
+    dy, dx = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+    along = dx * direction_u + dy * direction_v
+    across = -dx * direction_v + dy * direction_u
+
+    downwind = np.maximum(along, 0)
+    width = sigma + spread * downwind
+    kernel = np.exp(-across ** 2 / (2 * width ** 2) - downwind / decay_length) / (np.sqrt(2 * np.pi) * width * speed)
+    # Upwind, the plume falls off like the source footprint
+    kernel *= np.exp(-np.minimum(along, 0) ** 2 / (2 * sigma ** 2))
+    return kernel
+
+
+def add_kernel(field, kernel, row, col, scale):
+    """Add scale x kernel centred on (row, col) to field, clipped at the borders."""
+    radius = kernel.shape[0] // 2
+    height, width = field.shape
+    r0, r1 = max(0, row - radius), min(height, row + radius + 1)
+    c0, c1 = max(0, col - radius), min(width, col + radius + 1)
+    if r0 < r1 and c0 < c1:
+        field[r0:r1, c0:c1] += scale * kernel[r0 - row + radius:r1 - row + radius, c0 - col + radius:c1 - col + radius]
+
+
+def _normal(rng, shape, mean, std, dtype):
+    """Gaussian noise drawn directly in dtype, or in float32 for dtypes numpy cannot draw in."""
+    draw_dtype = dtype if np.dtype(dtype) in (np.float32, np.float64) else np.float32
+    noise = rng.standard_normal(shape, dtype=draw_dtype)
+    noise *= std
+    noise += mean
+    return noise.astype(dtype, copy=False)
+
+
+def iter_plume_scenario(shape, dates, positions, rates, background=1.0, noise_std=0.05, wind_speed=(2.0, 8.0),
+                        wind_noise=0.3, rate_variability=0.1, seed=None, dtype=np.float32, **kernel_options):
+    """
+    Yield one synthetic day at a time for a set of point sources.
+
+    Every day gets a uniform wind of random direction and speed, with per-pixel
+    noise. Since the wind is uniform, one plume kernel per day is shared by all
+    sources and scaled by each source's emission rate for that day. NO2 gets a
+    constant background and Gaussian noise. Noise is drawn in dtype, so float32
+    scenarios never hold a float64 copy of a map.
+
+    Yields:
+    tuple: date, NO2, U wind and V wind maps of the given shape
+    """
+    rng = np.random.default_rng(seed)
+    for date in dates:
+        angle = rng.uniform(0, 2 * np.pi)
+        speed = rng.uniform(*wind_speed)
+        u_mean, v_mean = speed * np.cos(angle), speed * np.sin(angle)
+        kernel = plume_kernel(u_mean, v_mean, **kernel_options)
+
+        no2 = np.full(shape, background, dtype=dtype)
+        daily_rates = rates * rng.normal(1, rate_variability, len(rates)).clip(0)
+        for (row, col), rate in zip(positions, daily_rates):
+            add_kernel(no2, kernel, row, col, rate)
+        no2 += _normal(rng, shape, 0, noise_std, dtype)
+
+        u_wind = _normal(rng, shape, u_mean, wind_noise, dtype)
+        v_wind = _normal(rng, shape, v_mean, wind_noise, dtype)
+        yield date, no2, u_wind, v_wind
+
+
+def save_sources(positions, rates, output_path):
+    """Save the ground-truth sources as a CSV of row, col and emission rate."""
+    pd.DataFrame({'row': positions[:, 0], 'col': positions[:, 1], 'emission_rate': rates}).to_csv(
+        output_path, index=False)
+
+
+def write_scenario_datacube(datacube_dir, shape, dates, positions, rates, **scenario_options):
+    """Write a synthetic scenario straight into a datacube, as read by model.py."""
+    dtype = scenario_options.get('dtype', np.float32)
+    cube = Datacube.create(datacube_dir, dates, shape, {'no2': dtype, 'u_wind': dtype, 'v_wind': dtype})
+    for date, no2, u_wind, v_wind in iter_plume_scenario(shape, dates, positions, rates, **scenario_options):
+        cube.write('no2', date, no2)
+        cube.write('u_wind', date, u_wind)
+        cube.write('v_wind', date, v_wind)
+    cube.flush()
+    save_sources(positions, rates, os.path.join(datacube_dir, 'sources.csv'))
+    return cube
+
+
+def write_scenario_geotiffs(output_dir, shape, dates, positions, rates, transform=None, crs='EPSG:4326',
+                            **scenario_options):
+    """
+    Write a synthetic scenario as per-date GeoTIFFs, as read by the plotting.py loaders.
+
+    Files go to no2/, u_wind/ and v_wind/ subdirectories, named <variable>_YYYY-MM-DD.tif.
+    """
+    if transform is None:
+        transform = from_origin(14.0, 55.0, 0.01, 0.01)
+    for variable in ('no2', 'u_wind', 'v_wind'):
+        os.makedirs(os.path.join(output_dir, variable), exist_ok=True)
+
+    for date, *arrays in iter_plume_scenario(shape, dates, positions, rates, **scenario_options):
+        for variable, array in zip(('no2', 'u_wind', 'v_wind'), arrays):
+            output_path = os.path.join(output_dir, variable, f'{variable}_{np.datetime64(date, "D")}.tif')
+            with rasterio.open(output_path, 'w', driver='GTiff', height=shape[0], width=shape[1], count=1,
+                               dtype=array.dtype, crs=crs, transform=transform, tiled=True,
+                               blockxsize=256, blockysize=256, compress='deflate') as dst:
+                dst.write(array, 1)
+    save_sources(positions, rates, os.path.join(output_dir, 'sources.csv'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--datacube', help='Write a synthetic scenario datacube to this directory instead')
+    parser.add_argument('--size', type=int, default=1000, help='Height and width of the scenario maps')
+    parser.add_argument('--days', type=int, default=365, help='Number of scenario days, from 2023-01-01')
+    parser.add_argument('--sources', type=int, default=100, help='Number of point sources')
+    args = parser.parse_args()
+
+    if args.datacube:
+        shape = (args.size, args.size)
+        scenario_dates = np.datetime64('2023-01-01') + np.arange(args.days)
+        source_positions, emission_rates = make_point_sources(args.sources, shape, seed=0)
+        write_scenario_datacube(args.datacube, shape, scenario_dates, source_positions, emission_rates, seed=0)
+        print(f"Synthetic datacube of {args.days} days saved to {args.datacube}")
+    else:
+        input_raster_path = DATA_DIR/'NO2_plant_larger.tif'
+        point_gpkg_path = '/home/cedric/plant_point_2.gpkg'
+        output_raster_path = DATA_DIR/'NO2_simulated.tif'
+
+        create_concentrated_decay_raster(input_raster_path, point_gpkg_path, output_raster_path)
+
 
-create_concentrated_decay_raster(input_raster_path, point_gpkg_path, output_raster_path)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
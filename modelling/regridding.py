@@ -0,0 +1,154 @@
+import functools
+import numpy as np
+from scipy import sparse
+
+
+def _axis_positions(n_src, n_dst, src_origin=None, src_step=None, dst_origin=None, dst_step=None):
+    """
+    Target pixel centres and edges along one axis, in source index coordinates.
+
+    Without geotransforms, the target grid spans the source grid end to end, as
+    in interpolate_wind_to_no2_grid.
+    """
+    if src_origin is None:
+        centers = np.linspace(0, n_src - 1, n_dst)
+        edges = np.linspace(-0.5, n_src - 0.5, n_dst + 1)
+        return centers, edges
+
+    dst_edges = dst_origin + np.arange(n_dst + 1) * dst_step
+    edges = (dst_edges - src_origin) / src_step - 0.5
+    centers = (edges[:-1] + edges[1:]) / 2
+    return centers, edges
+
+
+def _bilinear_weights(centers, n_src):
+    """Sparse (n_dst, n_src) linear interpolation matrix, clamped at the edges."""
+    n_dst = len(centers)
+    rows = np.arange(n_dst)
+    if n_src == 1:
+        return sparse.csr_matrix((np.ones(n_dst), (rows, np.zeros(n_dst, dtype=int))), shape=(n_dst, 1))
+
+    positions = np.clip(centers, 0, n_src - 1)
+    lower = np.minimum(np.floor(positions).astype(int), n_src - 2)
+    frac = positions - lower
+    data = np.concatenate([1 - frac, frac])
+    return sparse.csr_matrix((data, (np.tile(rows, 2), np.concatenate([lower, lower + 1]))),
+                             shape=(n_dst, n_src))
+
+
+def _conservative_weights(edges, n_src):
+    """Sparse (n_dst, n_src) area-weighted matrix from 1D cell overlaps."""
+    rows, cols, data = [], [], []
+    for j in range(len(edges) - 1):
+        lo, hi = sorted((edges[j], edges[j + 1]))
+        lo, hi = max(lo, -0.5), min(hi, n_src - 0.5)
+        if hi <= lo:
+            continue
+        cells = np.arange(int(np.floor(lo + 0.5)), int(np.ceil(hi + 0.5)))
+        cells = cells[(cells >= 0) & (cells < n_src)]
+        overlap = np.minimum(cells + 0.5, hi) - np.maximum(cells - 0.5, lo)
+        keep = overlap > 0
+        rows.extend([j] * int(keep.sum()))
+        cols.extend(cells[keep])
+        # Normalize so cells partly outside the source still average correctly
+        data.extend(overlap[keep] / overlap[keep].sum())
+    return sparse.csr_matrix((data, (rows, cols)), shape=(len(edges) - 1, n_src))
+
+
+@functools.lru_cache(maxsize=32)
+def regrid_operator(src_shape, dst_shape, src_transform=None, dst_transform=None, method='bilinear'):
+    """
+    Separable regridding weights for a (source shape, target shape, transforms) pair.
+
+    Results are cached, so the weights are computed once per grid pair and reused
+    for every date. Transforms are north-up affine geotransforms (e.g. rasterio's
+    Affine); without them the target grid spans the source grid end to end.
+
+    Returns:
+    tuple: sparse row weights (H_dst, H_src), sparse column weights (W_dst, W_src)
+    """
+    if (src_transform is None) != (dst_transform is None):
+        raise ValueError("Both source and target transforms are needed to regrid in map coordinates")
+    if method not in ('bilinear', 'conservative'):
+        raise ValueError(f"Unknown regridding method: {method}")
+
+    if src_transform is None:
+        y_axis = _axis_positions(src_shape[0], dst_shape[0])
+        x_axis = _axis_positions(src_shape[1], dst_shape[1])
+    else:
+        src_a, _, src_c, _, src_e, src_f = tuple(src_transform)[:6]
+        dst_a, _, dst_c, _, dst_e, dst_f = tuple(dst_transform)[:6]
+        y_axis = _axis_positions(src_shape[0], dst_shape[0], src_f, src_e, dst_f, dst_e)
+        x_axis = _axis_positions(src_shape[1], dst_shape[1], src_c, src_a, dst_c, dst_a)
+
+    if method == 'bilinear':
+        return _bilinear_weights(y_axis[0], src_shape[0]), _bilinear_weights(x_axis[0], src_shape[1])
+    return _conservative_weights(y_axis[1], src_shape[0]), _conservative_weights(x_axis[1], src_shape[1])
+
+
+def regrid_stack(stack, dst_shape, src_transform=None, dst_transform=None, method='bilinear'):
+    """
+    Regrid a (T, H, W) stack, or a single (H, W) map, onto a target grid.
+
+    Applies the cached row and column weights as two sparse matrix products over
+    the whole stack. float32 input stays float32.
+    """
+    stack = np.asarray(stack)
+    single = stack.ndim == 2
+    if single:
+        stack = stack[None]
+    n_days, src_height, src_width = stack.shape
+    dst_height, dst_width = dst_shape
+
+    row_weights, col_weights = regrid_operator((src_height, src_width), tuple(dst_shape),
+                                               src_transform, dst_transform, method)
+    dtype = np.result_type(stack.dtype, np.float32)
+    row_weights, col_weights = row_weights.astype(dtype), col_weights.astype(dtype)
+
+    # Columns: (W_dst, W_src) @ (W_src, T*H_src)
+    columns = col_weights @ stack.reshape(-1, src_width).T
+    columns = columns.reshape(dst_width, n_days, src_height).transpose(2, 1, 0).reshape(src_height, -1)
+    # Rows: (H_dst, H_src) @ (H_src, T*W_dst)
+    result = (row_weights @ columns).reshape(dst_height, n_days, dst_width).transpose(1, 0, 2)
+    result = np.ascontiguousarray(result)
+    return result[0] if single else result
+
+
+def regrid_masked(stack, missing, dst_shape, src_transform=None, dst_transform=None, method='bilinear',
+                  min_weight=0.5):
+    """
+    Regrid a stack while excluding its missing pixels.
+
+    Missing pixels get zero weight and the weights of each target pixel are
+    renormalized over its valid sources. Target pixels whose valid weight is
+    below min_weight are reported missing.
+
+    Returns:
+    tuple: regridded stack, boolean missing mask on the target grid
+    """
+    stack = np.asarray(stack)
+    dtype = np.result_type(stack.dtype, np.float32)
+    valid = ~np.asarray(missing)
+    regridded = regrid_stack(np.where(valid, stack, 0).astype(dtype, copy=False), dst_shape,
+                             src_transform, dst_transform, method)
+    weight = regrid_stack(valid.astype(dtype), dst_shape, src_transform, dst_transform, method)
+    dst_missing = weight < min_weight
+    regridded /= np.where(dst_missing, 1, weight)
+    return regridded, dst_missing
+
+
+def regrid_wind_stack(u_wind, v_wind, dst_shape, src_transform=None, dst_transform=None, method='bilinear',
+                      missing=None):
+    """
+    Regrid U and V wind stacks onto the NO2 grid with the same cached operator.
+
+    With a boolean missing mask of the wind grid, missing pixels are excluded
+    as in regrid_masked and the missing mask of the NO2 grid is returned as a
+    third value.
+    """
+    if missing is None:
+        return (regrid_stack(u_wind, dst_shape, src_transform, dst_transform, method),
+                regrid_stack(v_wind, dst_shape, src_transform, dst_transform, method))
+    u_regridded, dst_missing = regrid_masked(u_wind, missing, dst_shape, src_transform, dst_transform, method)
+    v_regridded, _ = regrid_masked(v_wind, missing, dst_shape, src_transform, dst_transform, method)
+    return u_regridded, v_regridded, dst_missing
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from aggregation import StreamingAggregator
+
+
+def daily_maps(days=30, shape=(6, 7), seed=0):
+    rng = np.random.default_rng(seed)
+    maps = rng.normal(100, 20, (days, *shape))
+    maps[rng.random(maps.shape) < 0.2] = np.nan
+    maps[:, 0, 0] = np.nan
+    return maps
+
+
+def test_welford_statistics_match_numpy():
+    maps = daily_maps()
+    aggregator = StreamingAggregator().update_all(maps)
+    with pytest.warns(RuntimeWarning):  # numpy warns about the all-NaN pixel
+        np.testing.assert_allclose(aggregator.mean, np.nanmean(maps, axis=0), rtol=1e-12)
+        np.testing.assert_allclose(aggregator.variance(), np.nanvar(maps, axis=0), rtol=1e-10)
+        np.testing.assert_allclose(aggregator.variance(ddof=1), np.nanvar(maps, axis=0, ddof=1), rtol=1e-10)
+        np.testing.assert_allclose(aggregator.minimum, np.nanmin(maps, axis=0))
+        np.testing.assert_allclose(aggregator.maximum, np.nanmax(maps, axis=0))
+
+
+def test_nan_pixels_are_skipped():
+    maps = daily_maps()
+    result = StreamingAggregator().update_all(maps).result()
+    assert result['count'] == len(maps)
+    np.testing.assert_array_equal(result['valid_count'], (~np.isnan(maps)).sum(axis=0))
+    # A pixel that was never valid has no statistics
+    assert result['valid_count'][0, 0] == 0
+    assert np.isnan([result['mean'][0, 0], result['variance'][0, 0], result['min'][0, 0]]).all()
+
+
+def test_update_all_matches_repeated_update():
+    maps = daily_maps()
+    repeated = StreamingAggregator()
+    for array in maps:
+        repeated.update(array)
+    streamed = StreamingAggregator().update_all(iter(maps))
+    for name, values in repeated.result().items():
+        np.testing.assert_array_equal(streamed.result()[name], values)
+
+
+def test_float32_mean_and_shape_check():
+    maps = daily_maps()
+    aggregator = StreamingAggregator(np.float32).update_all(maps)
+    assert aggregator.mean.dtype == np.float32
+    with pytest.warns(RuntimeWarning):
+        np.testing.assert_allclose(aggregator.mean, np.nanmean(maps, axis=0), rtol=1e-5)
+    with pytest.raises(ValueError):
+        aggregator.update(np.zeros((3, 3)))
+    with pytest.raises(ValueError):
+        StreamingAggregator().mean
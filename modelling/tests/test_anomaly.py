@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import anomaly
+from anomaly import EwmaAnomalyDetector, flag_anomalies
+from emissions_store import EmissionsStore
+
+
+def daily_emissions(sites=('a', 'b', 'c'), days=80, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2023-01-01', periods=days, freq='D')
+    df = pd.DataFrame([(site, date) for site in sites for date in dates], columns=['Site', 'Date'])
+    df['NOx_Emissions_kg_per_day'] = rng.normal(1000, 50, len(df))
+    # Spikes after the warmup, some of them flagged
+    df.loc[rng.choice(np.flatnonzero(df['Date'] > dates[20]), 12, replace=False), 'NOx_Emissions_kg_per_day'] *= 2
+    return df
+
+
+def test_incremental_matches_full_run(tmp_path):
+    df = daily_emissions()
+    full, _ = flag_anomalies(df)
+    assert full['Anomaly'].any()
+
+    # Site 'c' reports its last ten days of the first batch only with the second batch
+    cutoff = pd.Timestamp('2023-02-15')
+    late = (df['Site'] == 'c') & (df['Date'] > cutoff - pd.Timedelta(days=10)) & (df['Date'] <= cutoff)
+    first, detector = flag_anomalies(df[(df['Date'] <= cutoff) & ~late])
+    detector.save(tmp_path / 'state.npz')
+    detector = EwmaAnomalyDetector.load(tmp_path / 'state.npz')
+    assert detector.last_date.tolist() == [np.datetime64('2023-02-15'), np.datetime64('2023-02-15'),
+                                           np.datetime64('2023-02-05')]
+
+    # The second run sees the whole table with the first run's flags, as anomaly.py's CSV
+    table = df.merge(first[['Site', 'Date', 'Anomaly']], on=['Site', 'Date'], how='left')
+    table['Anomaly'] = table['Anomaly'].fillna(False).astype(bool)
+    second, detector = flag_anomalies(table, detector)
+    pd.testing.assert_series_equal(second['Anomaly'], full['Anomaly'])
+    assert (detector.last_date == np.datetime64('2023-03-21')).all()
+
+
+def test_new_site_starts_from_an_empty_baseline():
+    df = daily_emissions(sites=('a',))
+    _, detector = flag_anomalies(df)
+    df_b = daily_emissions(sites=('b',), seed=1)
+    flagged, detector = flag_anomalies(pd.concat([df, df_b], ignore_index=True), detector)
+    expected, _ = flag_anomalies(df_b)
+    np.testing.assert_array_equal(flagged.loc[flagged['Site'] == 'b', 'Anomaly'], expected['Anomaly'])
+
+
+def test_main_reads_and_appends_only_new_rows(tmp_path, monkeypatch):
+    df = daily_emissions()
+    csv_path, output_path = tmp_path / 'emissions.csv', tmp_path / 'daily.csv'
+    state_path, store_path = tmp_path / 'state.npz', tmp_path / 'store'
+    df[df['Date'] < '2023-03-01'].to_csv(csv_path, index=False)
+    anomaly.main(csv_path, output_path, state_path, store_path)
+    first_output = output_path.read_bytes()
+
+    # Rows already read are not read again: a corrupted one would fail to parse
+    content = csv_path.read_bytes()
+    csv_path.write_bytes(content.replace(b'1', b'x', 1))
+    df[df['Date'] >= '2023-03-01'].to_csv(csv_path, mode='a', header=False, index=False)
+
+    published = []
+    add_days = EmissionsStore.add_days
+    monkeypatch.setattr(EmissionsStore, 'add_days',
+                        lambda store, site, dates, *args: published.append(len(dates)) or add_days(store, site, dates, *args))
+    # A run interrupted before saving its state appends nothing twice
+    saved_state = state_path.read_bytes()
+    anomaly.main(csv_path, output_path, state_path, store_path)
+    state_path.write_bytes(saved_state)
+    anomaly.main(csv_path, output_path, state_path, store_path)
+    assert published == [21, 21, 21] * 2
+    assert output_path.read_bytes().startswith(first_output)
+
+    full, _ = flag_anomalies(df)
+    output = pd.read_csv(output_path, parse_dates=['Date'])
+    pd.testing.assert_frame_equal(output.sort_values(['Site', 'Date'], ignore_index=True), full)
+    store = EmissionsStore(str(store_path))
+    for site in ('a', 'b', 'c'):
+        np.testing.assert_array_equal(store.read(site)['anomaly'], full.loc[full['Site'] == site, 'Anomaly'])
@@ -0,0 +1,92 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+import api
+from datacube import Datacube
+
+POINT = {'type': 'Point', 'coordinates': [14.5, 54.5]}
+
+
+@pytest.fixture
+def service(tmp_path):
+    dates = np.arange(np.datetime64('2023-01-01'), np.datetime64('2023-01-05'))
+    Datacube.create(str(tmp_path / 'cube'), dates, (20, 20), {'divergence': np.float32}).flush()
+    np.save(tmp_path / 'lats.npy', np.linspace(55, 54, 20))
+    np.save(tmp_path / 'lons.npy', np.linspace(14, 15, 20))
+    service = api.EmissionsService(str(tmp_path / 'cube'), str(tmp_path / 'lats.npy'), str(tmp_path / 'lons.npy'))
+    # Threads instead of processes, so the estimate can be replaced in tests
+    service.executor = ThreadPoolExecutor(max_workers=2)
+    yield service
+    service.close()
+
+
+def request_body(**fields):
+    return json.dumps(dict({'site': POINT, 'start': '2023-01-01', 'end': '2023-01-04'}, **fields)).encode()
+
+
+async def http_post(service, body):
+    server = await asyncio.start_server(api.make_handler(service), '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'POST /emissions HTTP/1.1\r\nConnection: close\r\n'
+                     + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+    head, _, content = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(content) if content.startswith(b'{') else content
+
+
+@pytest.mark.parametrize('fields', [{'params': None}, {'params': {}}])
+def test_missing_params_use_defaults(service, fields):
+    _, _, _, params, _ = service.parse_request(request_body(**fields))
+    assert params == api.DEFAULT_PARAMS
+
+
+@pytest.mark.parametrize('fields', [{'params': [1]}, {'params': {'bogus': 1}}, {'params': {'threshold': 'x'}},
+                                    {'format': 'xml'}, {'site': 1}])
+def test_invalid_requests_are_client_errors(service, fields):
+    status, content = asyncio.run(http_post(service, request_body(**fields)))
+    assert status == 400
+    assert 'Invalid request' in content['error']
+
+
+def test_date_range_without_days_is_a_client_error(service):
+    status, _ = asyncio.run(http_post(service, request_body(start='2024-01-01', end='2024-01-31')))
+    assert status == 400
+
+
+def test_computation_failures_are_server_errors(service, monkeypatch):
+    def fail(*args):
+        raise ValueError("fit failed")
+
+    monkeypatch.setattr(api, 'estimate_site_emissions', fail)
+    status, content = asyncio.run(http_post(service, request_body()))
+    assert status == 500
+    assert 'fit failed' in content['error']
+
+
+def test_repeat_queries_are_served_from_the_cache(service):
+    async def query_twice():
+        first = await service.emissions(request_body())
+        second = await service.emissions(request_body())
+        return first, second
+
+    (_, first, first_cached), (_, second, second_cached) = asyncio.run(query_twice())
+    assert (first_cached, second_cached) == (False, True)
+    assert first == second
+    assert json.loads(first)['days'] == 4
+
+
+def test_cache_evicts_least_recently_used_entries_by_size():
+    cache = api.ResultCache(max_bytes=10)
+    cache.put('a', b'1234')
+    cache.put('b', b'1234')
+    cache.get('a')
+    cache.put('c', b'1234')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234' and cache.get('c') == b'1234'
+    assert cache.size == 8
@@ -0,0 +1,52 @@
+import os
+import warnings
+import matplotlib.pyplot as plt
+import numpy as np
+from batch_rendering import MapLayout, render_dates, value_range
+from benchmarks import baseline_plot_data
+from datacube import Datacube
+
+
+def test_value_range():
+    assert value_range(np.array([[np.nan, 2.0], [-1.0, np.inf]])) == (-1.0, 2.0)
+    assert value_range(np.full((3, 3), np.nan)) == (0.0, 1.0)
+    assert value_range(np.full((3, 3), 5.0)) == (5.0, 6.0)
+
+
+def test_render_all_nan_day(tmp_path):
+    layout = MapLayout('no2_and_wind_map', (20, 30), dpi=20)
+    blank = np.full((20, 30), np.nan, dtype=np.float32)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        layout.render('2023-01-01', str(tmp_path), no2=blank, u_wind=np.zeros((20, 30)), v_wind=np.zeros((20, 30)))
+    assert layout.artists['no2'].get_clim() == (0.0, 1.0)
+    assert os.listdir(tmp_path) == ['no2_and_wind_map_2023-01-01.png']
+
+
+def test_appending_a_day_renders_only_that_day(tmp_path):
+    cube_dir, output_dir = str(tmp_path / 'cube'), str(tmp_path / 'maps')
+    dates = ['2023-01-01', '2023-01-02']
+    cube = Datacube.create(cube_dir, dates, (10, 12), {'no2': np.float32})
+    for i, date in enumerate(dates):
+        cube.write('no2', date, np.full((10, 12), i, dtype=np.float32))
+    cube.flush()
+    assert len(render_dates(cube_dir, output_dir, ('no2_map',), dpi=10)) == 2
+    assert render_dates(cube_dir, output_dir, ('no2_map',), dpi=10) == []
+
+    cube = Datacube.open_or_create(cube_dir, dates + ['2023-01-03'], (10, 12), {'no2': np.float32})
+    cube.write('no2', '2023-01-03', np.full((10, 12), 2, dtype=np.float32))
+    cube.flush()
+    rendered = render_dates(cube_dir, output_dir, ('no2_map',), dpi=10)
+    assert [os.path.basename(path) for path in rendered] == ['no2_map_2023-01-03.png']
+
+
+def test_layout_matches_the_per_date_plot(tmp_path):
+    rng = np.random.default_rng(0)
+    no2, u_wind, v_wind, divergence = rng.random((4, 40, 50)) * [[[1e-4]], [[10]], [[10]], [[1e-6]]]
+    (tmp_path / 'baseline').mkdir()
+    baseline_plot_data(no2, u_wind, v_wind, divergence, '2023-01-01', str(tmp_path / 'baseline'))
+    layout = MapLayout('nox_emission_analysis', (40, 50))
+    layout.render('2023-01-01', str(tmp_path), no2=no2, u_wind=u_wind, v_wind=v_wind, divergence=divergence)
+    # Same margins: the layout is fitted to each date's tick labels and cropped to the drawn content
+    expected = plt.imread(str(tmp_path / 'baseline' / 'nox_emission_analysis_2023-01-01.png'))
+    assert plt.imread(str(tmp_path / 'nox_emission_analysis_2023-01-01.png')).shape == expected.shape
@@ -0,0 +1,15 @@
+import json
+import benchmarks
+
+
+def test_run_prints_only_the_summary_table(tmp_path, capsys):
+    grid = {'size': [20], 'days': [3], 'peaks': [2]}
+    benchmarks.run(str(tmp_path / 'results.json'), grid, 'divergence', repeats=1)
+    lines = capsys.readouterr().out.splitlines()
+    with open(tmp_path / 'results.json') as f:
+        names = [result['name'] for result in json.load(f)['results']]
+    assert 'compute_divergence_tiled' in names
+    assert lines[0].split()[0] == 'benchmark' and [line.split()[0] for line in lines[1:]] == names
+
+    benchmarks.run(str(tmp_path / 'results.json'), grid, 'compute_divergence_tiled', repeats=1, verbose=True)
+    assert 'Processed divergence' in capsys.readouterr().out
@@ -0,0 +1,69 @@
+import os
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from correct_wind import fill_gaps, fill_gaps_and_save, fill_gaps_in_directories
+
+
+def write_raster(path, data):
+    with rasterio.open(path, 'w', driver='GTiff', height=data.shape[0], width=data.shape[1], count=1,
+                       dtype=data.dtype, crs='EPSG:4326', transform=from_origin(14.0, 55.0, 0.25, 0.25)) as dst:
+        dst.write(data, 1)
+
+
+def read_raster(path):
+    with rasterio.open(path) as src:
+        return src.read(1)
+
+
+def test_fill_gaps_edge_copies_nearest_row():
+    data = np.arange(12, dtype=np.float64).reshape(4, 3)
+    data[0] = np.nan
+    filled = fill_gaps(data, 'edge')
+    np.testing.assert_array_equal(filled[0], data[1])
+    np.testing.assert_array_equal(filled[1:], data[1:])
+
+
+def test_gap_free_output_follows_a_replaced_input(tmp_path):
+    input_dir, output_dir = tmp_path / 'in', tmp_path / 'out'
+    input_dir.mkdir()
+    output_dir.mkdir()
+    source = str(input_dir / 'u_2023-01-01.tif')
+    write_raster(source, np.ones((4, 4), dtype=np.float32))
+    output_file, filled = fill_gaps_and_save(source, str(output_dir))
+    assert not filled
+
+    # A new version of the input replaces the file, the old output must not be kept
+    os.remove(source)
+    write_raster(source, np.full((4, 4), 2, dtype=np.float32))
+    fill_gaps_and_save(source, str(output_dir))
+    np.testing.assert_array_equal(read_raster(output_file), 2)
+
+
+def test_filled_output_leaves_only_tif_rasters(tmp_path):
+    source = str(tmp_path / 'u_2023-01-01.tif')
+    data = np.ones((4, 4), dtype=np.float32)
+    data[0] = np.nan
+    write_raster(source, data)
+    output_dir = tmp_path / 'out'
+    output_dir.mkdir()
+    output_file, filled = fill_gaps_and_save(source, str(output_dir))
+    assert filled
+    assert os.listdir(output_dir) == ['u_2023-01-01.tif']
+    assert not np.isnan(read_raster(output_file)).any()
+
+
+def test_raster_without_valid_pixels_is_copied_and_others_filled(tmp_path, capsys):
+    input_dir, output_dir = tmp_path / 'in', tmp_path / 'out'
+    input_dir.mkdir()
+    data = np.ones((4, 4), dtype=np.float32)
+    data[0] = np.nan
+    write_raster(str(input_dir / 'u_2023-01-01.tif'), np.full((4, 4), np.nan, dtype=np.float32))
+    write_raster(str(input_dir / 'u_2023-01-02.tif'), data)
+    fill_gaps_in_directories([(str(input_dir), str(output_dir))], workers=2)
+
+    assert sorted(os.listdir(output_dir)) == ['u_2023-01-01.tif', 'u_2023-01-02.tif']
+    assert np.isnan(read_raster(str(output_dir / 'u_2023-01-01.tif'))).all()
+    np.testing.assert_array_equal(read_raster(str(output_dir / 'u_2023-01-02.tif')), 1)
+    assert f"Could not fill, copied as is (Cannot fill a raster without any valid pixel): " \
+           f"{output_dir / 'u_2023-01-01.tif'}" in capsys.readouterr().out
@@ -0,0 +1,85 @@
+import os
+import numpy as np
+import pytest
+from datacube import Datacube, _grow_npy, _recover_rebuild
+
+DATES = ['2023-01-01', '2023-01-02', '2023-01-03']
+
+
+def make_cube(path, dates=DATES):
+    cube = Datacube.create(path, dates, (4, 5), {'no2': np.float32, 'divergence': np.float64})
+    for i, date in enumerate(dates):
+        cube.write('no2', date, np.full((4, 5), i, dtype=np.float32))
+        cube.write('divergence', date, np.full((4, 5), -i, dtype=np.float64))
+    cube.flush()
+    return cube
+
+
+def test_date_slice_and_read(tmp_path):
+    cube = make_cube(str(tmp_path / 'cube'))
+    assert cube.date_slice('2023-01-02', '2023-01-03') == slice(1, 3)
+    assert cube.date_slice('2023-01', '2023-01') == slice(0, 3)
+    data, dates = cube.read('no2', '2023-01-02')
+    np.testing.assert_array_equal(data[:, 0, 0], [1, 2])
+    with pytest.raises(KeyError):
+        cube.index_of('2023-02-01')
+
+
+def test_append_grows_in_place(tmp_path):
+    path = str(tmp_path / 'cube')
+    make_cube(path)
+    inode = os.stat(os.path.join(path, 'no2.npy')).st_ino
+
+    cube = Datacube.open_or_create(path, DATES + ['2023-01-04'], (4, 5), {'no2': np.float32})
+    assert os.stat(os.path.join(path, 'no2.npy')).st_ino == inode
+    assert len(cube) == 4 and cube.array('divergence').shape == (4, 4, 5)
+    np.testing.assert_array_equal(cube.array('no2')[:3, 0, 0], [0, 1, 2])
+    np.testing.assert_array_equal(cube.array('divergence')[:3, 0, 0], [0, -1, -2])
+    np.testing.assert_array_equal(cube.array('no2')[3], 0)
+
+    cube.write('no2', '2023-01-04', np.full((4, 5), 3, dtype=np.float32))
+    cube.flush()
+    np.testing.assert_array_equal(np.load(os.path.join(path, 'no2.npy'))[:, 0, 0], [0, 1, 2, 3])
+
+
+def test_interrupted_append_keeps_previous_dates(tmp_path):
+    path = str(tmp_path / 'cube')
+    make_cube(path)
+    # Variable files grown, but dates.npy not replaced yet
+    cube = Datacube(path)
+    for name in cube.variables:
+        assert _grow_npy(cube.variable_path(name), 5)
+
+    cube = Datacube(path)
+    assert len(cube) == 3 and cube.array('no2').shape == (3, 4, 5)
+    np.testing.assert_array_equal(cube.array('no2')[:, 0, 0], [0, 1, 2])
+
+    cube = Datacube.open_or_create(path, DATES + ['2023-01-04'], (4, 5))
+    assert cube.array('no2').shape == (4, 4, 5)
+    assert np.load(cube.variable_path('no2')).shape == (4, 4, 5)
+
+
+def test_other_date_changes_rebuild(tmp_path):
+    path = str(tmp_path / 'cube')
+    make_cube(path)
+    cube = Datacube.open_or_create(path, ['2022-12-31', '2023-01-02', '2023-01-03'], (4, 5))
+    # 2022-12-31 is new and left empty, the other days are copied over
+    np.testing.assert_array_equal(cube.array('no2')[:, 0, 0], [0, 1, 2])
+    assert not os.path.exists(path + '.tmp') and not os.path.exists(path + '.old')
+
+    cube = Datacube.open_or_create(path, DATES[1:], (4, 5), {'no2': np.float64})
+    assert cube.variables['no2'] == np.dtype(np.float64).str
+    np.testing.assert_array_equal(cube.array('no2')[:, 0, 0], [1, 2])
+
+
+@pytest.mark.parametrize('rebuilt', [True, False])
+def test_recover_interrupted_rebuild(tmp_path, rebuilt):
+    path = str(tmp_path / 'cube')
+    make_cube(path)
+    os.replace(path, path + '.old')
+    if rebuilt:
+        make_cube(path + '.tmp', DATES[:2])
+
+    _recover_rebuild(path)
+    assert not os.path.exists(path + '.old')
+    assert len(Datacube(path)) == (2 if rebuilt else 3)
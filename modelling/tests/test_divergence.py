@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from datacube import Datacube
+from manifest import StageManifest
+import model
+from model import (calculate_divergence, calculate_divergence_stack, calculate_flux, calculate_flux_stack,
+                   compute_divergence)
+
+DATES = np.datetime64('2023-01-01') + np.arange(7)
+SHAPE = (23, 37)
+
+
+def make_cube(path, masked=False, seed=0, cube_id=None):
+    """A float64 datacube of random inputs, with a 'missing' variable when masked."""
+    rng = np.random.default_rng(seed)
+    variables = {'no2': np.float64, 'u_wind': np.float64, 'v_wind': np.float64}
+    if masked:
+        variables['missing'] = bool
+    cube = Datacube.create(str(path), DATES, SHAPE, variables, cube_id=cube_id)
+    cube.array('no2')[:] = rng.gamma(2.0, 1e-5, (len(DATES), *SHAPE))
+    cube.array('u_wind')[:] = rng.normal(size=(len(DATES), *SHAPE))
+    cube.array('v_wind')[:] = rng.normal(size=(len(DATES), *SHAPE))
+    if masked:
+        cube.array('missing')[:] = rng.random((len(DATES), *SHAPE)) < 0.05
+    cube.flush()
+    return str(path)
+
+
+@pytest.mark.parametrize('masked', [False, True])
+def test_tiled_divergence_is_bit_identical_to_untiled(tmp_path, masked):
+    untiled = make_cube(tmp_path / 'untiled', masked)
+    compute_divergence(untiled, batch_size=3)
+    expected = np.array(Datacube(untiled).array('divergence'))
+    assert np.isnan(expected).any() == masked
+
+    # Tiles that do not divide the grid, so the last row and column of tiles are partial
+    for tile_shape in ((8, 10), (5, 37), (23, 1)):
+        tiled = make_cube(tmp_path / f'tiled_{tile_shape[0]}_{tile_shape[1]}', masked)
+        compute_divergence(tiled, batch_size=3, tile_shape=tile_shape)
+        np.testing.assert_array_equal(Datacube(tiled).array('divergence'), expected)
+
+
+def test_stack_divergence_matches_per_day_divergence():
+    rng = np.random.default_rng(1)
+    no2 = rng.gamma(2.0, 1e-5, (4, *SHAPE))
+    u_wind, v_wind = rng.normal(size=(2, 4, *SHAPE))
+    flux_u, flux_v = np.empty_like(no2), np.empty_like(no2)
+    assert calculate_flux_stack(no2, u_wind, v_wind, flux_u, flux_v)[0] is flux_u
+    divergence = calculate_divergence_stack(flux_u, flux_v)
+    for day in range(len(no2)):
+        expected = calculate_divergence(*calculate_flux(no2[day], u_wind[day], v_wind[day]))
+        np.testing.assert_array_equal(divergence[day], expected)
+
+    # Writing into scratch=flux_u gives the same result
+    expected = divergence.copy()
+    np.testing.assert_array_equal(calculate_divergence_stack(flux_u, flux_v, scratch=flux_u), expected)
+
+
+def test_serial_batches_share_flux_buffers(tmp_path, monkeypatch):
+    path = make_cube(tmp_path / 'cube', masked=True)
+    buffers = []
+
+    def record_buffers(no2, u_wind, v_wind, flux_u=None, flux_v=None, missing=None):
+        buffers.append((flux_u.base, flux_v.base))
+        return calculate_flux_stack(no2, u_wind, v_wind, flux_u, flux_v, missing)
+
+    monkeypatch.setattr(model, 'calculate_flux_stack', record_buffers)
+    compute_divergence(path, batch_size=3)
+    assert len(buffers) == 3 and all(pair[0] is buffers[0][0] and pair[1] is buffers[0][1] for pair in buffers)
+
+    monkeypatch.undo()
+    expected = make_cube(tmp_path / 'expected', masked=True)
+    compute_divergence(expected, batch_size=3, workers=2)
+    np.testing.assert_array_equal(Datacube(path).array('divergence'), Datacube(expected).array('divergence'))
+
+
+@pytest.mark.parametrize('tile_shape', [None, (8, 10)])
+def test_parallel_divergence_matches_serial(tmp_path, tile_shape):
+    results = []
+    for workers in (1, 2):
+        # The same datacube id, as the manifest fingerprints include it
+        path = make_cube(tmp_path / f'workers_{workers}', masked=True, cube_id='cube')
+        manifest = StageManifest(str(tmp_path / f'manifest_{workers}.json'))
+        compute_divergence(path, batch_size=3, workers=workers, manifest=manifest, tile_shape=tile_shape)
+        records = {key: (record['fingerprint'], record['output_fingerprint'])
+                   for key, record in manifest.entries['divergence'].items()}
+        results.append((np.array(Datacube(path).array('divergence')), list(records.items())))
+
+    (serial, serial_records), (parallel, parallel_records) = results
+    np.testing.assert_array_equal(parallel, serial)
+    assert parallel_records == serial_records
+    assert [key for key, _ in serial_records] == [str(date) for date in DATES]
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+from emissions_store import EmissionsStore
+
+
+def daily_table(start, days, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'Date': pd.date_range(start, periods=days, freq='D'),
+                         'NOx_Emissions_kg_per_day': rng.uniform(0, 5000, days),
+                         'Anomaly': rng.random(days) < 0.1})
+
+
+def expected_yearly(df):
+    yearly = df.groupby(df['Date'].dt.year).agg(total=('NOx_Emissions_kg_per_day', 'sum'),
+                                                days=('Date', 'size'), anomalies=('Anomaly', 'sum'))
+    return yearly.reset_index(drop=True)
+
+
+def check_rollups(store, df, site='plant'):
+    yearly = store.yearly()
+    yearly = yearly[yearly['Site'] == site].reset_index(drop=True)
+    expected = expected_yearly(df)
+    np.testing.assert_allclose(yearly['Yearly_NOx_Emissions_kg'], expected['total'])
+    np.testing.assert_array_equal(yearly['Days'], expected['days'])
+    np.testing.assert_array_equal(yearly['Anomalies'], expected['anomalies'])
+
+    monthly = store.monthly()
+    monthly = monthly[monthly['Site'] == site]
+    expected = df.groupby([df['Date'].dt.year, df['Date'].dt.month])['Anomaly'].sum().to_numpy()
+    np.testing.assert_array_equal(monthly['Anomalies'], expected)
+
+
+def test_appends_match_groupby(tmp_path):
+    df = daily_table('2022-11-01', 120)
+    store = EmissionsStore(str(tmp_path))
+    for rows in np.array_split(np.arange(len(df)), 4):
+        part = df.iloc[rows]
+        store.append('plant', part['Date'].to_numpy(), part['NOx_Emissions_kg_per_day'], part['Anomaly'])
+    check_rollups(store, df)
+
+    store.compact('plant', 2023)
+    stored = store.read('plant')
+    np.testing.assert_array_equal(stored['anomaly'], df['Anomaly'])
+    check_rollups(EmissionsStore(str(tmp_path)), df)
+
+
+def test_missing_anomaly_flags_are_false(tmp_path):
+    store = EmissionsStore(str(tmp_path))
+    store.append('plant', ['2023-01-01', '2023-01-02', '2023-01-03'], [1.0, 2.0, 3.0], [True, np.nan, None])
+    np.testing.assert_array_equal(store.read('plant')['anomaly'], [True, False, False])
+    assert store.yearly()['Anomalies'].tolist() == [1]
+
+
+def test_add_days_updates_stored_flags_and_appends(tmp_path):
+    df = daily_table('2022-12-01', 60)
+    store = EmissionsStore(str(tmp_path))
+    store.add_days('plant', df['Date'][:50], df['NOx_Emissions_kg_per_day'][:50], df['Anomaly'][:50])
+
+    # Days flagged again with a repeated date, where the last row wins, and new days
+    df.loc[[45, 48], 'Anomaly'] = ~df.loc[[45, 48], 'Anomaly']
+    days = pd.concat([df.iloc[[48]].assign(Anomaly=~df.loc[48, 'Anomaly']), df.iloc[40:]])
+    store.add_days('plant', days['Date'], days['NOx_Emissions_kg_per_day'], days['Anomaly'])
+    np.testing.assert_array_equal(store.read('plant')['anomaly'], df['Anomaly'])
+    check_rollups(store, df)
+    assert store.update_anomalies('plant', days['Date'], days['Anomaly']) == 0
+
+
+def test_import_csv_reads_only_appended_bytes(tmp_path, monkeypatch):
+    csv_path = tmp_path / 'daily_nox_emissions.csv'
+    df = daily_table('2022-12-01', 60)
+    df.to_csv(csv_path, index=False)
+    store = EmissionsStore(str(tmp_path / 'store'))
+    store.import_csv(csv_path, 'plant')
+    check_rollups(store, df)
+
+    # Rows already imported are never read again, even if they no longer parse
+    content = csv_path.read_bytes()
+    start = content.index(b'\n') + 1
+    stop = content.index(b'\n', start)
+    csv_path.write_bytes(content[:start] + b'x' * (stop - start) + content[stop:])
+    new = daily_table('2023-01-30', 10, seed=1)
+    new.to_csv(csv_path, mode='a', header=False, index=False)
+    with open(csv_path, 'ab') as f:
+        f.write(b'2023-02-09,12.5')  # Row still being written
+    store.import_csv(csv_path, 'plant')
+    check_rollups(store, pd.concat([df, new], ignore_index=True))
+
+    read_csv = pd.read_csv
+    parsed = []
+    monkeypatch.setattr(pd, 'read_csv', lambda *args, **kwargs: parsed.append(read_csv(*args, **kwargs)) or parsed[-1])
+    store.import_csv(csv_path, 'plant')
+    assert parsed == []
+    with open(csv_path, 'ab') as f:
+        f.write(b',False\n')
+    store.import_csv(csv_path, 'plant')
+    assert len(parsed) == 1 and store.state['last_date']['plant'] == '2023-02-09'
+
+
+def test_import_csv_keeps_sites_apart(tmp_path):
+    csv_path = tmp_path / 'daily_nox_emissions.csv'
+    df = pd.concat([daily_table('2023-01-01', 20).assign(Site='a'),
+                    daily_table('2023-01-01', 20, seed=1).assign(Site='b')], ignore_index=True)
+    df.to_csv(csv_path, index=False)
+    store = EmissionsStore(str(tmp_path / 'store'))
+    store.import_csv(csv_path)
+    assert store.sites() == ['a', 'b']
+    for site in ('a', 'b'):
+        check_rollups(store, df[df['Site'] == site].reset_index(drop=True), site=site)
@@ -0,0 +1,81 @@
+import os
+import numpy as np
+import rasterio
+import export
+from datacube import Datacube
+from export import export_datacube_cogs, export_maps, export_tiles, write_cog
+from manifest import StageManifest, hash_array
+
+LATS = np.linspace(50.0, 49.0, 11)
+LONS = np.linspace(19.0, 21.0, 21)
+DATES = ['2023-01-01', '2023-01-02']
+
+
+def make_cube(path):
+    cube = Datacube.create(path, DATES, (len(LATS), len(LONS)), {'no2': np.float32, 'divergence': np.float32})
+    rng = np.random.default_rng(0)
+    for name in cube.variables:
+        cube.array(name)[:] = rng.normal(size=cube.array(name).shape)
+    cube.array('divergence')[0, 3, 4] = np.nan
+    cube.flush()
+    return cube
+
+
+def test_write_cog_round_trip(tmp_path):
+    array = np.random.default_rng(0).normal(size=(len(LATS), len(LONS))).astype(np.float32)
+    array[2, 3] = np.nan
+    path = write_cog(array, str(tmp_path / 'map.tif'), LATS, LONS)
+    with rasterio.open(path) as src:
+        np.testing.assert_array_equal(src.read(1), array)
+    assert os.listdir(tmp_path) == ['map.tif']
+
+
+def test_unchanged_days_are_skipped_without_reading(tmp_path, monkeypatch):
+    datacube_dir, output_dir = str(tmp_path / 'cube'), str(tmp_path / 'export')
+    cube = make_cube(datacube_dir)
+    manifest = StageManifest(str(tmp_path / 'manifest.json'))
+    for date in DATES:
+        index = cube.index_of(date)
+        manifest.record('interpolate', date, 'inputs', [datacube_dir], hash_array(cube.array('no2')[index]))
+        manifest.record('divergence', date, 'inputs', [datacube_dir], hash_array(cube.array('divergence')[index]))
+
+    assert len(export_datacube_cogs(datacube_dir, output_dir, LATS, LONS, manifest=manifest)) == 4
+
+    def rehash(array):
+        raise AssertionError("Days with a recorded output fingerprint must not be hashed")
+
+    monkeypatch.setattr(export, 'hash_array', rehash)
+    assert export_datacube_cogs(datacube_dir, output_dir, LATS, LONS, manifest=manifest) == []
+
+    # A recomputed day is written again
+    manifest.record('divergence', DATES[1], 'inputs', [datacube_dir], 'changed')
+    written = export_datacube_cogs(datacube_dir, output_dir, LATS, LONS, manifest=manifest)
+    assert written == [os.path.join(output_dir, 'divergence', f'divergence_{DATES[1]}.tif')]
+
+
+def test_unchanged_average_is_not_rewritten(tmp_path):
+    datacube_dir, output_dir = str(tmp_path / 'cube'), str(tmp_path / 'export')
+    cube = make_cube(datacube_dir)
+    manifest = StageManifest(str(tmp_path / 'manifest.json'))
+    average = np.nanmean(cube.array('divergence'), axis=0)
+    export_maps(datacube_dir, output_dir, LATS, LONS, average, tiles=True, max_zoom=6, manifest=manifest)
+    cog_path = os.path.join(output_dir, 'cog', 'divergence_average.tif')
+    tiles_json = os.path.join(output_dir, 'tiles', 'divergence_average', 'tiles.json')
+    mtimes = os.stat(cog_path).st_mtime_ns, os.stat(tiles_json).st_mtime_ns
+
+    export_maps(datacube_dir, output_dir, LATS, LONS, average.copy(), tiles=True, max_zoom=6, manifest=manifest)
+    assert (os.stat(cog_path).st_mtime_ns, os.stat(tiles_json).st_mtime_ns) == mtimes
+
+    export_maps(datacube_dir, output_dir, LATS, LONS, average + 1, tiles=True, max_zoom=6, manifest=manifest)
+    assert os.stat(cog_path).st_mtime_ns != mtimes[0] and os.stat(tiles_json).st_mtime_ns != mtimes[1]
+
+
+def test_smaller_pyramid_leaves_no_stale_tiles(tmp_path):
+    average = np.random.default_rng(0).normal(size=(len(LATS), len(LONS)))
+    tiles_dir = str(tmp_path / 'tiles' / 'divergence_average')
+    export_tiles(average, tiles_dir, LATS, LONS, max_zoom=6)
+    assert sorted(os.listdir(tiles_dir)) == ['0', '1', '2', '3', '4', '5', '6', 'tiles.json']
+
+    export_tiles(average, tiles_dir, LATS, LONS, max_zoom=4)
+    assert sorted(os.listdir(tiles_dir)) == ['0', '1', '2', '3', '4', 'tiles.json']
+    assert os.listdir(tmp_path / 'tiles') == ['divergence_average']
@@ -0,0 +1,35 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+from facilities import group_windows, process_facilities, to_pixel_geometries
+from model import gaussian_2d
+
+LATS = np.linspace(55.0, 54.0, 100)
+LONS = np.linspace(14.0, 15.0, 100)
+
+
+def facility_table(positions):
+    points = gpd.points_from_xy([LONS[col] for _, col in positions], [LATS[row] for row, _ in positions])
+    return gpd.GeoDataFrame({'Facility': [f'f{i}' for i in range(len(positions))]}, geometry=points,
+                            crs='EPSG:4326').set_index('Facility')
+
+
+def plume_map(positions):
+    y, x = np.mgrid[:100, :100]
+    return sum(gaussian_2d((x, y), 5.0, col, row, 3, 3, 0, 0) for row, col in positions)
+
+
+def test_overlapping_windows_are_merged():
+    footprints = to_pixel_geometries(facility_table([(30, 30), (32, 35), (80, 80)]).geometry, LATS, LONS)
+    groups = group_windows(footprints, (100, 100), margin=5)
+    assert sorted(len(members) for *_, members in groups) == [1, 2]
+
+
+@pytest.mark.parametrize('stacked', [False, True])
+def test_nan_pixels_do_not_abort_the_run(stacked):
+    divergence = plume_map([(50, 50)])
+    divergence[45, 45] = np.nan
+    if stacked:
+        divergence = np.stack([divergence] * 3)
+    report = process_facilities(divergence, facility_table([(50, 50)]), LATS, LONS)
+    assert list(report['Facility']) == ['f0']
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from scipy import optimize
+import model
+from model import (detect_and_fit_peaks_local_maxima, fit_gaussian_2d_analytic, fit_gaussian_2d_batch, gaussian_2d,
+                   gaussian_2d_jacobian)
+
+PARAMS = (5.0, 10.3, 9.6, 3.0, 2.0, 0.4, 0.1)
+
+
+def gaussian_window(params=PARAMS, size=21, noise=0.0, seed=0):
+    y, x = np.mgrid[:size, :size]
+    window = gaussian_2d((x, y), *params)
+    return window + np.random.default_rng(seed).normal(0, noise, window.shape)
+
+
+def test_analytic_jacobian_matches_finite_differences():
+    y, x = np.mgrid[:21, :21]
+    xy = (x.ravel().astype(np.float64), y.ravel().astype(np.float64))
+    analytic = gaussian_2d_jacobian(xy, *PARAMS)
+    numeric = optimize.approx_fprime(np.array(PARAMS), lambda p: gaussian_2d(xy, *p), 1e-7)
+    np.testing.assert_allclose(analytic, numeric, rtol=1e-4, atol=1e-5)
+
+
+def test_analytic_fit_recovers_parameters():
+    popt, info = fit_gaussian_2d_analytic(gaussian_window(noise=0.01))
+    assert info['converged']
+    np.testing.assert_allclose(popt[:5], PARAMS[:5], rtol=1e-2)
+
+
+def test_analytic_fit_ignores_nan_pixels():
+    window = gaussian_window(noise=0.01)
+    window[4, 4] = np.nan
+    popt, info = fit_gaussian_2d_analytic(window)
+    assert info['converged']
+    np.testing.assert_allclose(popt[:5], PARAMS[:5], rtol=1e-2)
+
+
+def test_analytic_fit_reports_empty_window_without_raising():
+    popt, info = fit_gaussian_2d_analytic(np.full((21, 21), np.nan))
+    assert not info['converged']
+    assert np.isnan(popt).all()
+
+
+def test_batch_fit_matches_analytic_fit():
+    windows = np.stack([gaussian_window(noise=0.05, seed=seed) for seed in range(4)])
+    windows[1, 0, :] = np.nan
+    popt, converged = fit_gaussian_2d_batch(windows)
+    assert converged.all()
+    for window, batch_params in zip(windows, popt):
+        single_params, _ = fit_gaussian_2d_analytic(window)
+        np.testing.assert_allclose(batch_params[:5], single_params[:5], rtol=1e-4)
+
+
+@pytest.mark.parametrize('nan_pixel', [(45, 45), (50, 50)])
+def test_local_maxima_detection_survives_nan_pixels(nan_pixel):
+    y, x = np.mgrid[:100, :100]
+    divergence = gaussian_2d((x, y), 5.0, 50, 50, 3, 3, 0, 0)
+    divergence[nan_pixel] = np.nan
+    peaks = detect_and_fit_peaks_local_maxima(divergence, threshold=0.5)
+    assert len(peaks) == 1
+
+
+def test_local_maxima_detection_drops_fits_leaving_their_window():
+    # A plume much wider than the fit window: the fitted sigmas exceed the window
+    y, x = np.mgrid[:100, :100]
+    divergence = gaussian_2d((x, y), 5.0, 50, 50, 40, 40, 0, 0)
+    fit_info = []
+    peaks = detect_and_fit_peaks_local_maxima(divergence, threshold=0.5, fit_info=fit_info)
+    assert peaks == []
+    assert len(fit_info) == 1 and not fit_info[0]['converged']
+
+
+def test_small_rounds_are_fitted_without_a_process_pool(monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError("A process pool was started for a small round")
+
+    monkeypatch.setattr(model, 'ProcessPoolExecutor', no_pool)
+    y, x = np.mgrid[:100, :100]
+    divergence = gaussian_2d((x, y), 5.0, 30, 30, 3, 3, 0, 0) + gaussian_2d((x, y), 4.0, 70, 60, 3, 3, 0, 0)
+    assert len(detect_and_fit_peaks_local_maxima(divergence, threshold=0.5, workers=8)) == 2
@@ -0,0 +1,42 @@
+import json
+import os
+import subprocess
+import sys
+import pytest
+from instrumentation import summarize_trace
+
+
+TRACED_SCRIPT = """
+import resource
+import sys
+import numpy as np
+from instrumentation import _peak_rss, enable_trace, stage
+enable_trace(sys.argv[1], run_id='test')
+# Linux keeps the parent's peak across fork and exec, so allocate past it
+with open('/proc/self/statm') as f:
+    rss = int(f.read().split()[1]) * resource.getpagesize()
+with stage('allocate') as span:
+    # Touch every page, so the allocation raises the process high-water mark
+    span.array('block', np.ones(_peak_rss() - rss + (64 << 20), dtype=np.uint8))
+with stage('idle'):
+    pass
+"""
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/statm'), reason='reads the RSS from /proc')
+def test_stage_records_peak_rss_increase(tmp_path):
+    path = tmp_path / 'trace.jsonl'
+    # A fresh process, so earlier tests have not raised its peak already
+    modelling_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, '-c', TRACED_SCRIPT, str(path)], check=True,
+                   env=dict(os.environ, PYTHONPATH=modelling_dir))
+
+    allocate, idle = [json.loads(line) for line in path.read_text().splitlines()]
+    assert allocate['peak_rss_increase'] >= 32 << 20
+    assert idle['peak_rss_increase'] == 0
+    assert idle['process_peak_rss'] >= allocate['process_peak_rss']
+
+    summary = summarize_trace(path)
+    assert summary.loc['allocate', 'peak_rss_increase'] == allocate['peak_rss_increase']
+    assert summary.loc['idle', 'calls'] == 1
+
@@ -0,0 +1,83 @@
+import os
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import box
+from load_rasters import LocalFileBackend, TimeSeriesCache, date_chunks, generate_time_series_batch, polygon_hash
+
+REQUESTS = [('NASA/GDDP-CMIP6', 'pr'), ('NASA/GDDP-CMIP6', 'tas')]
+
+
+class CountingBackend(LocalFileBackend):
+    def __init__(self, root):
+        super().__init__(root)
+        self.calls = []
+
+    def fetch(self, image_collection_id, band, polygon, start_date, end_date):
+        self.calls.append((image_collection_id, band, start_date, end_date))
+        return super().fetch(image_collection_id, band, polygon, start_date, end_date)
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    dates = pd.date_range('2019-06-01', '2021-06-30', freq='D')
+    for image_collection_id, band in REQUESTS:
+        directory = tmp_path / 'series' / image_collection_id.replace('/', '_')
+        directory.mkdir(parents=True, exist_ok=True)
+        values = np.random.default_rng(len(band)).normal(size=len(dates))
+        pd.DataFrame({'timestamp': dates, 'mean_daily': values}).to_csv(directory / f'{band}.csv', index=False)
+    polygon_path = tmp_path / 'basin.gpkg'
+    gpd.GeoDataFrame(geometry=[box(6.9, 47.1, 7.1, 47.2)], crs='EPSG:4326').to_file(polygon_path)
+    return tmp_path / 'series', polygon_path
+
+
+def test_date_chunks_follow_the_calendar():
+    assert date_chunks('2019-06-01', '2021-03-01') == [('2019-06-01', '2020-01-01'), ('2020-01-01', '2021-01-01'),
+                                                       ('2021-01-01', '2021-03-01')]
+    assert date_chunks('2020-01-15', '2020-03-01', 'MS') == [('2020-01-15', '2020-02-01'), ('2020-02-01', '2020-03-01')]
+
+
+def test_cached_chunks_are_not_fetched_again(tmp_path, inputs):
+    series_dir, polygon_path = inputs
+    backend = CountingBackend(series_dir)
+    cache_dir = tmp_path / 'cache'
+    first = generate_time_series_batch(REQUESTS, polygon_path, '2019-06-01', '2021-01-01', backend, cache_dir)
+    assert len(backend.calls) == 4
+    expected = backend.fetch(*REQUESTS[0], None, '2019-06-01', '2021-01-01')
+    pd.testing.assert_frame_equal(first[REQUESTS[0]], expected, check_freq=False)
+
+    # Extending the range only fetches the new chunk; the cache is keyed by collection, band, polygon and chunk
+    backend.calls.clear()
+    extended = generate_time_series_batch(REQUESTS, polygon_path, '2019-06-01', '2021-03-01', backend, cache_dir)
+    assert sorted(backend.calls) == [(*request, '2021-01-01', '2021-03-01') for request in REQUESTS]
+    assert len(extended[REQUESTS[1]]) == len(pd.date_range('2019-06-01', '2021-02-28'))
+    polygon_key = polygon_hash(gpd.read_file(polygon_path).geometry[0])
+    assert TimeSeriesCache(cache_dir).path(*REQUESTS[1], polygon_key, ('2020-01-01', '2021-01-01')).exists()
+
+    # Another polygon misses the cache
+    backend.calls.clear()
+    other_path = tmp_path / 'other.gpkg'
+    gpd.GeoDataFrame(geometry=[box(6.0, 47.0, 6.5, 47.5)], crs='EPSG:4326').to_file(other_path)
+    generate_time_series_batch(REQUESTS[:1], other_path, '2020-01-01', '2021-01-01', backend, cache_dir)
+    assert backend.calls == [(*REQUESTS[0], '2020-01-01', '2021-01-01')]
+
+
+def test_failed_fetch_or_write_leaves_no_cache_file(tmp_path, inputs, monkeypatch):
+    series_dir, polygon_path = inputs
+    cache_dir = tmp_path / 'cache'
+    with pytest.raises(FileNotFoundError):
+        generate_time_series_batch([('NASA/GDDP-CMIP6', 'missing')], polygon_path, '2020-01-01', '2020-03-01',
+                                   LocalFileBackend(series_dir), cache_dir)
+    assert not any(files for _, _, files in os.walk(cache_dir))
+
+    def write_partially(df, path, **kwargs):
+        with open(path, 'w') as f:
+            f.write('timestamp,mean_daily\n2020-01-01,')
+        raise OSError('disk full')
+
+    monkeypatch.setattr(pd.DataFrame, 'to_csv', write_partially)
+    with pytest.raises(OSError):
+        generate_time_series_batch(REQUESTS[:1], polygon_path, '2020-01-01', '2020-03-01',
+                                   LocalFileBackend(series_dir), cache_dir)
+    assert not any(files for _, _, files in os.walk(cache_dir))
@@ -0,0 +1,71 @@
+import json
+import numpy as np
+import pytest
+from datacube import Datacube
+from manifest import StageManifest
+
+DATES = ['2023-01-01', '2023-01-02']
+
+
+def run_stage(manifest, input_path, output_path, params):
+    """A one-key stage copying its input, skipped when its fingerprint is current."""
+    fingerprint = manifest.fingerprint([manifest.file_fingerprint(str(input_path))], params)
+    if manifest.is_current('copy', 'day', fingerprint):
+        return False
+    output_path.write_text(input_path.read_text())
+    manifest.record('copy', 'day', fingerprint, [output_path])
+    return True
+
+
+def test_unchanged_rerun_skips_and_changed_input_reruns(tmp_path):
+    input_path, output_path = tmp_path / 'input.txt', tmp_path / 'output.txt'
+    input_path.write_text('a')
+    manifest_path = str(tmp_path / 'manifest.json')
+    manifest = StageManifest(manifest_path)
+    assert run_stage(manifest, input_path, output_path, {'scale': 1})
+    manifest.save()
+
+    manifest = StageManifest(manifest_path)
+    assert not run_stage(manifest, input_path, output_path, {'scale': 1})
+    assert run_stage(manifest, input_path, output_path, {'scale': 2})
+
+    input_path.write_text('bb')
+    assert run_stage(manifest, input_path, output_path, {'scale': 2})
+    output_path.unlink()
+    assert run_stage(manifest, input_path, output_path, {'scale': 2})
+
+
+def test_interrupted_save_keeps_the_previous_manifest(tmp_path, monkeypatch):
+    input_path, output_path = tmp_path / 'input.txt', tmp_path / 'output.txt'
+    input_path.write_text('a')
+    manifest_path = str(tmp_path / 'manifest.json')
+    manifest = StageManifest(manifest_path)
+    manifest.save()
+
+    run_stage(manifest, input_path, output_path, {})
+
+    def write_partially(content, f):
+        f.write('{"entries": {"copy"')
+        raise OSError('disk full')
+
+    monkeypatch.setattr(json, 'dump', write_partially)
+    with pytest.raises(OSError):
+        manifest.save()
+    monkeypatch.undo()
+    assert StageManifest(manifest_path).entries == {}
+
+
+def test_recreated_datacube_changes_day_signatures(tmp_path):
+    path = str(tmp_path / 'cube')
+    cube = Datacube.create(path, DATES, (3, 4), {'no2': np.float32})
+    signature = cube.day_signature('2023-01-02', ('no2',))
+
+    # Appending after a date keeps its signature, so only the new date is recomputed
+    cube = Datacube.open_or_create(path, DATES + ['2023-01-03'], (3, 4), {'no2': np.float32})
+    assert cube.day_signature('2023-01-02', ('no2',)) == signature
+    cube = Datacube.open_or_create(path, ['2022-12-31'] + DATES + ['2023-01-03'], (3, 4), {'no2': np.float32})
+    assert cube.day_signature('2023-01-02', ('no2',)) != signature
+
+    # An empty datacube recreated over the same dates is a new datacube
+    cube = Datacube.create(path, DATES, (3, 4), {'no2': np.float32})
+    assert cube.day_signature('2023-01-02', ('no2',)) != signature
@@ -0,0 +1,149 @@
+import os
+import uuid
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from shapely.geometry import Polygon, mapping
+import datacube
+from datacube import Datacube
+from manifest import StageManifest
+from model import compute_divergence
+from plotting import aoi_window, process_directories, read_raster_band
+
+DATES = ['2023-01-01', '2023-01-02', '2023-01-03']
+
+
+def write_geotiff(path, array, transform):
+    with rasterio.open(path, 'w', driver='GTiff', height=array.shape[0], width=array.shape[1], count=1,
+                       dtype=array.dtype, crs='EPSG:4326', transform=transform) as dst:
+        dst.write(array, 1)
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    """Coarse wind and fine NO2 GeoTIFFs of a few dates, with some missing pixels."""
+    rng = np.random.default_rng(0)
+    directories = {name: tmp_path / name for name in ('u_wind', 'v_wind', 'no2')}
+    for directory in directories.values():
+        directory.mkdir()
+    for date in DATES:
+        for name in ('u_wind', 'v_wind'):
+            wind = rng.normal(size=(4, 5)).astype(np.float32)
+            wind[rng.random(wind.shape) < 0.1] = np.nan
+            write_geotiff(directories[name] / f'{name}_{date}.tif', wind, from_origin(0, 8, 2, 2))
+        no2 = rng.gamma(2.0, 1e-5, size=(8, 10)).astype(np.float32)
+        no2[rng.random(no2.shape) < 0.1] = np.nan
+        write_geotiff(directories['no2'] / f'no2_{date}.tif', no2, from_origin(0, 8, 1, 1))
+    return [str(directories[name]) for name in ('u_wind', 'v_wind', 'no2')]
+
+
+def run(inputs, directory, precision=None, workers=1):
+    """Process the inputs into directory/datacube and compute its divergence, as model.py does."""
+    datacube_dir, manifest_path = str(directory / 'datacube'), str(directory / 'manifest.json')
+    process_directories(*inputs, datacube_dir, str(directory / 'maps'), manifest_path, workers=workers,
+                        precision=precision, plot=False)
+    manifest = StageManifest(manifest_path)
+    compute_divergence(datacube_dir, workers=workers, manifest=manifest)
+    manifest.save()
+    cube = Datacube(datacube_dir)
+    return {name: np.array(cube.array(name)) for name in cube.variables}
+
+
+def test_switching_precision_drops_or_restores_the_missing_mask(tmp_path, inputs):
+    masked = run(inputs, tmp_path / 'masked', 'float32')
+    full = run(inputs, tmp_path / 'full')
+    assert masked['missing'].any() and 'missing' not in full
+
+    # The same datacube switched between modes matches a fresh run of each mode
+    for precision, expected in (('float32', masked), (None, full), ('float32', masked)):
+        result = run(inputs, tmp_path / 'switched', precision)
+        assert result.keys() == expected.keys()
+        for name, values in expected.items():
+            np.testing.assert_array_equal(result[name], values)
+
+
+def test_parallel_run_matches_serial_run(tmp_path, inputs, monkeypatch):
+    # Both datacubes get the same id, which the stage fingerprints include
+    monkeypatch.setattr(datacube.uuid, 'uuid4', lambda: uuid.UUID(int=0))
+    results, entries = [], []
+    for workers in (1, 2):
+        directory = tmp_path / f'workers_{workers}'
+        results.append(run(inputs, directory, 'float32', workers))
+        manifest = StageManifest(str(directory / 'manifest.json'))
+        for records in manifest.entries.values():
+            for record in records.values():
+                record['outputs'] = [os.path.relpath(path, directory) for path in record['outputs']]
+        entries.append(manifest.entries)
+
+    serial, parallel = results
+    assert serial.keys() == parallel.keys() == {'no2', 'u_wind', 'v_wind', 'missing', 'divergence'}
+    for name, values in serial.items():
+        np.testing.assert_array_equal(parallel[name], values)
+    # Same records, in the same order
+    assert list(entries[0]) == list(entries[1]) == ['interpolate', 'divergence']
+    for stage in entries[0]:
+        assert list(entries[0][stage].items()) == list(entries[1][stage].items())
+        assert list(entries[0][stage]) == DATES
+
+
+@pytest.fixture
+def tiled_raster(tmp_path):
+    """A 50 x 70 GeoTIFF in 16 x 16 blocks with 1 x 1 pixels, and some nodata and NaN pixels."""
+    data = np.arange(50 * 70, dtype=np.float32).reshape(50, 70)
+    data[3, 4] = -9999
+    data[20, 30] = np.nan
+    path = str(tmp_path / 'tiled.tif')
+    with rasterio.open(path, 'w', driver='GTiff', height=50, width=70, count=1, dtype='float32', crs='EPSG:4326',
+                       transform=from_origin(10, 50, 1, 1), tiled=True, blockxsize=16, blockysize=16,
+                       nodata=-9999) as dst:
+        dst.write(data, 1)
+    return path, data
+
+
+def test_read_by_bounds_is_a_slice_of_the_full_read(tiled_raster):
+    path, data = tiled_raster
+    full = read_raster_band(path)
+    np.testing.assert_array_equal(full, data)
+    # Partial pixels at the edges are included: rows 11.3 to 29.8, columns 5.5 to 30.3
+    bounds = (15.5, 20.2, 40.3, 38.7)
+    np.testing.assert_array_equal(read_raster_band(path, bounds=bounds), full[11:30, 5:31])
+    with rasterio.open(path) as src:
+        assert aoi_window(src) == Window(0, 0, 70, 50)
+        # Bounds past the raster are clipped to it
+        assert aoi_window(src, bounds=(0, 45, 12, 60)) == Window(0, 0, 2, 5)
+
+
+def test_read_by_geometry_covers_its_bounding_box(tiled_raster):
+    path, data = tiled_raster
+    triangle = Polygon([(15.5, 20.2), (40.3, 20.2), (20, 38.7)])
+    np.testing.assert_array_equal(read_raster_band(path, geometry=mapping(triangle)), data[11:30, 5:31])
+    np.testing.assert_array_equal(read_raster_band(path, geometry=triangle), data[11:30, 5:31])
+
+
+def test_block_alignment_and_decimation_shapes(tiled_raster):
+    path, data = tiled_raster
+    bounds = (15.5, 20.2, 40.3, 38.7)
+    # Rows 11-30 and columns 5-31 grow to whole 16 x 16 blocks
+    aligned = read_raster_band(path, bounds=bounds, align_to_blocks=True)
+    np.testing.assert_array_equal(aligned, data[:32, :32])
+    # Blocks at the edge of the raster stop at the raster
+    with rasterio.open(path) as src:
+        window = aoi_window(src, bounds=(75, 0.5, 79, 3), align_to_blocks=True)
+    assert (window.row_off, window.col_off, window.height, window.width) == (32, 64, 18, 6)
+
+    assert read_raster_band(path, decimation=4).shape == (13, 18)
+    assert read_raster_band(path, bounds=bounds, decimation=3).shape == (7, 9)
+    assert read_raster_band(path, decimation=4, dtype=np.float64).dtype == np.float64
+
+
+def test_masked_read_flags_nodata_and_nan(tiled_raster):
+    path, data = tiled_raster
+    values, missing = read_raster_band(path, masked=True)
+    assert values.dtype == np.float32 and not isinstance(values, np.ma.MaskedArray)
+    np.testing.assert_array_equal(np.argwhere(missing), [[3, 4], [20, 30]])
+    np.testing.assert_array_equal(values[~missing], data[~missing])
+
+    values, missing = read_raster_band(path, bounds=(12, 40, 16, 48), masked=True)
+    assert values.shape == missing.shape == (8, 4) and missing.sum() == 1 and missing[1, 2]
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from precision import resolve_dtype, validate_precision
+from raster_simulated import make_point_sources, write_scenario_datacube
+
+SHAPE = (80, 80)
+
+
+@pytest.fixture
+def scenario(tmp_path):
+    """float64 inputs of a small synthetic datacube, with random missing pixels."""
+    dates = np.datetime64('2023-01-01') + np.arange(10)
+    positions, rates = make_point_sources(3, SHAPE, margin=15, seed=0)
+    cube = write_scenario_datacube(str(tmp_path / 'cube'), SHAPE, dates, positions, rates, seed=0, dtype=np.float64)
+    no2, u_wind, v_wind = (np.array(cube.array(name)) for name in ('no2', 'u_wind', 'v_wind'))
+    missing = np.random.default_rng(0).random(no2.shape) < 0.02
+    no2[missing] = np.nan
+    return no2, u_wind, v_wind, missing, positions
+
+
+def test_float32_path_is_within_the_default_tolerances(scenario):
+    no2, u_wind, v_wind, missing, positions = scenario
+    report = validate_precision(no2, u_wind, v_wind, missing, peak_positions=positions)
+    assert report.keys() == {'flux', 'divergence', 'average', 'emissions'}
+    # Every stage differs, and the emissions of the converged fits are compared
+    for result in report.values():
+        assert result['passed'] and 0 < result['error'] <= result['tolerance']
+
+
+def test_tighter_tolerance_fails(scenario):
+    no2, u_wind, v_wind, missing, _ = scenario
+    report = validate_precision(no2, u_wind, v_wind, missing, tolerances={'divergence': 1e-12})
+    assert not report['divergence']['passed'] and report['flux']['passed']
+    with pytest.raises(ValueError):
+        resolve_dtype('float16')
@@ -0,0 +1,53 @@
+import os
+import numpy as np
+import pytest
+import rasterio
+from raster_simulated import (add_kernel, make_point_sources, plume_kernel, write_scenario_datacube,
+                              write_scenario_geotiffs)
+
+
+def plume_reference(shape, row, col, u_wind, v_wind, sigma=1.5, spread=0.1, lifetime=4.0):
+    """The plume of plume_kernel evaluated over a whole raster, without truncation."""
+    speed = np.hypot(u_wind, v_wind)
+    dy, dx = np.mgrid[:shape[0], :shape[1]]
+    dy, dx = dy - row, dx - col
+    along = (dx * u_wind + dy * v_wind) / speed
+    across = (-dx * v_wind + dy * u_wind) / speed
+    downwind = np.maximum(along, 0)
+    width = sigma + spread * downwind
+    plume = np.exp(-across ** 2 / (2 * width ** 2) - downwind / (speed * lifetime))
+    plume /= np.sqrt(2 * np.pi) * width * speed
+    return plume * np.exp(-np.minimum(along, 0) ** 2 / (2 * sigma ** 2))
+
+
+@pytest.mark.parametrize('u_wind, v_wind', [(3.0, 0.0), (-2.0, 1.5), (0.5, -4.0)])
+@pytest.mark.parametrize('truncate', [1e-2, 1e-3])
+def test_truncated_kernel_matches_the_full_plume(u_wind, v_wind, truncate):
+    shape, row, col = (301, 301), 150, 150
+    expected = plume_reference(shape, row, col, u_wind, v_wind)
+    kernel = plume_kernel(u_wind, v_wind, truncate=truncate)
+    assert kernel.shape[0] < shape[0]
+    field = np.zeros(shape)
+    add_kernel(field, kernel, row, col, 1.0)
+
+    radius = kernel.shape[0] // 2
+    inside = (slice(row - radius, row + radius + 1), slice(col - radius, col + radius + 1))
+    np.testing.assert_allclose(field[inside], expected[inside], rtol=1e-12)
+    # Outside its radius, the plume is below truncate x its peak
+    assert np.abs(field - expected).max() <= truncate * expected.max()
+
+
+def test_datacube_and_geotiffs_hold_the_same_scenario(tmp_path):
+    shape, dates = (40, 60), np.datetime64('2023-01-01') + np.arange(3)
+    positions, rates = make_point_sources(4, shape, seed=0)
+    cube = write_scenario_datacube(str(tmp_path / 'cube'), shape, dates, positions, rates, seed=1)
+    write_scenario_geotiffs(str(tmp_path / 'tifs'), shape, dates, positions, rates, seed=1)
+
+    for variable in ('no2', 'u_wind', 'v_wind'):
+        for index, date in enumerate(dates):
+            with rasterio.open(os.path.join(tmp_path, 'tifs', variable, f'{variable}_{date}.tif')) as src:
+                array = src.read(1)
+            assert array.dtype == cube.array(variable).dtype == np.float32
+            np.testing.assert_array_equal(array, cube.array(variable)[index])
+    with open(tmp_path / 'cube' / 'sources.csv') as cube_sources, open(tmp_path / 'tifs' / 'sources.csv') as sources:
+        assert cube_sources.read() == sources.read()
@@ -0,0 +1,75 @@
+import numpy as np
+from rasterio.transform import from_origin
+from scipy.interpolate import RegularGridInterpolator
+from regridding import regrid_masked, regrid_operator, regrid_stack, regrid_wind_stack
+
+
+def interpolate_reference(stack, rows, cols):
+    """Bilinear interpolation of each map of a stack at source index positions."""
+    grid = np.meshgrid(rows, cols, indexing='ij')
+    points = np.stack([axis.ravel() for axis in grid], axis=-1)
+    return np.stack([RegularGridInterpolator((np.arange(day.shape[0]), np.arange(day.shape[1])), day)(points)
+                     .reshape(len(rows), len(cols)) for day in stack])
+
+
+def test_bilinear_matches_regular_grid_interpolator():
+    stack = np.random.default_rng(0).normal(size=(3, 7, 9))
+    result = regrid_stack(stack, (20, 31))
+    expected = interpolate_reference(stack, np.linspace(0, 6, 20), np.linspace(0, 8, 31))
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-14)
+
+    # In map coordinates: a finer target grid inside the source, whose pixel centres are at source index positions
+    src_transform, dst_transform = from_origin(10, 20, 1, 1), from_origin(11, 18, 0.25, 0.5)
+    result = regrid_stack(stack, (8, 20), src_transform, dst_transform)
+    rows = (20 - (18 - 0.5 * (np.arange(8) + 0.5))) - 0.5
+    cols = (11 + 0.25 * (np.arange(20) + 0.5) - 10) - 0.5
+    np.testing.assert_allclose(result, interpolate_reference(stack, rows, cols), rtol=0, atol=1e-14)
+    np.testing.assert_array_equal(regrid_stack(stack[0], (8, 20), src_transform, dst_transform), result[0])
+
+
+def test_operator_is_cached_and_float32_stays_float32():
+    assert regrid_operator((7, 9), (20, 31)) is regrid_operator((7, 9), (20, 31))
+    stack = np.random.default_rng(1).normal(size=(2, 7, 9))
+    result = regrid_stack(stack.astype(np.float32), (20, 31))
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, regrid_stack(stack, (20, 31)), atol=1e-5)
+
+
+def test_conservative_preserves_the_area_weighted_sum():
+    stack = np.random.default_rng(2).gamma(2.0, size=(3, 6, 9))
+    # Same extent, so sum * cell area is the total; coarser and finer non-integer ratios
+    for dst_shape in ((4, 6), (10, 14)):
+        result = regrid_stack(stack, dst_shape, method='conservative')
+        cell_ratio = (6 * 9) / (dst_shape[0] * dst_shape[1])
+        np.testing.assert_allclose(result.sum(axis=(1, 2)), stack.sum(axis=(1, 2)) / cell_ratio, rtol=1e-12)
+
+    # Whole 3 x 3 blocks average exactly
+    result = regrid_stack(stack, (2, 3), from_origin(0, 6, 1, 1), from_origin(0, 6, 3, 3), method='conservative')
+    np.testing.assert_allclose(result, stack.reshape(3, 2, 3, 3, 3).mean(axis=(2, 4)), rtol=1e-12)
+
+
+def test_masked_regridding_excludes_missing_pixels():
+    rng = np.random.default_rng(3)
+    stack = rng.normal(size=(2, 8, 10))
+    missing = rng.random(stack.shape) < 0.2
+    missing[1, :4, :5] = True
+    for method in ('bilinear', 'conservative'):
+        result, dst_missing = regrid_masked(np.where(missing, np.nan, stack), missing, (15, 12), method=method)
+        assert dst_missing.shape == result.shape == (2, 15, 12)
+        # Missing values never leak into the result
+        np.testing.assert_array_equal(result, regrid_masked(np.where(missing, 1e30, stack), missing, (15, 12),
+                                                            method=method)[0])
+        assert np.isfinite(result).all()
+        # Weights are renormalized over valid pixels, so a constant field stays constant
+        constant, _ = regrid_masked(np.where(missing, np.nan, 5.0), missing, (15, 12), method=method)
+        np.testing.assert_allclose(constant[~dst_missing], 5.0, rtol=1e-12)
+        np.testing.assert_array_equal(dst_missing, regrid_stack((~missing).astype(float), (15, 12),
+                                                                method=method) < 0.5)
+        assert dst_missing[1, :6, :5].all() and not dst_missing[1, 10:, 8:].all()
+
+    u_wind, v_wind = stack, -2 * stack
+    u_result, v_result, wind_missing = regrid_wind_stack(u_wind, v_wind, (15, 12), missing=missing)
+    np.testing.assert_array_equal(u_result, regrid_masked(u_wind, missing, (15, 12))[0])
+    np.testing.assert_allclose(v_result, -2 * u_result)
+    np.testing.assert_array_equal(wind_missing, regrid_masked(u_wind, missing, (15, 12))[1])
+    assert len(regrid_wind_stack(u_wind, v_wind, (15, 12))) == 2
@@ -0,0 +1,45 @@
+import numpy as np
+from model import gaussian_2d, grid_pixel_area
+from uncertainty import emission_intervals, replicate_means, resample_days
+
+LATS = np.linspace(55.0, 54.0, 60)
+LONS = np.linspace(14.0, 15.0, 60)
+
+
+def noisy_plume_stack(n_days=40, seed=0):
+    y, x = np.mgrid[:60, :60]
+    plume = gaussian_2d((x, y), 5.0, 30, 30, 3, 2, 0.3, 0)
+    return plume + np.random.default_rng(seed).normal(0, 0.5, (n_days, 60, 60))
+
+
+def test_grid_pixel_area_ignores_axis_orientation():
+    assert grid_pixel_area(LATS, LONS) == grid_pixel_area(LATS[::-1], LONS) > 0
+
+
+def test_replicate_means_match_explicit_resampling():
+    windows = np.random.default_rng(1).normal(size=(12, 3, 4))
+    windows[2, 0, 0] = np.nan
+    weights = resample_days(len(windows), 5, seed=2)
+    means = replicate_means(windows, weights)
+    for replicate, counts in zip(means, weights.astype(int)):
+        np.testing.assert_allclose(replicate, np.nanmean(np.repeat(windows, counts, axis=0), axis=0))
+    np.testing.assert_allclose(replicate_means(windows, np.ones((1, 12)))[0], np.nanmean(windows, axis=0))
+
+
+def test_intervals_bracket_the_reported_rate():
+    intervals = emission_intervals([(30, 30)], noisy_plume_stack(), LATS, LONS, n_replicates=100)
+    row = intervals.iloc[0]
+    expected = 5.0 * 2 * np.pi * 3 * 2 * grid_pixel_area(LATS, LONS)
+    assert row['Lower 95%'] <= row['Emission Rate'] <= row['Upper 95%']
+    assert row['Lower 95%'] <= expected <= row['Upper 95%']
+    assert row['Converged Fraction'] > 0.9
+
+
+def test_sources_at_the_same_position_get_the_same_estimate():
+    intervals = emission_intervals([(30, 30), (30, 30)], noisy_plume_stack(), LATS, LONS, n_replicates=20)
+    first, second = intervals.to_numpy()
+    np.testing.assert_array_equal(first, second)
+
+
+def test_no_sources():
+    assert emission_intervals([], noisy_plume_stack(), LATS, LONS, n_replicates=5).empty
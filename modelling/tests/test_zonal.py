@@ -0,0 +1,86 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+from zonal import ZonalStatistics, coverage_mask, zonal_time_series, zonal_time_series_geotiffs
+
+# 1 x 1 pixels, with pixel (row, col) covering x in [col, col + 1] and y in [10 - row - 1, 10 - row]
+TRANSFORM = from_origin(0, 10, 1, 1)
+SHAPE = (10, 12)
+
+
+def pixel_box(row_start, row_stop, col_start, col_stop):
+    return box(col_start, 10 - row_stop, col_stop, 10 - row_start)
+
+
+def weighted_percentile(values, weights, q):
+    """Midpoint-rule weighted percentile of one polygon and day, pixel by pixel."""
+    valid = ~np.isnan(values)
+    values, weights = values[valid], weights[valid]
+    if not len(values):
+        return np.nan
+    order = np.argsort(values)
+    values, weights = values[order], weights[order]
+    positions = (np.cumsum(weights) - weights / 2) / weights.sum()
+    return np.interp(q / 100, positions, values)
+
+
+def test_coverage_fractions():
+    indices, weights = coverage_mask(box(2.0, 5.0, 3.5, 6.25), SHAPE, TRANSFORM)
+    coverage = np.zeros(SHAPE)
+    coverage.flat[indices] = weights
+    np.testing.assert_allclose(coverage[3:5, 2:4], [[0.25, 0.125], [1.0, 0.5]])
+    assert np.count_nonzero(coverage) == 4
+
+
+def test_weighted_mean_skips_nan_pixels():
+    stack = np.arange(2 * 10 * 12, dtype=np.float64).reshape(2, 10, 12)
+    stack[1, 0, 0] = np.nan
+    # Pixel (0, 0) fully and pixel (0, 1) half covered
+    zonal = ZonalStatistics([box(0, 9, 1.5, 10)], SHAPE, TRANSFORM)
+    np.testing.assert_allclose(zonal.mean(stack)[:, 0], [(0 + 0.5 * 1) / 1.5, stack[1, 0, 1]])
+    np.testing.assert_allclose(zonal.sum(stack)[:, 0], [0.5, stack[1, 0, 1] / 2])
+
+
+def test_percentiles_match_hazen_rule_and_weighted_reference():
+    rng = np.random.default_rng(0)
+    stack = rng.normal(size=(5, 10, 12))
+    stack[2, :4, :4] = np.nan
+    stack[3, 5, 5] = np.nan
+    polygons = [pixel_box(0, 4, 0, 4), box(3.3, 1.2, 9.7, 6.6), box(50, 50, 60, 60), pixel_box(2, 7, 6, 12)]
+    q = [5, 25, 50, 90, 100]
+    result = ZonalStatistics(polygons, SHAPE, TRANSFORM).percentiles(stack, q, batch_size=2)
+    assert result.shape == (5, 5, 4)
+
+    # Whole pixels have equal weights, where the midpoint rule is numpy's Hazen method
+    days = [0, 1, 3, 4]
+    expected = np.percentile(stack[days, :4, :4].reshape(4, -1), q, axis=1, method='hazen')
+    np.testing.assert_allclose(result[:, days, 0], expected)
+    assert np.isnan(result[:, 2, 0]).all()
+    assert np.isnan(result[:, :, 2]).all()
+
+    for polygon in (1, 3):
+        indices, weights = coverage_mask(polygons[polygon], SHAPE, TRANSFORM)
+        for day in range(5):
+            values = stack[day].reshape(-1)[indices]
+            expected = [weighted_percentile(values, weights, quantile) for quantile in q]
+            np.testing.assert_allclose(result[:, day, polygon], expected)
+
+
+def test_geotiffs_are_streamed_in_batches(tmp_path):
+    rng = np.random.default_rng(1)
+    stack = rng.normal(size=(5, 10, 12)).astype(np.float32)
+    files = []
+    for day, array in enumerate(stack):
+        files.append(str(tmp_path / f'no2_2023-01-0{day + 1}.tif'))
+        with rasterio.open(files[-1], 'w', driver='GTiff', height=10, width=12, count=1, dtype='float32',
+                           crs='EPSG:4326', transform=TRANSFORM) as dst:
+            dst.write(array, 1)
+    dates = [f'2023-01-0{day + 1}' for day in range(5)]
+    polygons = [box(1.5, 2.5, 6.5, 8.5), box(0, 0, 12, 10)]
+    streamed = zonal_time_series_geotiffs(files, dates, polygons, stats=('mean', 'sum'), percentiles=(50,),
+                                          batch_size=2)
+    expected = zonal_time_series(stack.astype(np.float64), dates, polygons, TRANSFORM, stats=('mean', 'sum'),
+                                 percentiles=(50,))
+    assert len(streamed) == 10
+    np.testing.assert_allclose(streamed.to_numpy(), expected.to_numpy())
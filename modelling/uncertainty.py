@@ -0,0 +1,154 @@
+import os
+import numpy as np
+import pandas as pd
+from datacube import Datacube
+from instrumentation import enable_trace, stage
+from model import fit_gaussian_2d_batch, gaussian_emission_rate, grid_pixel_area, load_peaks
+
+
+def gather_windows(stack, peak_positions, half_window=10):
+    """
+    (T, N, h, w) windows of a (T, H, W) stack centred on each (row, col) peak position.
+
+    Only the windows are read, so stack may be a memory-mapped datacube
+    variable. Windows are padded with NaN at the map border, like fit_peak_windows.
+    """
+    height, width = np.shape(stack)[-2:]
+    size = 2 * half_window + 1
+    windows = np.full((len(stack), len(peak_positions), size, size), np.nan,
+                      dtype=np.result_type(stack.dtype, np.float32))
+    for i, (row, col) in enumerate(peak_positions):
+        row_start, col_start = row - half_window, col - half_window
+        rows = slice(max(0, row_start), min(height, row_start + size))
+        cols = slice(max(0, col_start), min(width, col_start + size))
+        windows[:, i, rows.start - row_start:rows.stop - row_start, cols.start - col_start:cols.stop - col_start] = \
+            stack[:, rows, cols]
+    return windows
+
+
+def resample_days(n_days, n_replicates, seed=0):
+    """(replicates, T) bootstrap weights: how many times each day is drawn in each replicate."""
+    rng = np.random.default_rng(seed)
+    return rng.multinomial(n_days, np.full(n_days, 1 / n_days), size=n_replicates).astype(np.float64)
+
+
+def replicate_means(windows, weights):
+    """
+    NaN-skipping weighted means of (T, ...) windows, one per row of (B, T) weights.
+
+    Both the sums and the valid-day counts are a single matrix product over
+    days, so every replicate average costs one BLAS call.
+
+    Returns:
+    np.ndarray: (B, ...) means, NaN where a pixel has no valid drawn day
+    """
+    flat = windows.reshape(len(windows), -1)
+    valid = ~np.isnan(flat)
+    sums = weights @ np.where(valid, flat, 0)
+    counts = weights @ valid.astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return means.reshape((len(weights),) + windows.shape[1:])
+
+
+def bootstrap_emissions(stack, peak_positions, pixel_area, n_replicates=200, half_window=10, seed=0,
+                        peak_batch=64, fit_batch=2048):
+    """
+    Bootstrap replicates of the emission rate of each source.
+
+    Days of the (T, H, W) divergence stack are resampled with replacement; the
+    same draws are used for all sources, so replicates of sources of one site
+    can be summed. Each replicate's window averages are weighted sums over days,
+    and all replicate windows are refitted together with fit_gaussian_2d_batch.
+    Memory is bounded by peak_batch sources' windows and fit_batch fits at a time.
+
+    Args:
+    stack: (T, H, W) divergence array or memory map
+    peak_positions: (N, 2) (row, col) source positions
+    pixel_area (float): Pixel area in m^2
+
+    Returns:
+    tuple: (N,) point estimates from all days, (B, N) replicate rates (NaN where a fit did not converge)
+    """
+    positions = np.asarray(peak_positions, dtype=np.int64).reshape(-1, 2)
+    weights = resample_days(len(stack), n_replicates, seed)
+    # The point estimate is the all-days replicate, refitted the same way
+    weights = np.vstack([np.ones(len(stack)), weights])
+    rates = np.full((len(weights), len(positions)), np.nan)
+
+    for start in range(0, len(positions), peak_batch):
+        sources = slice(start, start + peak_batch)
+        windows = gather_windows(stack, positions[sources], half_window)
+        replicates_per_fit = max(1, fit_batch // windows.shape[1])
+        for first in range(0, len(weights), replicates_per_fit):
+            replicates = slice(first, first + replicates_per_fit)
+            means = replicate_means(windows, weights[replicates])
+            # Replicates whose fit diverges are dropped, so their overflows are not reported
+            with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+                popt, converged = fit_gaussian_2d_batch(means.reshape((-1,) + means.shape[2:]))
+                batch_rates = np.where(converged, gaussian_emission_rate(popt, pixel_area), np.nan)
+            rates[replicates, sources] = batch_rates.reshape(means.shape[:2])
+    return rates[0], rates[1:]
+
+
+def emission_intervals(peak_positions, stack, lats, lons, n_replicates=200, confidence=95, half_window=10, seed=0):
+    """
+    Emission rates of sources with percentile confidence intervals.
+
+    The reported rate is the batch Gaussian fit of each source window averaged
+    over all days, and the interval bootstraps that same estimator, so the two
+    are always comparable. Sources whose all-days fit did not converge have a
+    NaN rate.
+
+    Args:
+    peak_positions (list): (row, col) source positions, e.g. of the peaks fitted by model.py
+    stack: (T, H, W) divergence of the days to resample
+
+    Returns:
+    pd.DataFrame: One row per source with its rate, bootstrap standard deviation,
+                  interval bounds and the fraction of replicates whose fit converged
+    """
+    positions = [tuple(pos) for pos in peak_positions]
+    with stage('uncertainty', sources=len(positions), replicates=n_replicates, days=len(stack)) as span:
+        estimates, replicates = bootstrap_emissions(stack, positions, grid_pixel_area(lats, lons), n_replicates,
+                                                    half_window, seed)
+        converged = ~np.isnan(replicates)
+        span.set(converged=float(converged.mean()) if converged.size else None)
+
+    tail = (100 - confidence) / 2
+    lower, upper, std = np.full((3, len(positions)), np.nan)
+    # Sources with fewer than two converged replicates have no interval
+    sources = converged.sum(axis=0) > 1
+    if sources.any():
+        lower[sources], upper[sources] = np.nanpercentile(replicates[:, sources], [tail, 100 - tail], axis=0)
+        std[sources] = np.nanstd(replicates[:, sources], axis=0, ddof=1)
+    return pd.DataFrame({
+        'Latitude': [lats[row] for row, _ in positions],
+        'Longitude': [lons[col] for _, col in positions],
+        'Emission Rate': estimates,
+        'Std': std,
+        f'Lower {confidence:g}%': lower,
+        f'Upper {confidence:g}%': upper,
+        'Converged Fraction': converged.mean(axis=0) if len(positions) else np.empty(0),
+    })
+
+
+def save_uncertainty_report(intervals, output_dir):
+    """Save the emission confidence intervals next to the emissions report."""
+    intervals.to_csv(os.path.join(output_dir, 'nox_emissions_uncertainty.csv'), index=False)
+
+
+if __name__ == "__main__":
+    datacube_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/datacube"
+    output_dir = "/home/cedric/repos/cassini_nitrogen_estimation/data/divergence_np"
+    enable_trace("/home/cedric/repos/cassini_nitrogen_estimation/data/trace.jsonl")
+
+    lats = np.load("/home/cedric/repos/cassini_nitrogen_estimation/data/latitudes.npy")
+    lons = np.load("/home/cedric/repos/cassini_nitrogen_estimation/data/longitudes.npy")
+
+    # Sources fitted by model.py on the averaged divergence, resampled over the days of the datacube
+    positions = [pos for pos, _ in load_peaks(os.path.join(output_dir, 'peaks.npz'))]
+    intervals = emission_intervals(positions, Datacube(datacube_dir).array('divergence'), lats, lons)
+    save_uncertainty_report(intervals, output_dir)
+    print(f"Saved 95% intervals of {len(intervals)} sources, "
+          f"{intervals['Converged Fraction'].mean():.0%} of replicate fits converged")
@@ -0,0 +1,234 @@
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import rasterio
+from affine import Affine
+from rasterio.features import rasterize
+from scipy import sparse
+from load_rasters import polygon_hash
+
+# Coverage masks keyed by (polygon hash, transform, shape, supersample), least recently used first
+_MASK_CACHE = OrderedDict()
+MASK_CACHE_SIZE = 4096
+
+
+def _polygon_window(polygon, shape, transform):
+    """Pixel (row_start, row_stop, col_start, col_stop) of a polygon's bounds, clipped to the grid."""
+    left, bottom, right, top = polygon.bounds
+    cols, rows = zip(*(~transform * corner for corner in ((left, bottom), (left, top), (right, bottom), (right, top))))
+    row_start, col_start = max(0, int(np.floor(min(rows)))), max(0, int(np.floor(min(cols))))
+    row_stop, col_stop = min(shape[0], int(np.ceil(max(rows)))), min(shape[1], int(np.ceil(max(cols))))
+    return row_start, row_stop, col_start, col_stop
+
+
+def coverage_mask(polygon, shape, transform, supersample=8):
+    """
+    Fraction of each pixel covered by a polygon, as flat pixel indices and weights.
+
+    The polygon is rasterized on a grid supersample times finer than the target,
+    only within its bounding window, and the sub-pixels are counted per pixel.
+    Masks are cached by (polygon hash, grid transform, shape), so each polygon
+    is rasterized once per grid.
+
+    Args:
+    polygon: Shapely polygon in the CRS of the grid
+    shape (tuple): (H, W) of the grid
+    transform (Affine): Geotransform of the grid
+    supersample (int): Sub-pixels per pixel along each axis
+
+    Returns:
+    tuple: flat indices into the (H, W) grid, coverage fractions in (0, 1]
+    """
+    transform = Affine(*tuple(transform)[:6])
+    key = (polygon_hash(polygon), tuple(transform)[:6], tuple(shape), supersample)
+    if key in _MASK_CACHE:
+        _MASK_CACHE.move_to_end(key)
+        return _MASK_CACHE[key]
+
+    row_start, row_stop, col_start, col_stop = _polygon_window(polygon, shape, transform)
+    if row_stop <= row_start or col_stop <= col_start:
+        mask = np.empty(0, dtype=np.int64), np.empty(0)
+    else:
+        height, width = row_stop - row_start, col_stop - col_start
+        window_transform = transform * Affine.translation(col_start, row_start) * Affine.scale(1 / supersample)
+        fine = rasterize([polygon], out_shape=(height * supersample, width * supersample),
+                         transform=window_transform, fill=0, default_value=1, dtype=np.uint8)
+        coverage = fine.reshape(height, supersample, width, supersample).sum(axis=(1, 3)) / supersample ** 2
+        rows, cols = np.nonzero(coverage)
+        mask = (rows + row_start) * shape[1] + cols + col_start, coverage[rows, cols]
+
+    _MASK_CACHE[key] = mask
+    if len(_MASK_CACHE) > MASK_CACHE_SIZE:
+        _MASK_CACHE.popitem(last=False)
+    return mask
+
+
+class ZonalStatistics:
+    """
+    Statistics of many polygons over (T, H, W) stacks on one grid.
+
+    The coverage masks of all polygons are stacked into one sparse
+    (polygons, pixels) weight matrix, so sums and means of every polygon and
+    day come from one sparse matrix product per batch of days. NaN pixels are
+    left out of the statistics of their day.
+    """
+
+    def __init__(self, polygons, shape, transform, supersample=8):
+        self.shape = tuple(shape)
+        self.masks = [coverage_mask(polygon, shape, transform, supersample) for polygon in polygons]
+        rows = np.repeat(np.arange(len(self.masks)), [len(indices) for indices, _ in self.masks])
+        indices = np.concatenate([indices for indices, _ in self.masks]) if self.masks else np.empty(0, dtype=int)
+        weights = np.concatenate([weights for _, weights in self.masks]) if self.masks else np.empty(0)
+        self.weights = sparse.csr_matrix((weights, (rows, indices)),
+                                         shape=(len(self.masks), self.shape[0] * self.shape[1]))
+
+    def _flat(self, stack):
+        stack = np.asarray(stack)
+        if stack.shape[-2:] != self.shape:
+            raise ValueError(f"Stack shape {stack.shape} does not match the grid {self.shape}")
+        return stack.reshape(-1, self.shape[0] * self.shape[1])
+
+    def weighted_sums(self, stack, batch_size=64):
+        """
+        Coverage-weighted sums of each polygon and day, and the covered area of valid pixels.
+
+        Returns:
+        tuple: (T, polygons) sums, (T, polygons) valid weights, both in pixel units
+        """
+        flat = self._flat(stack)
+        n_days = flat.shape[0]
+        sums = np.empty((n_days, len(self.masks)))
+        valid_weights = np.empty_like(sums)
+        # Batches of days bound the temporary copies when the stack is a memory map
+        for start in range(0, n_days, batch_size):
+            days = flat[start:start + batch_size]
+            valid = ~np.isnan(days)
+            sums[start:start + batch_size] = (self.weights @ np.where(valid, days, 0).T).T
+            valid_weights[start:start + batch_size] = (self.weights @ valid.T.astype(np.float64)).T
+        return sums, valid_weights
+
+    def sum(self, stack):
+        """(T, polygons) coverage-weighted sums."""
+        return self.weighted_sums(stack)[0]
+
+    def mean(self, stack):
+        """(T, polygons) coverage-weighted means, NaN where a polygon has no valid pixel."""
+        sums, valid_weights = self.weighted_sums(stack)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(valid_weights > 0, sums / valid_weights, np.nan)
+
+    def percentiles(self, stack, q, batch_size=64):
+        """
+        (len(q), T, polygons) coverage-weighted percentiles.
+
+        Percentiles follow the midpoint (Hazen) rule: each pixel sits at the middle
+        of its cumulative weight, and values are interpolated between pixels, so
+        with equal weights they match np.percentile(..., method='hazen') rather
+        than its default linear rule. The pixels of all polygons are sorted
+        together per day, segmented by polygon, one batch of days at a time.
+        """
+        flat = self._flat(stack)
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64)) / 100
+        result = np.full((len(q), flat.shape[0], len(self.masks)), np.nan)
+        polygons = np.flatnonzero([len(indices) for indices, _ in self.masks])
+        if not len(polygons):
+            return result
+        indices = np.concatenate([self.masks[i][0] for i in polygons])
+        weights = np.concatenate([self.masks[i][1] for i in polygons])
+        sizes = np.array([len(self.masks[i][0]) for i in polygons])
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        segments = np.repeat(np.arange(len(polygons)), sizes)
+
+        for start in range(0, flat.shape[0], batch_size):
+            values = flat[start:start + batch_size][:, indices]
+            # Sorted by polygon, then value; NaN sorts last within its polygon
+            order = np.lexsort((values, np.broadcast_to(segments, values.shape)), axis=-1)
+            values = np.take_along_axis(values, order, axis=1)
+            missing = np.isnan(values)
+            day_weights = np.where(missing, 0, weights[order])
+            n_valid = np.add.reduceat(~missing, starts, axis=1, dtype=np.int64)
+            total = np.add.reduceat(day_weights, starts, axis=1)
+
+            # Cumulative weight within each polygon, at the middle of each pixel
+            cumulative = np.cumsum(day_weights, axis=1)
+            offsets = np.repeat(cumulative[:, starts] - day_weights[:, starts], sizes, axis=1)
+            totals = np.repeat(np.where(total > 0, total, 1), sizes, axis=1)
+            positions = (cumulative - offsets - day_weights / 2) / totals
+            positions[missing] = np.inf
+
+            below = np.add.reduceat(positions[None] < q[:, None, None], starts, axis=2, dtype=np.int64)
+            upper = np.minimum(below, np.maximum(n_valid - 1, 0)) + starts
+            lower = np.maximum(upper - 1, starts)
+            x0, x1 = (np.take_along_axis(positions[None], index, axis=2) for index in (lower, upper))
+            y0, y1 = (np.take_along_axis(values[None], index, axis=2) for index in (lower, upper))
+            # Polygons without valid pixels on a day have infinite positions and are set to NaN below
+            with np.errstate(invalid='ignore'):
+                frac = np.clip(np.where(x1 > x0, (q[:, None, None] - x0) / np.where(x1 > x0, x1 - x0, 1), 0), 0, 1)
+                result[:, start:start + batch_size, polygons] = np.where(n_valid > 0, y0 + frac * (y1 - y0), np.nan)
+        return result
+
+
+def zonal_time_series(stack, dates, polygons, transform, site_ids=None, stats=('mean',), percentiles=(),
+                      supersample=8):
+    """
+    Per-site time series of a (T, H, W) stack, for many polygons at once.
+
+    Args:
+    stack (np.ndarray): (T, H, W) array or memory map, e.g. a datacube variable
+    dates (list): The T dates of the stack
+    polygons: Shapely polygons (or a GeoSeries) in the CRS of the grid
+    transform (Affine): Geotransform of the grid
+    site_ids (list): Optional site identifiers, defaults to the polygon positions
+    stats (tuple): Any of 'mean' and 'sum'
+    percentiles (tuple): Percentiles to add as p<q> columns
+
+    Returns:
+    pd.DataFrame: One row per (date, site) with a column per statistic
+    """
+    polygons = list(polygons)
+    zonal = ZonalStatistics(polygons, np.shape(stack)[-2:], transform, supersample)
+    return _zonal_frame(_zonal_columns(zonal, stack, stats, percentiles), dates, polygons, site_ids)
+
+
+def _zonal_columns(zonal, stack, stats, percentiles):
+    """Statistic name to (T, polygons) values, as selected for zonal_time_series."""
+    columns = {}
+    if stats:
+        sums, valid_weights = zonal.weighted_sums(stack)
+        if 'sum' in stats:
+            columns['sum'] = sums
+        if 'mean' in stats:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                columns['mean'] = np.where(valid_weights > 0, sums / valid_weights, np.nan)
+    if len(percentiles):
+        for q, values in zip(percentiles, zonal.percentiles(stack, percentiles)):
+            columns[f'p{q:g}'] = values
+    return columns
+
+
+def _zonal_frame(columns, dates, polygons, site_ids=None):
+    site_ids = list(range(len(polygons))) if site_ids is None else list(site_ids)
+    index = pd.MultiIndex.from_product([pd.to_datetime(np.asarray(dates)), site_ids], names=['date', 'site'])
+    return pd.DataFrame({name: values.reshape(-1) for name, values in columns.items()}, index=index)
+
+
+def zonal_time_series_geotiffs(files, dates, polygons, site_ids=None, stats=('mean',), percentiles=(),
+                               supersample=8, batch_size=64):
+    """
+    zonal_time_series over a list of single-band GeoTIFFs sharing one grid.
+
+    Days are read batch_size at a time, so only one batch of rasters is in memory.
+    """
+    polygons = list(polygons)
+    with rasterio.open(files[0]) as src:
+        zonal = ZonalStatistics(polygons, src.shape, src.transform, supersample)
+
+    batches = []
+    for start in range(0, len(files), batch_size):
+        days = []
+        for path in files[start:start + batch_size]:
+            with rasterio.open(path) as src:
+                days.append(src.read(1, masked=True).astype(np.float64).filled(np.nan))
+        batches.append(_zonal_columns(zonal, np.stack(days), stats, percentiles))
+    columns = {name: np.concatenate([batch[name] for batch in batches]) for name in batches[0]}
+    return _zonal_frame(columns, dates, polygons, site_ids)